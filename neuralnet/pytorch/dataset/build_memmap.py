@@ -0,0 +1,175 @@
+"""Convert CIFAR and ImageNet datasets into pre-decoded uint8 shards.
+
+Images are decoded once, resized and stored as raw uint8 HWC arrays in
+memory-mapped shards. An index gives for each image its shard, its byte
+offset in the shard and its label. The shards are read by the memmap readers
+of `readers.py` (datasets 'cifar10_memmap', 'cifar100_memmap' and
+'imagenet_memmap').
+
+Example:
+  python3 -m neuralnet.pytorch.dataset.build_memmap \
+    --data_dir=$DATADIR --output_dir=$DATADIR --dataset=imagenet \
+    --image_size=256
+"""
+import os
+import json
+import logging
+from os.path import join, exists
+from datetime import datetime
+from multiprocessing import Pool
+
+import numpy as np
+from absl import app, flags
+from PIL import Image
+from torchvision.datasets import CIFAR10
+from torchvision.datasets import CIFAR100
+from torchvision.datasets import ImageNet
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("data_dir", "",
+                    "Directory of the original datasets.")
+
+flags.DEFINE_string("output_dir", "/tmp/",
+                    "Output data directory.")
+
+flags.DEFINE_enum("dataset", "", ("cifar10", "cifar100", "imagenet"),
+                  "Dataset to convert.")
+
+flags.DEFINE_integer("image_size", 256,
+                     "Size of the stored square ImageNet images. The short "
+                     "side is resized to image_size then center cropped.")
+
+flags.DEFINE_integer("shard_size", 50000,
+                     "Number of images per shard.")
+
+flags.DEFINE_integer("num_threads", 16,
+                     "Number of processes used to decode the images.")
+
+
+# converter used by the decoding processes, set before the pool is forked to
+# avoid pickling the dataset with each task
+_converter = None
+
+
+def _decode(idx):
+  return _converter.decode(idx)
+
+
+def resize_and_crop(img, image_size):
+  """Resize the short side to image_size and center crop a square."""
+  width, height = img.size
+  scale = image_size / min(width, height)
+  new_width = max(image_size, int(round(width * scale)))
+  new_height = max(image_size, int(round(height * scale)))
+  img = img.resize((new_width, new_height), Image.BICUBIC)
+  left = (new_width - image_size) // 2
+  top = (new_height - image_size) // 2
+  return img.crop((left, top, left + image_size, top + image_size))
+
+
+class ConvertDataset:
+
+  def __init__(self, name, image_size):
+    self.name = name
+    self.image_size = image_size
+
+  def load(self, split):
+    """Return a torchvision dataset yielding (PIL Image, label)."""
+    raise NotImplementedError('Must be implemented in derived classes')
+
+  def decode(self, idx):
+    img, label = self.dataset[idx]
+    img = img.convert('RGB')
+    if img.size != (self.image_size, self.image_size):
+      img = resize_and_crop(img, self.image_size)
+    return np.asarray(img, dtype=np.uint8), label
+
+  def _process_split(self, split, output_dir):
+    global _converter
+    self.dataset = self.load(split)
+    _converter = self
+    n_images = len(self.dataset)
+    image_shape = (self.image_size, self.image_size, 3)
+    image_nbytes = int(np.prod(image_shape))
+    n_shards = int(np.ceil(n_images / FLAGS.shard_size))
+
+    # index: shard id, byte offset in the shard, label
+    index = np.zeros((n_images, 3), dtype=np.int64)
+    with Pool(FLAGS.num_threads) as pool:
+      images = pool.imap(_decode, range(n_images), chunksize=64)
+      for shard_id in range(n_shards):
+        start = shard_id * FLAGS.shard_size
+        end = min(start + FLAGS.shard_size, n_images)
+        output_file = join(output_dir, '{}-{:05d}-of-{:05d}.bin'.format(
+          split, shard_id, n_shards))
+        shard = np.memmap(output_file, dtype=np.uint8, mode='w+',
+                          shape=((end - start) * image_nbytes,))
+        for i in range(start, end):
+          img, label = next(images)
+          offset = (i - start) * image_nbytes
+          shard[offset:offset + image_nbytes] = img.reshape(-1)
+          index[i] = (shard_id, offset, label)
+        shard.flush()
+        del shard
+        print('{}: Wrote {} images to {}'.format(
+          datetime.now(), end - start, output_file), flush=True)
+
+    np.save(join(output_dir, '{}_index.npy'.format(split)), index)
+    meta = {'n_images': n_images, 'n_shards': n_shards,
+            'image_shape': image_shape}
+    with open(join(output_dir, '{}_meta.json'.format(split)), 'w') as f:
+      json.dump(meta, f)
+
+  def convert(self):
+    output_dir = join(FLAGS.output_dir, '{}_memmap'.format(self.name))
+    if exists(output_dir):
+      logging.info('{} data already converted to memmap.'.format(self.name))
+      return
+    os.makedirs(output_dir)
+    for split in ('train', 'val'):
+      self._process_split(split, output_dir)
+
+
+class ConvertCIFAR10(ConvertDataset):
+
+  def __init__(self):
+    super(ConvertCIFAR10, self).__init__('cifar10', 32)
+
+  def load(self, split):
+    return CIFAR10(join(FLAGS.data_dir, self.name),
+                   train=split == 'train', download=False)
+
+
+class ConvertCIFAR100(ConvertDataset):
+
+  def __init__(self):
+    super(ConvertCIFAR100, self).__init__('cifar100', 32)
+
+  def load(self, split):
+    return CIFAR100(join(FLAGS.data_dir, self.name),
+                    train=split == 'train', download=False)
+
+
+class ConvertImageNet(ConvertDataset):
+
+  def __init__(self):
+    super(ConvertImageNet, self).__init__('imagenet', FLAGS.image_size)
+
+  def load(self, split):
+    return ImageNet(join(FLAGS.data_dir, self.name),
+                    split=split, download=False)
+
+
+def main(_):
+  if FLAGS.dataset == "cifar10":
+    ConvertCIFAR10().convert()
+  elif FLAGS.dataset == "cifar100":
+    ConvertCIFAR100().convert()
+  elif FLAGS.dataset == "imagenet":
+    ConvertImageNet().convert()
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -1,14 +1,21 @@
 
+import os
+import glob
 import logging
 import random
 import math
+import json
 from os.path import join
 from os.path import exists
 
+import numpy as np
 import torch
+import torch.nn.functional as F
+import torch.distributed as dist
 import torchvision.transforms as transforms
+from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
-from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data import Sampler
 from torchvision.transforms import Compose
 from torchvision.datasets import MNIST
 from torchvision.datasets import CIFAR10
@@ -19,6 +26,154 @@ from PIL import Image
 from ..utils import AddNoise
 
 
+def get_numa_node_cpus(local_rank, num_gpus):
+  """Return the list of cpus of the NUMA node assumed to be attached to the
+  gpu local_rank (gpus evenly spread over the NUMA nodes)."""
+  nodes = sorted(glob.glob('/sys/devices/system/node/node[0-9]*'),
+                 key=lambda x: int(x.split('node')[-1]))
+  if not nodes or not num_gpus:
+    return None
+  node = nodes[local_rank * len(nodes) // num_gpus]
+  with open(join(node, 'cpulist')) as f:
+    cpulist = f.read().strip()
+  cpus = []
+  for cpu_range in cpulist.split(','):
+    if '-' in cpu_range:
+      start, end = map(int, cpu_range.split('-'))
+      cpus.extend(range(start, end + 1))
+    else:
+      cpus.append(int(cpu_range))
+  return cpus
+
+
+class PinWorker:
+  """worker_init_fn pinning the loader workers on a set of cpus."""
+
+  def __init__(self, cpus):
+    self.cpus = cpus
+
+  def __call__(self, worker_id):
+    os.sched_setaffinity(0, self.cpus)
+
+
+class CUDAPrefetcher:
+  """Wrap a DataLoader and copy the next batch to the gpu on a side stream
+  while the current batch is processed."""
+
+  def __init__(self, loader):
+    self.loader = loader
+    self.stream = torch.cuda.Stream()
+
+  def __len__(self):
+    return len(self.loader)
+
+  def _to_cuda(self, data):
+    with torch.cuda.stream(self.stream):
+      return [x.cuda(non_blocking=True) for x in data]
+
+  def __iter__(self):
+    loader = iter(self.loader)
+    next_data = None
+    try:
+      next_data = self._to_cuda(next(loader))
+    except StopIteration:
+      return
+    while next_data is not None:
+      torch.cuda.current_stream().wait_stream(self.stream)
+      data = next_data
+      for x in data:
+        x.record_stream(torch.cuda.current_stream())
+      try:
+        next_data = self._to_cuda(next(loader))
+      except StopIteration:
+        next_data = None
+      yield data
+
+
+def get_loader_queue_depth(iterator):
+  """Return the number of batches ready in a DataLoader iterator, None if it
+  cannot be known (single process loading, prefetcher, macOS)."""
+  queue = getattr(iterator, '_data_queue', None)
+  try:
+    return queue.qsize()
+  except (AttributeError, NotImplementedError):
+    return None
+
+
+class ElasticDistributedSampler(Sampler):
+  """Distributed sampler which can resume an epoch from a global position.
+
+  The permutation of an epoch only depends on the seed and the epoch, not on
+  the number of replicas. The samples from `start_index` are split between
+  the current replicas, an epoch interrupted by a failure or a change of
+  the number of workers is resumed without repeating or skipping samples.
+  The skipped samples are sliced out of the permutation, they are never
+  loaded.
+
+  The training loop calls `advance` with the number of samples consumed by
+  all the replicas, `state_dict` gives the seed, the epoch and the position
+  of the next unseen sample to store in the checkpoints.
+  """
+
+  def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True,
+               seed=0):
+    if num_replicas is None:
+      num_replicas = dist.get_world_size()
+    if rank is None:
+      rank = dist.get_rank()
+    self.dataset = dataset
+    self.num_replicas = num_replicas
+    self.rank = rank
+    self.shuffle = shuffle
+    self.seed = seed
+    self.epoch = 0
+    self.start_index = 0
+    # global position of the next sample which has not been consumed
+    self.cursor = 0
+
+  def set_epoch(self, epoch, start_index=0):
+    """Set the epoch and the global position of the first sample."""
+    self.epoch = epoch
+    self.start_index = start_index
+    self.cursor = start_index
+
+  def advance(self, n_samples):
+    """Move the cursor after n_samples consumed by all the replicas."""
+    self.cursor = min(self.cursor + n_samples, len(self.dataset))
+
+  def state_dict(self):
+    return {'seed': self.seed, 'epoch': self.epoch, 'start_index': self.cursor}
+
+  def load_state_dict(self, state_dict):
+    self.seed = state_dict.get('seed', self.seed)
+    self.set_epoch(state_dict['epoch'], state_dict['start_index'])
+
+  @property
+  def num_samples(self):
+    remaining = max(len(self.dataset) - self.start_index, 0)
+    return int(math.ceil(remaining / self.num_replicas))
+
+  def __iter__(self):
+    n = len(self.dataset)
+    if self.shuffle:
+      generator = torch.Generator()
+      generator.manual_seed(self.seed + self.epoch)
+      indices = torch.randperm(n, generator=generator).tolist()
+    else:
+      indices = list(range(n))
+    indices = indices[self.start_index:]
+    if not indices:
+      return iter([])
+    # pad the indices to make them evenly divisible between the replicas
+    total_size = self.num_samples * self.num_replicas
+    while len(indices) < total_size:
+      indices += indices[:total_size - len(indices)]
+    return iter(indices[self.rank:total_size:self.num_replicas])
+
+  def __len__(self):
+    return self.num_samples
+
+
 class BaseReader:
 
   def __init__(self, params, batch_size, num_gpus, is_training):
@@ -29,8 +184,28 @@ class BaseReader:
     self.is_training = is_training
     self.add_noise = getattr(
       self.params, 'add_noise', False) and self.is_training
+    # sample the noise on the device on the whole batch instead of on each
+    # image in the workers (imagenet)
+    self.noise_on_device = getattr(
+      self.params, 'noise_on_device', False) and self.add_noise
     self.path = join(self.get_data_dir(), self.params.dataset)
     self.num_threads = self.params.datasets_num_private_threads
+    # transformation applied on the whole batch after the host to device
+    # copy, None if all the transformations are done in the workers
+    self.batch_transform = None
+
+    # DataLoader configuration
+    self.persistent_workers = getattr(
+      self.params, 'datasets_persistent_workers', False)
+    self.prefetch_factor = getattr(self.params, 'datasets_prefetch_factor', 2)
+    self.drop_last = getattr(
+      self.params, 'datasets_drop_last', False) and self.is_training
+    self.cuda_prefetch = getattr(
+      self.params, 'datasets_cuda_prefetch', False) and bool(self.num_gpus)
+    self.numa_pinning = getattr(self.params, 'datasets_numa_pinning', False)
+    # the loader is built once and reused by all the calls to load_dataset
+    self._loader = None
+    self._sampler = None
 
   def get_data_dir(self):
     paths = self.params.data_dir.split(':')
@@ -47,23 +222,109 @@ class BaseReader:
     """Create the transformer pipeline."""
     raise NotImplementedError('Must be implemented in derived classes')
 
+  def reset_loader(self):
+    """Drop the cached loader, the next call to load_dataset builds a new
+    one (e.g. after changing num_threads)."""
+    self._loader = None
+    self._sampler = None
+
   def load_dataset(self):
-    """Load or download dataset."""
-    if getattr(self.params, 'job_name', None):
-      sampler = torch.utils.data.distributed.DistributedSampler(
-        self.dataset, num_replicas=None, rank=None)
+    """Load or download dataset.
+
+    The loader is cached: with persistent workers, the workers are kept
+    alive between the passes over the dataset."""
+    if self._loader is not None:
+      return self._loader, self._sampler
+    seed = getattr(self.params, 'torch_random_seed', None) or 0
+    if dist.is_available() and dist.is_initialized():
+      # the number of replicas is read from the current process group
+      sampler = ElasticDistributedSampler(
+        self.dataset, shuffle=self.is_training, seed=seed)
+    elif self.is_training:
+      # single replica, the sampler makes the epochs resumable
+      sampler = ElasticDistributedSampler(
+        self.dataset, num_replicas=1, rank=0, seed=seed)
     else:
       sampler = None
+    loader_kwargs = {}
+    if self.num_threads > 0:
+      loader_kwargs['persistent_workers'] = self.persistent_workers
+      loader_kwargs['prefetch_factor'] = self.prefetch_factor
+      if self.numa_pinning:
+        cpus = get_numa_node_cpus(
+          getattr(self.params, 'local_rank', 0), self.num_gpus)
+        if cpus is not None:
+          loader_kwargs['worker_init_fn'] = PinWorker(cpus)
     loader = DataLoader(self.dataset,
                         batch_size=self.batch_size,
                         num_workers=self.num_threads,
                         shuffle=self.is_training and not sampler,
                         pin_memory=bool(self.num_gpus),
-                        sampler=sampler)
+                        drop_last=self.drop_last,
+                        sampler=sampler,
+                        **loader_kwargs)
+    if self.cuda_prefetch:
+      loader = CUDAPrefetcher(loader)
+    self._loader, self._sampler = loader, sampler
     return loader, sampler
 
 
 
+class MemmapDataset(Dataset):
+  """Dataset of pre-decoded uint8 images stored in memory-mapped shards.
+
+  The shards and the index are created by `build_memmap.py`. Images are
+  returned as PIL Images built on a view of the shard, the online
+  transformations (crop, flip, ...) are applied afterwards.
+  """
+
+  def __init__(self, path, split, transform=None, as_tensor=False):
+    self.path = path
+    self.split = split
+    self.transform = transform
+    # if True, images are returned as uint8 CHW tensors instead of PIL Images
+    self.as_tensor = as_tensor
+    with open(join(path, '{}_meta.json'.format(split))) as f:
+      meta = json.load(f)
+    self.n_shards = meta['n_shards']
+    self.image_shape = tuple(meta['image_shape'])
+    self.image_nbytes = int(np.prod(self.image_shape))
+    # index: shard id, byte offset in the shard, label
+    self.index = np.load(join(path, '{}_index.npy'.format(split)))
+    self.targets = self.index[:, 2]
+    # shards are opened lazily in each worker
+    self.shards = {}
+
+  def __len__(self):
+    return len(self.index)
+
+  def get_shard(self, shard_id):
+    if shard_id not in self.shards:
+      filename = '{}-{:05d}-of-{:05d}.bin'.format(
+        self.split, shard_id, self.n_shards)
+      self.shards[shard_id] = np.memmap(
+        join(self.path, filename), dtype=np.uint8, mode='r')
+    return self.shards[shard_id]
+
+  def get_array(self, idx):
+    """Return a zero-copy view of the image idx and its label."""
+    shard_id, offset, label = self.index[idx]
+    shard = self.get_shard(shard_id)
+    img = shard[offset:offset + self.image_nbytes].reshape(self.image_shape)
+    return img, int(label)
+
+  def __getitem__(self, idx):
+    img, label = self.get_array(idx)
+    if self.as_tensor:
+      img = torch.from_numpy(np.ascontiguousarray(img.transpose(2, 0, 1)))
+    else:
+      img = Image.fromarray(img)
+    if self.transform is not None:
+      img = self.transform(img)
+    return img, label
+
+
+
 class MNISTReader(BaseReader):
 
   def __init__(self, params, batch_size, num_gpus, is_training):
@@ -131,8 +392,11 @@ class CIFAR10Reader(CIFARReader):
     if self.add_noise:
       transform.transforms.append(AddNoise(self.params))
 
-    self.dataset = CIFAR10(self.path, train=self.is_training,
-                           download=False, transform=transform)
+    self.dataset = self.build_dataset(transform)
+
+  def build_dataset(self, transform):
+    return CIFAR10(self.path, train=self.is_training,
+                   download=False, transform=transform)
 
 
 class CIFAR100Reader(CIFARReader):
@@ -146,8 +410,11 @@ class CIFAR100Reader(CIFARReader):
     if self.add_noise:
       transform.transforms.append(AddNoise(self.params))
 
-    self.dataset = CIFAR100(self.path, train=self.is_training,
-                           download=False, transform=transform)
+    self.dataset = self.build_dataset(transform)
+
+  def build_dataset(self, transform):
+    return CIFAR100(self.path, train=self.is_training,
+                    download=False, transform=transform)
 
 
 
@@ -260,6 +527,220 @@ def final_normalization(img):
   return (img - img.min()) / (img.max() - img.min())
 
 
+def to_float(batch):
+  """Convert a uint8 batch to float in [0, 1]."""
+  if batch.dtype == torch.uint8:
+    return batch.float().div_(255)
+  return batch
+
+
+class BatchEfficientNetRandomCrop:
+  """Batched version of EfficientNetRandomCrop followed by the resize and the
+  random horizontal flip. Takes a (N, C, H, W) batch, all the crop boxes are
+  sampled with tensor ops and applied with a single grid_sample."""
+
+  def __init__(self, imgsize, min_covered=0.1,
+               aspect_ratio_range=(3./4, 4./3), area_range=(0.08, 1.0),
+               max_attempts=10, flip=True):
+
+    assert 0.0 < min_covered
+    assert 0 < aspect_ratio_range[0] <= aspect_ratio_range[1]
+    assert 0 < area_range[0] <= area_range[1]
+    assert 1 <= max_attempts
+
+    self.imgsize = imgsize
+    self.min_covered = min_covered
+    self.aspect_ratio_range = aspect_ratio_range
+    self.area_range = area_range
+    self.max_attempts = max_attempts
+    self.flip = flip
+
+  def sample_boxes(self, n, original_height, original_width, device):
+    """Sample max_attempts boxes per image and keep the first valid one,
+    same rules as EfficientNetRandomCrop."""
+    original_area = original_width * original_height
+    min_area = self.area_range[0] * original_area
+    max_area = self.area_range[1] * original_area
+
+    shape = (n, self.max_attempts)
+    aspect_ratio = torch.empty(shape, device=device).uniform_(
+      *self.aspect_ratio_range)
+    height = torch.round(torch.sqrt(min_area / aspect_ratio))
+    max_height = torch.round(torch.sqrt(max_area / aspect_ratio))
+
+    too_wide = max_height * aspect_ratio > original_width
+    max_height = torch.where(
+      too_wide,
+      torch.floor((original_width + 0.5 - 1e-7) / aspect_ratio), max_height)
+    too_wide = max_height * aspect_ratio > original_width
+    max_height = torch.where(too_wide, max_height - 1, max_height)
+    max_height = torch.clamp(max_height, max=original_height)
+    height = torch.min(height, max_height)
+
+    height = torch.round(
+      height + torch.rand(shape, device=device) * (max_height - height))
+    width = torch.round(height * aspect_ratio)
+    area = width * height
+
+    valid = (area >= min_area) & (area <= max_area)
+    valid &= (width <= original_width) & (height <= original_height)
+    valid &= area >= self.min_covered * original_area
+
+    # index of the first valid attempt
+    order = torch.arange(self.max_attempts, 0, -1, device=device)
+    first = (valid.float() * order).argmax(dim=1, keepdim=True)
+    height = height.gather(1, first).squeeze(1)
+    width = width.gather(1, first).squeeze(1)
+    # fallback to the center crop if no attempt is valid or if the box covers
+    # the full image
+    fallback = ~valid.any(dim=1)
+    fallback |= (width == original_width) & (height == original_height)
+
+    x = torch.floor(torch.rand(n, device=device) * (original_width - width + 1))
+    y = torch.floor(
+      torch.rand(n, device=device) * (original_height - height + 1))
+
+    crop_size = float(self.imgsize) / (self.imgsize + 32) * \
+        min(original_width, original_height)
+    center_x = round((original_width - crop_size) / 2.)
+    center_y = round((original_height - crop_size) / 2.)
+    x = torch.where(fallback, torch.full_like(x, center_x), x)
+    y = torch.where(fallback, torch.full_like(y, center_y), y)
+    width = torch.where(fallback, torch.full_like(width, crop_size), width)
+    height = torch.where(fallback, torch.full_like(height, crop_size), height)
+    return x, y, width, height
+
+  def __call__(self, batch):
+    batch = to_float(batch)
+    n, _, original_height, original_width = batch.shape
+    x, y, width, height = self.sample_boxes(
+      n, original_height, original_width, batch.device)
+
+    # affine transformation from the output grid to the crop box in the
+    # normalized coordinates of grid_sample
+    scale_x = width / original_width
+    scale_y = height / original_height
+    if self.flip:
+      flip = torch.rand(n, device=batch.device) < 0.5
+      scale_x = torch.where(flip, -scale_x, scale_x)
+    theta = torch.zeros(n, 2, 3, device=batch.device)
+    theta[:, 0, 0] = scale_x
+    theta[:, 0, 2] = (2 * x + width) / original_width - 1
+    theta[:, 1, 1] = scale_y
+    theta[:, 1, 2] = (2 * y + height) / original_height - 1
+    grid = F.affine_grid(
+      theta, (n, batch.shape[1], self.imgsize, self.imgsize),
+      align_corners=False)
+    batch = F.grid_sample(
+      batch, grid, mode='bilinear', padding_mode='border',
+      align_corners=False)
+    return batch
+
+
+class BatchEfficientNetCenterCrop:
+  """Batched version of EfficientNetCenterCrop followed by the resize."""
+
+  def __init__(self, imgsize):
+    self.imgsize = imgsize
+
+  def __call__(self, batch):
+    batch = to_float(batch)
+    image_height, image_width = batch.shape[2:]
+    image_short = min(image_width, image_height)
+    crop_size = float(self.imgsize) / (self.imgsize + 32) * image_short
+    crop_size = int(round(crop_size))
+    crop_top = int(round((image_height - crop_size) / 2.))
+    crop_left = int(round((image_width - crop_size) / 2.))
+    batch = batch[:, :, crop_top:crop_top + crop_size,
+                  crop_left:crop_left + crop_size]
+    batch = F.interpolate(
+      batch, size=(self.imgsize, self.imgsize), mode='bicubic',
+      align_corners=False)
+    return batch.clamp_(0, 1)
+
+
+class BatchColorJitter:
+  """Batched version of ColorJitter for brightness, contrast and saturation,
+  the factors are sampled for each image."""
+
+  def __init__(self, brightness=0, contrast=0, saturation=0):
+    self.brightness = brightness
+    self.contrast = contrast
+    self.saturation = saturation
+
+  def _factor(self, value, batch):
+    return torch.empty(batch.shape[0], 1, 1, 1, device=batch.device).uniform_(
+      max(0, 1 - value), 1 + value)
+
+  def _grayscale(self, batch):
+    r, g, b = batch[:, 0], batch[:, 1], batch[:, 2]
+    return (0.299 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+  def _adjust_brightness(self, batch):
+    return batch * self._factor(self.brightness, batch)
+
+  def _adjust_contrast(self, batch):
+    mean = self._grayscale(batch).mean(dim=(1, 2, 3), keepdim=True)
+    factor = self._factor(self.contrast, batch)
+    return factor * batch + (1 - factor) * mean
+
+  def _adjust_saturation(self, batch):
+    factor = self._factor(self.saturation, batch)
+    return factor * batch + (1 - factor) * self._grayscale(batch)
+
+  def __call__(self, batch):
+    adjusts = []
+    if self.brightness:
+      adjusts.append(self._adjust_brightness)
+    if self.contrast:
+      adjusts.append(self._adjust_contrast)
+    if self.saturation:
+      adjusts.append(self._adjust_saturation)
+    random.shuffle(adjusts)
+    for adjust in adjusts:
+      batch = adjust(batch).clamp_(0, 1)
+    return batch
+
+
+class BatchLighting:
+  """Batched version of Lighting, alpha is sampled for each image."""
+
+  def __init__(self, alphastd, eigval, eigvec):
+    self.alphastd = alphastd
+    self.eigval = torch.Tensor(eigval)
+    self.eigvec = torch.Tensor(eigvec)
+
+  def __call__(self, batch):
+    if self.alphastd == 0:
+      return batch
+    eigval = self.eigval.to(batch.device)
+    eigvec = self.eigvec.to(batch.device)
+    alpha = torch.empty(batch.shape[0], 3, device=batch.device).normal_(
+      0, self.alphastd)
+    rgb = torch.matmul(alpha * eigval, eigvec.t())
+    return batch + rgb.view(-1, 3, 1, 1)
+
+
+class BatchNormalize:
+
+  def __init__(self, mean, std):
+    self.mean = torch.Tensor(mean).view(1, -1, 1, 1)
+    self.std = torch.Tensor(std).view(1, -1, 1, 1)
+
+  def __call__(self, batch):
+    mean = self.mean.to(batch.device)
+    std = self.std.to(batch.device)
+    return (batch - mean) / std
+
+
+def batch_final_normalization(batch):
+  """Batched version of final_normalization, min and max for each image."""
+  flat = batch.view(batch.shape[0], -1)
+  batch_min = flat.min(dim=1)[0].view(-1, 1, 1, 1)
+  batch_max = flat.max(dim=1)[0].view(-1, 1, 1, 1)
+  return (batch - batch_min) / (batch_max - batch_min)
+
+
 class IMAGENETReader(BaseReader):
 
   def __init__(self, params, batch_size, num_gpus, is_training):
@@ -295,18 +776,22 @@ class IMAGENETReader(BaseReader):
     self.n_classes = 1000
     self.batch_shape = (None, 3, self.height, self.height)
 
-    split = 'train' if self.is_training else 'val'
-
     if 'efficientnet' in self.params.model:
       transform = self.efficientnet_transform()
     else:
       transform = self.transform()
 
-    if self.add_noise:
+    if self.add_noise and not self.noise_on_device:
       transform.transforms.append(AddNoise(self.params))
 
-    self.dataset = ImageNet(self.path, split=split,
-                            download=False, transform=transform)
+    self.dataset = self.build_dataset(transform)
+    if self.noise_on_device:
+      self.batch_transform = AddNoise(self.params)
+
+  def build_dataset(self, transform):
+    split = 'train' if self.is_training else 'val'
+    return ImageNet(self.path, split=split,
+                    download=False, transform=transform)
 
   def efficientnet_transform(self):
     if self.is_training:
@@ -350,9 +835,77 @@ class IMAGENETReader(BaseReader):
     return transform
 
 
+class CIFAR10MemmapReader(CIFAR10Reader):
+  """CIFAR10 reader for the shards created by `build_memmap.py`."""
+
+  def build_dataset(self, transform):
+    split = 'train' if self.is_training else 'val'
+    return MemmapDataset(self.path, split, transform=transform)
+
+
+class CIFAR100MemmapReader(CIFAR100Reader):
+  """CIFAR100 reader for the shards created by `build_memmap.py`."""
+
+  def build_dataset(self, transform):
+    split = 'train' if self.is_training else 'val'
+    return MemmapDataset(self.path, split, transform=transform)
+
+
+class IMAGENETMemmapReader(IMAGENETReader):
+  """ImageNet reader for the pre-resized shards created by
+  `build_memmap.py`, the JPEG decoding is done once offline.
+
+  If `batched_augmentation` is True, the workers only gather uint8 images and
+  the EfficientNet augmentation is applied on the whole batch by
+  `batch_transform` after the host to device copy.
+  """
+
+  def __init__(self, params, batch_size, num_gpus, is_training):
+    self.batched_augmentation = getattr(
+      params, 'batched_augmentation', False)
+    if self.batched_augmentation and 'efficientnet' not in params.model:
+      raise ValueError(
+        "batched_augmentation is only available for efficientnet models.")
+    super(IMAGENETMemmapReader, self).__init__(
+      params, batch_size, num_gpus, is_training)
+    if self.batched_augmentation:
+      self.dataset.transform = None
+      self.batch_transform = self.efficientnet_batch_transform()
+
+  def build_dataset(self, transform):
+    split = 'train' if self.is_training else 'val'
+    return MemmapDataset(self.path, split, transform=transform,
+                         as_tensor=self.batched_augmentation)
+
+  def efficientnet_batch_transform(self):
+    if self.is_training:
+      transform = Compose([
+        BatchEfficientNetRandomCrop(self.image_size),
+        BatchColorJitter(brightness=0.4, contrast=0.4, saturation=0.4),
+        BatchLighting(
+          0.1, self.imagenet_pca['eigval'], self.imagenet_pca['eigvec']),
+        BatchNormalize(
+          mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+        batch_final_normalization
+      ])
+    else:
+      transform = Compose([
+        BatchEfficientNetCenterCrop(self.image_size),
+        BatchNormalize(
+          mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+        batch_final_normalization
+      ])
+    if self.add_noise:
+      transform.transforms.append(AddNoise(self.params))
+    return transform
+
+
 readers_config = {
   'mnist': MNISTReader,
   'cifar10': CIFAR10Reader,
   'cifar100': CIFAR100Reader,
-  'imagenet': IMAGENETReader
+  'imagenet': IMAGENETReader,
+  'cifar10_memmap': CIFAR10MemmapReader,
+  'cifar100_memmap': CIFAR100MemmapReader,
+  'imagenet_memmap': IMAGENETMemmapReader
 }
@@ -2,12 +2,14 @@
 import json
 import time
 import os
+import copy
 import re
 import socket
 import pprint
 import logging
 from os.path import join
 from os.path import exists
+from collections import OrderedDict
 
 import utils as global_utils
 from dump_files import DumpFiles
@@ -74,6 +76,13 @@ class Evaluator:
     self.model = torch.nn.DataParallel(self.model)
     self.model = self.model.cuda()
 
+    # replicas of the model used to evaluate several checkpoints with a
+    # single pass over the dataset
+    self.models = [self.model]
+    if not self.params.eval_under_attack:
+      n_models = getattr(self.params, 'eval_num_ckpts_per_pass', 1)
+      self.models += [copy.deepcopy(self.model) for _ in range(n_models - 1)]
+
     self.add_noise = False
     eot = getattr(self.params, 'eot', False)
     if getattr(self.params, 'add_noise', False) and eot == False:
@@ -81,20 +90,41 @@ class Evaluator:
       self.noise = utils.AddNoise(self.params)
 
     if self.params.eval_under_attack:
-      if self.params.dump_files:
-        self.dump = DumpFiles(params)
       if eot:
         attack_model = utils.EOTWrapper(
           self.model, self.reader.n_classes, self.params)
       else:
         attack_model = self.model
 
-      attack_params = self.params.attack_params
-      self.attack = utils.get_attack(
-                      self.model,
-                      self.reader.n_classes,
-                      self.params.attack_method,
-                      attack_params)
+      # the attacks run on each batch, with the attack_multi config several
+      # attacks are evaluated with a single pass over the dataset
+      self.attacks_config = getattr(self.params, 'attacks', None) or [{
+        'name': self.params.attack_method,
+        'attack_method': self.params.attack_method,
+        'attack_params': self.params.attack_params}]
+      self.attacks = OrderedDict()
+      self.dumps = {}
+      for config in self.attacks_config:
+        name = config.get('name', config['attack_method'])
+        if name in self.attacks:
+          raise ValueError("Attack name '{}' is not unique.".format(name))
+        self.attacks[name] = utils.get_attack(
+                               attack_model,
+                               self.reader.n_classes,
+                               config['attack_method'],
+                               config['attack_params'])
+        if self.params.dump_files:
+          self.dumps[name] = DumpFiles(self._get_attack_params(config))
+
+      # an early stopping attack with refill takes the samples from the
+      # data loader itself, the batches are not aligned with the loader
+      self.refill_attack = None
+      refill = [attack for attack in self.attacks.values()
+                if getattr(attack, 'refill', False)]
+      if refill and len(self.attacks) > 1:
+        raise ValueError("Attacks with refill can only be run alone.")
+      if refill:
+        self.refill_attack = refill[0]
 
 
   def run(self):
@@ -108,16 +138,17 @@ class Evaluator:
       logging.info('Evalution under attack done.')
 
 
-  def load_ckpt(self, path):
+  def load_ckpt(self, path, model=None):
+    model = model or self.model
     checkpoint = torch.load(path)
     global_step = checkpoint['global_step']
     epoch = checkpoint['epoch']
     if 'ema' in checkpoint.keys():
       logging.info("Loading ema state dict.")
-      self.model.load_state_dict(checkpoint['ema'])
+      model.load_state_dict(checkpoint['ema'])
     else:
-      self.model.load_state_dict(checkpoint['model_state_dict'])
-    self.model.eval()
+      model.load_state_dict(checkpoint['model_state_dict'])
+    model.eval()
     return global_step, epoch
 
 
@@ -125,23 +156,130 @@ class Evaluator:
     # those variables are updated in eval_loop
     self.best_global_step = None
     self.best_accuracy = None
+    # checkpoints already in the accuracy table are not evaluated again
+    self.accuracy_table = self.read_accuracy_table()
+    for global_step, (_, accuracy, _) in self.accuracy_table.items():
+      if self.best_accuracy is None or self.best_accuracy < accuracy:
+        self.best_global_step = global_step
+        self.best_accuracy = accuracy
+
+    # the data loader and the models are built once and kept for all the
+    # checkpoints
+    data_loader, _ = self.reader.load_dataset()
+
+    # if the evaluation is made during training, we don't know how many
+    # checkpoints we need to process
+    if getattr(self.params, 'eval_during_training', False):
+      self._run_eval_during_training(data_loader)
+    else:
+      self.eval_checkpoints(self.get_new_checkpoints(), data_loader)
+      self.write_accuracy_table()
+      self.write_best_accuracy(mode='a')
+
+
+  def _run_eval_during_training(self, data_loader):
+    """Watch the train directory and evaluate new checkpoints as they land.
+    Stop after eval_timeout_secs without new checkpoint if it is set."""
+    timeout = getattr(self.params, 'eval_timeout_secs', None)
+    last_ckpt_time = time.time()
+    while True:
+      ckpts = self.get_new_checkpoints()
+      if ckpts:
+        n_evaluated = self.eval_checkpoints(ckpts, data_loader)
+        if n_evaluated:
+          last_ckpt_time = time.time()
+          self.write_accuracy_table()
+          self.write_best_accuracy(mode='w')
+          continue
+      if timeout is not None and time.time() - last_ckpt_time > timeout:
+        logging.info(
+          "No new checkpoint since {} seconds.".format(timeout))
+        break
+      time.sleep(self.params.eval_interval_secs)
+
+
+  def get_new_checkpoints(self):
+    """Return the checkpoints not yet evaluated, the newest first."""
     ckpts = global_utils.get_list_checkpoints(
       self.train_dir, backend='pytorch')
+    new_ckpts = []
     for ckpt in ckpts[::-1]:
+      global_step = global_utils.get_global_step_from_ckpt(ckpt)
       # remove first checkpoint model.ckpt-0
-      if 'model.ckpt-0' in ckpt: continue
-      logging.info(
-        "Loading checkpoint for eval: {}".format(ckpt))
-      global_step, epoch = self.load_ckpt(ckpt)
-      self.eval_loop(global_step, epoch)
-
+      if global_step == 0 or global_step in self.accuracy_table:
+        continue
+      new_ckpts.append(ckpt)
+    return new_ckpts
+
+
+  def eval_checkpoints(self, ckpts, data_loader):
+    """Evaluate a list of checkpoints, len(self.models) at a time.
+    Returns the number of checkpoints evaluated."""
+    n_models = len(self.models)
+    n_evaluated = 0
+    for i in range(0, len(ckpts), n_models):
+      models = []
+      for model, ckpt in zip(self.models, ckpts[i:i+n_models]):
+        logging.info(
+          "Loading checkpoint for eval: {}".format(ckpt))
+        try:
+          global_step, epoch = self.load_ckpt(ckpt, model)
+        except (RuntimeError, EOFError):
+          # the checkpoint is still being written, it will be evaluated
+          # at the next call
+          logging.info("Checkpoint {} not complete, skipping.".format(ckpt))
+          continue
+        models.append((model, global_step, epoch))
+      if models:
+        self.eval_loop(models, data_loader)
+        n_evaluated += len(models)
+    return n_evaluated
+
+
+  def read_accuracy_table(self):
+    """Read the accuracy of the checkpoints evaluated by previous runs."""
+    accuracy_table = {}
+    path = join(self.logs_dir, "accuracy_table.txt")
+    if not exists(path):
+      return accuracy_table
+    with open(path) as f:
+      # skip header
+      next(f, None)
+      for line in f:
+        global_step, epoch, accuracy, loss = line.strip().split('\t')
+        accuracy_table[int(global_step)] = (
+          float(epoch), float(accuracy), float(loss))
+    return accuracy_table
+
+
+  def write_accuracy_table(self):
+    """Write the accuracy of all evaluated checkpoints in a single file."""
+    path = join(self.logs_dir, "accuracy_table.txt")
+    with open(path, 'w') as f:
+      f.write("step\tepoch\taccuracy\tloss\n")
+      for global_step in sorted(self.accuracy_table):
+        epoch, accuracy, loss = self.accuracy_table[global_step]
+        f.write("{}\t{}\t{:.5f}\t{:.5f}\n".format(
+          global_step, epoch, accuracy, loss))
+
+
+  def write_best_accuracy(self, mode='a'):
     if self.best_global_step is not None and self.best_accuracy is not None:
       path = join(self.logs_dir, "best_accuracy.txt")
-      with open(path, 'a') as f:
+      with open(path, mode) as f:
         f.write("{}\t{:.4f}\n".format(
           self.best_global_step, self.best_accuracy))
 
 
+  def _get_attack_params(self, config):
+    """Return a copy of the params with the method and the parameters of
+    one attack of the attack_multi config."""
+    params = copy.copy(self.params)
+    params.attack_method = config['attack_method']
+    params.attack_params = config['attack_params']
+    return params
+
+
   def _run_under_attack(self):
     # normal evaluation has already been done
     # we get the best checkpoint of the model
@@ -155,110 +293,173 @@ class Evaluator:
     # save results
     path = join(self.logs_dir, "attacks_score.txt")
     with open(path, 'a') as f:
-      f.write("{}\n".format(self.attack.__class__.__name__))
-      if self.params.eot:
-        f.write("eot sample {}, {}\n".format(self.eot_samples,
-                                       json.dumps(self.params.attack_params)))
-      else:
-        f.write("{}\n".format(json.dumps(self.params.attack_params)))
-      f.write("{:.5f}\n\n".format(self.best_accuracy))
-
-
-  def eval_loop(self, global_step, epoch):
-    """Run the evaluation loop once."""
-
-    running_accuracy = 0
+      for config, (name, attack) in zip(
+          self.attacks_config, self.attacks.items()):
+        f.write("{}\n".format(attack.__class__.__name__))
+        if self.params.eot:
+          f.write("eot sample {}, {}\n".format(
+            self.params.eot_samples, json.dumps(config['attack_params'])))
+        else:
+          f.write("{}\n".format(json.dumps(config['attack_params'])))
+        f.write("{:.5f}\n\n".format(self.attacks_accuracy[name]))
+      if len(self.attacks) > 1:
+        f.write("worst case {}\n".format(', '.join(self.attacks)))
+        f.write("{:.5f}\n\n".format(self.best_accuracy))
+
+
+  def eval_loop(self, models, data_loader):
+    """Run the evaluation loop once.
+
+    Args:
+      models: list of (model, global_step, epoch), each batch of the
+        dataset is decoded once and evaluated by all the models.
+      data_loader: the loader of the evaluation dataset.
+    """
+    n_models = len(models)
+    steps = [global_step for _, global_step, _ in models]
+    epochs = [epoch for _, _, epoch in models]
+    running_accuracy = np.zeros(n_models)
     running_inputs = 0
-    running_loss = 0
-    data_loader, _ = self.reader.load_dataset()
+    running_loss = np.zeros(n_models)
     for batch_n, data in enumerate(data_loader):
 
       with torch.no_grad():
         batch_start_time = time.time()
         inputs, labels = data
         inputs, labels = inputs.cuda(), labels.cuda()
+        if self.reader.batch_transform is not None:
+          inputs = self.reader.batch_transform(inputs)
         if self.add_noise:
           inputs = self.noise(inputs)
-        outputs = self.model(inputs)
-        loss = self.criterion(outputs, labels)
-        _, predicted = torch.max(outputs.data, 1)
+        for i, (model, _, _) in enumerate(models):
+          outputs = model(inputs)
+          loss = self.criterion(outputs, labels)
+          _, predicted = torch.max(outputs.data, 1)
+          running_accuracy[i] += predicted.eq(labels.data).cpu().sum().numpy()
+          running_loss[i] += loss.cpu().numpy()
         seconds_per_batch = time.time() - batch_start_time
         examples_per_second = inputs.size(0) / seconds_per_batch
 
-      running_accuracy += predicted.eq(labels.data).cpu().sum().numpy()
       running_inputs += inputs.size(0)
-      running_loss += loss.cpu().numpy()
       accuracy = running_accuracy / running_inputs
       loss = running_loss / (batch_n + 1)
 
-      self.message.add('epoch', epoch)
-      self.message.add('step', global_step)
-      self.message.add('accuracy', accuracy, format='.5f')
-      self.message.add('loss', loss, format='.5f')
+      self.message.add('epoch', epochs)
+      self.message.add('step', steps)
+      self.message.add('accuracy', list(accuracy), format='.5f')
+      self.message.add('loss', list(loss), format='.5f')
       self.message.add('imgs/sec', examples_per_second, format='.0f')
       logging.info(self.message.get_message())
 
-    if self.best_accuracy is None or self.best_accuracy < accuracy:
-      self.best_global_step = global_step
-      self.best_accuracy = accuracy
-    self.message.add('--> epoch', epoch)
-    self.message.add('step', global_step)
-    self.message.add('accuracy', accuracy, format='.5f')
-    self.message.add('loss', loss, format='.5f')
-    logging.info(self.message.get_message())
+    for i in range(n_models):
+      if self.best_accuracy is None or self.best_accuracy < accuracy[i]:
+        self.best_global_step = steps[i]
+        self.best_accuracy = accuracy[i]
+      self.accuracy_table[steps[i]] = (epochs[i], accuracy[i], loss[i])
+      self.message.add('--> epoch', epochs[i])
+      self.message.add('step', steps[i])
+      self.message.add('accuracy', accuracy[i], format='.5f')
+      self.message.add('loss', loss[i], format='.5f')
+      logging.info(self.message.get_message())
     logging.info("Done with batched inference.")
     return
 
-  def eval_attack(self, global_step, epoch):
-    """Run evaluation under attack."""
-
-    running_accuracy = 0
-    running_inputs = 0
-    running_loss = 0
-    data_loader, _ = self.reader.load_dataset()
-    for batch_n, data in enumerate(data_loader):
-
-      batch_start_time = time.time()
-      inputs, labels = data
+  def _attack_batches(self, data_loader):
+    """Yield the (inputs, labels) batches to attack on the gpu."""
+    for inputs, labels in data_loader:
       inputs, labels = inputs.cuda(), labels.cuda()
+      if self.reader.batch_transform is not None:
+        inputs = self.reader.batch_transform(inputs)
       if self.add_noise:
         inputs = self.noise(inputs)
-      outputs = self.model(inputs)
-
-      inputs_adv = self.attack.perturb(inputs, labels)
-      outputs_adv = self.model(inputs_adv)
+      yield inputs, labels
 
-      loss = self.criterion(outputs_adv, labels)
-      _, predicted = torch.max(outputs_adv.data, 1)
+  def eval_attack(self, global_step, epoch):
+    """Run evaluation under attack.
+
+    The clean predictions of a batch are computed once and all the attacks
+    are run on it. With several attacks, the correctness of each sample,
+    clean and under each attack, is saved as a single matrix in
+    attacks_matrix.npz.
+    """
+    names = list(self.attacks)
+    running_correct = np.zeros(len(names) + 1)
+    running_inputs = 0
+    running_loss = np.zeros(len(names))
+    # (samples, clean + attacks) correct predictions
+    correct = []
+    data_loader, _ = self.reader.load_dataset()
+    batches = self._attack_batches(data_loader)
+    if self.refill_attack is not None:
+      # the attacked samples come back in a different order
+      batches = self.refill_attack.perturb_stream(batches)
+    batch_start_time = time.time()
+    for batch_n, batch in enumerate(batches):
+
+      inputs, labels = batch[:2]
+      with torch.no_grad():
+        outputs = self.model(inputs)
+      _, predicted = torch.max(outputs.data, 1)
+      batch_correct = [predicted.eq(labels.data)]
+
+      for i, name in enumerate(names):
+        if self.refill_attack is not None:
+          inputs_adv = batch[2]
+        else:
+          inputs_adv = self.attacks[name].perturb(inputs, labels)
+        with torch.no_grad():
+          outputs_adv = self.model(inputs_adv)
+          loss = self.criterion(outputs_adv, labels)
+        _, predicted_adv = torch.max(outputs_adv.data, 1)
+        batch_correct.append(predicted_adv.eq(labels.data))
+        running_loss[i] += loss.cpu().numpy()
+
+        if self.params.dump_files:
+          results = {
+            'images': inputs.cpu().numpy(),
+            'images_adv': inputs_adv.cpu().numpy(),
+            'predictions': outputs.cpu().numpy(),
+            'predictions_adv': outputs_adv.cpu().numpy()
+          }
+          self.dumps[name].files(results)
+
+      batch_correct = torch.stack(batch_correct, dim=1).cpu().numpy()
+      correct.append(batch_correct)
       seconds_per_batch = time.time() - batch_start_time
       examples_per_second = inputs.size(0) / seconds_per_batch
+      batch_start_time = time.time()
 
-      running_accuracy += predicted.eq(labels.data).cpu().sum().numpy()
+      running_correct += batch_correct.sum(axis=0)
       running_inputs += inputs.size(0)
-      running_loss += loss.cpu().detach().numpy()
-      accuracy = running_accuracy / running_inputs
+      accuracy = running_correct / running_inputs
       loss = running_loss / (batch_n + 1)
 
-      if self.params.dump_files:
-        results = {
-          'images': inputs.cpu().numpy(),
-          'images_adv': inputs_adv.cpu().numpy(),
-          'predictions': outputs.detach().cpu().numpy(),
-          'predictions_adv': outputs_adv.detach().cpu().numpy()
-        }
-        self.dump.files(results)
-
       self.message.add('', socket.gethostname())
-      self.message.add('accuracy', accuracy, format='.5f')
-      self.message.add('loss', loss, format='.5f')
+      self.message.add('clean', accuracy[0], format='.5f')
+      for i, name in enumerate(names):
+        self.message.add(name, accuracy[i + 1], format='.5f')
+      self.message.add('loss', list(loss), format='.5f')
       self.message.add('imgs/sec', examples_per_second, format='.0f')
       logging.info(self.message.get_message())
 
+    correct = np.concatenate(correct)
+    # a sample is robust if no attack succeeded
+    worst_case = correct[:, 1:].all(axis=1).mean()
+    self.attacks_accuracy = OrderedDict(zip(names, accuracy[1:]))
     self.best_global_step = global_step
-    self.best_accuracy = accuracy
+    self.best_accuracy = accuracy[1] if len(names) == 1 else worst_case
+    if len(names) > 1:
+      path = join(self.logs_dir, "attacks_matrix.npz")
+      np.savez(path, columns=np.array(['clean'] + names), correct=correct,
+               global_step=global_step)
+      logging.info("Attacks matrix saved in {}.".format(path))
     self.message.add('', socket.gethostname())
-    self.message.add('accuracy', accuracy, format='.5f')
-    self.message.add('loss', loss, format='.5f')
+    self.message.add('clean', accuracy[0], format='.5f')
+    for name, value in self.attacks_accuracy.items():
+      self.message.add(name, value, format='.5f')
+    if len(names) > 1:
+      self.message.add('worst case', worst_case, format='.5f')
+    self.message.add('loss', list(loss), format='.5f')
     logging.info(self.message.get_message())
     logging.info("Done with batched inference under attack.")
     return
@@ -1,5 +1,7 @@
 
+import math
 import logging
+from collections import OrderedDict
 import numpy as np
 
 import torch
@@ -7,6 +9,26 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from lipschitz_bound.lipschitz_bound import LipschitzBound
+from .models.structure import toeplitz as toep
+
+
+def rfft_pairs(x, signal_ndim):
+  """torch.rfft of torch < 1.8, the real and imaginary parts are stored in
+  the last dimension as in the structured layers. The torch.fft module is
+  used on the later versions."""
+  if hasattr(torch, 'rfft'):
+    return torch.rfft(x, signal_ndim)
+  dim = tuple(range(-signal_ndim, 0))
+  return torch.view_as_real(torch.fft.rfftn(x, dim=dim))
+
+
+def fft_pairs(x, signal_ndim):
+  """torch.fft of torch < 1.8 on complex values stored as real pairs."""
+  if callable(torch.fft):
+    return torch.fft(x, signal_ndim)
+  dim = tuple(range(-signal_ndim, 0))
+  return torch.view_as_real(
+    torch.fft.fftn(torch.view_as_complex(x.contiguous()), dim=dim))
 
 
 class LipschitzRegularization:
@@ -33,184 +55,575 @@ class LipschitzRegularization:
             "Lipschitz regularization activated with Power Iteration {}".format(
               self.params.lipschitz_n_iter))
         self.lip_constants = LipschitzPowerIteration(model, params, reader)
+      elif self.lipschitz_computation == "fft":
+        if local_rank == 0:
+          logging.info("Lipschitz regularization activated with FFT.")
+        self.lip_constants = LipschitzFFT(model, params, reader)
       else:
         raise ValueError("Method for computing Lipschitz not recognized.")
 
+      # the bounds of the conv layers are recomputed every
+      # lipschitz_update_steps steps, first order estimates or cached
+      # values are used in between
+      self.update_steps = getattr(params, 'lipschitz_update_steps', 1)
+      self.n_steps = 0
+    # last bound of each layer
+    self.bounds = OrderedDict()
+
   def get_lip_reg(self, epoch, model):
     if self.lipschitz_regularization and self.decay > 0:
-      lip_cst = self.lip_constants.compute(model)
-      lip_loss = [torch.log(x) for x in lip_cst]
-      return self.decay * sum(lip_loss)
+      exact = self.n_steps % self.update_steps == 0
+      self.n_steps += 1
+      self.bounds = self.lip_constants.compute(model, exact=exact)
+      if not self.bounds:
+        return 0.
+      lip_cst = torch.stack(list(self.bounds.values()))
+      return self.decay * lip_cst.log().sum()
     return 0.
 
+  def invalidate_plan(self):
+    """Rebuild the plan of the layers after a change of the modules of the
+    model in place."""
+    if self.lipschitz_regularization:
+      self.lip_constants.invalidate_plan()
 
-
-class LipschitzGlobal:
-
-  def __init__(self, model, params):
-
-    self.conv_id = set()
-    self.batch_bn_id = set()
-    self.diagonal_circulant_id = set()
-
-    for i, module in enumerate(model.modules()):
-      name = module.__class__.__name__.lower()
-      # logging.info(name)
-      # add_it = False
-      if 'conv2d' in name:
-        # add_it = True
-        self.conv_id.add(i)
-      elif 'batchnorm' in name:
-        # add_it = True
-        self.batch_bn_id.add(i)
-      elif 'diagonalcirculant' in name:
-        # add_it = True
-        self.diagonal_circulant_id.add(i)
-      # weight = getattr(module, 'weight', False)
-      # shape = 0 if weight is False else weight.shape
-      # if add_it:
-      #   logging.info('{} {} adding it !'.format(name, shape))
-      # else:
-      #   logging.info('{}'.format(name, shape))
-
-  def _compute_batch_norm(self, module):
-    """Compute the Lipschitz of Batch Norm layer."""
-    weight = module.weight
-    running_var = module.running_var
-    eps = module.eps
-    lip = torch.max(torch.abs(weight / torch.sqrt(running_var + eps)))
-    return lip
-
-  def _compute_diagonal_circulant(self, module):
-    """Compute the Lipschitz of Diagonal Circulant layer"""
-    lip_circ = torch.max(torch.abs(torch.rfft(module.kernel, 1)))
-    lip_diag = torch.max(torch.abs(module.diag))
-    return lip_circ, lip_diag
-
-  def compute(self, model):
-    """Compute Lipschitz of full Network."""
-    lip_loss = []
-    for i, module in enumerate(model.modules()):
-      name = module.__class__.__name__
-      if i in self.conv_id:
-        lip_conv = self._compute_conv(i, module)
-        lip_loss.append(lip_conv)
-      elif i in self.batch_bn_id:
-        lip_bn = self._compute_batch_norm(module)
-        lip_loss.append(lip_bn)
-      elif i in self.diagonal_circulant_id:
-        lip_circ, lip_diag = self._compute_diagonal_circulant(module)
-        lip_loss.extend([lip_circ, lip_diag])
-    return lip_loss
+  def get_metrics(self):
+    """Return the last bound of each layer and the log of their product."""
+    if not self.bounds:
+      return OrderedDict()
+    values = torch.stack(list(self.bounds.values())).detach()
+    metrics = OrderedDict(zip(self.bounds.keys(), values.cpu().tolist()))
+    metrics['log_product'] = float(values.log().sum())
+    return metrics
 
 
 
-class LipschitzPowerIteration(LipschitzGlobal):
-
-  def __init__(self, model, params, reader):
-    super(LipschitzPowerIteration, self).__init__(
-      model, params)
+class LipschitzPlan:
+  """Layers of a model whose Lipschitz is computed, classified once from the
+  module references. The plan is rebuilt when the model is replaced (rebuilt
+  or wrapped again), or after `invalidate_plan` if its modules are changed
+  in place."""
 
+  def __init__(self, model):
     self.model = model
-    self.n_iter = params.lipschitz_n_iter
+    self.conv = []
+    self.batch_norm = []
+    self.diagonal_circulant = []
+    # ToeplitzLike, LDRSubdiagonal and LDRTridiagonal layers
+    self.structured = []
+    for name, module in model.named_modules():
+      name = name or 'model'
+      kind = module.__class__.__name__.lower()
+      if 'conv2d' in kind:
+        self.conv.append((name, module))
+      elif 'batchnorm' in kind:
+        self.batch_norm.append((name, module))
+      elif 'diagonalcirculant' in kind:
+        self.diagonal_circulant.append((name, module))
+      elif kind in ('toeplitzlike', 'ldrsubdiagonal', 'ldrtridiagonal'):
+        self.structured.append((name, module))
+    self._build_batch_norm_index()
+
+  def _build_batch_norm_index(self):
+    """Position of the channels of the BatchNorm layers in a
+    (layers, max channels) matrix and eps of each channel."""
+    self.bn_index, self.bn_eps, self.bn_width = None, None, 0
+    if not self.batch_norm:
+      return
+    sizes = [module.num_features for _, module in self.batch_norm]
+    device = self.batch_norm[0][1].running_var.device
+    self.bn_width = max(sizes)
+    self.bn_index = torch.cat([
+      torch.arange(size) + i * self.bn_width
+      for i, size in enumerate(sizes)]).to(device)
+    self.bn_eps = torch.cat([
+      torch.full((size,), module.eps)
+      for size, (_, module) in zip(sizes, self.batch_norm)]).to(device)
+
+  def matches(self, model):
+    """Return True if the plan was built for this model, the modules are
+    not walked at each step."""
+    return model is self.model
+
 
-    self.u = {}
+class LipschitzGlobal:
 
-    input_size = reader.batch_shape[1:]
+  def __init__(self, model, params, reader=None):
+
+    self.reader = reader
+    # the structured layers use a warm started power iteration built on
+    # their fast multiplication, the Toeplitz-like layers can use an FFT
+    # bound instead
+    self.structured_computation = getattr(
+      params, 'lipschitz_structured_computation', 'power_method')
+    # number of iterations of the first call, then the power iteration
+    # is warm started from the previous singular vectors
+    self.n_iter = getattr(params, 'lipschitz_n_iter', 10)
+    self.n_iter_warm = getattr(params, 'lipschitz_n_iter_warm', 1)
+    self.structured_power = {}
+    # bounds of the conv layers at the last exact computation with their
+    # gradient, the first order estimate is used in between
+    self.conv_cache = None
+    self.plan = None
+    self.get_plan(model)
+
+  @staticmethod
+  def unwrap(model):
+    """Return the model wrapped by DistributedDataParallel or
+    DataParallel, the plan is the same for the bare and wrapped model."""
+    while isinstance(model, (nn.parallel.DistributedDataParallel,
+                             nn.DataParallel)):
+      model = model.module
+    return model
+
+  def get_plan(self, model):
+    """Return the plan of the model, rebuilt if its modules changed."""
+    model = self.unwrap(model)
+    if self.plan is None or not self.plan.matches(model):
+      if self.plan is not None:
+        logging.info('Model structure changed, rebuilding the Lipschitz plan.')
+      self.plan = self._build_plan(model)
+    return self.plan
+
+  def invalidate_plan(self):
+    """Rebuild the plan at the next computation, to call after a change of
+    the modules of the model in place."""
+    self.plan = None
+
+  def _build_plan(self, model):
+    """Classify the layers of the model, the subclasses prepare the
+    computation of the conv layers."""
+    plan = LipschitzPlan(model)
+    # keep the singular vectors of the layers already in the previous plan
+    self.structured_power = {
+      module: self.structured_power.get(module) or
+              PowerIterationStructured(module)
+      for _, module in plan.structured}
+    self.conv_cache = None
+    return plan
+
+  def record_input_sizes(self, model):
+    """Record the input size of each module in self.model_input_size."""
+    input_size = self.reader.batch_shape[1:]
     input_size = (1,) + input_size
 
     # record the input size for each module
     self.model_input_size = {}
-    def wrapper_function(module_id):
-      def store_input_sizes(module, input, output):
-        self.model_input_size[module_id] = list(input[0].shape)
+    def wrapper_function(module):
+      def store_input_sizes(_, input, output):
+        self.model_input_size[module] = list(input[0].shape)
       return store_input_sizes
-    self.execute_through_model(wrapper_function, input_size)
+    self.execute_through_model(model, wrapper_function, input_size)
 
-  def execute_through_model(self, function, input_size):
+  def execute_through_model(self, model, function, input_size):
     """ Execute `function` through the model"""
     handles = []
-    for module_id, module in enumerate(self.model.modules()):
-      handle = module.register_forward_hook(function(module_id))
+    for module in model.modules():
+      handle = module.register_forward_hook(function(module))
       handles.append(handle)
 
+    # the plan can be rebuilt during training, the running statistics of
+    # the BatchNorm layers must not see the dummy input
+    training = model.training
+    model.eval()
     x = torch.zeros(*input_size)
-    x = x.cuda()
-    self.model(x)
+    x = x.to(next(model.parameters()).device)
+    with torch.no_grad():
+      model(x)
+    model.train(training)
 
     # Remove hooks
     for handle in handles:
       handle.remove()
 
-  def _compute_conv(self, i, module):
-    """Compute a bound on the Lipchitz of Convolution layer."""
+  def _compute_batch_norms(self, plan):
+    """Compute the Lipschitz of all the Batch Norm layers at once, the max
+    of |weight / sqrt(running_var + eps)| of each layer."""
+    modules = [module for _, module in plan.batch_norm]
+    weight = torch.cat([
+      module.weight if module.weight is not None
+      else torch.ones_like(module.running_var) for module in modules])
+    running_var = torch.cat([module.running_var for module in modules])
+    lip = torch.abs(weight / torch.sqrt(running_var + plan.bn_eps))
+    # the values are positive, the zero padding does not change the max
+    lip = lip.new_zeros(len(modules) * plan.bn_width).index_copy(
+      0, plan.bn_index, lip)
+    lip = lip.view(len(modules), plan.bn_width).max(dim=1)[0]
+    return OrderedDict(
+      zip([name for name, _ in plan.batch_norm], lip.unbind(0)))
+
+  def _compute_diagonal_circulant(self, module):
+    """Compute the Lipschitz of Diagonal Circulant layer"""
+    lip_circ = torch.max(torch.abs(rfft_pairs(module.kernel, 1)))
+    lip_diag = torch.max(torch.abs(module.diag))
+    return lip_circ, lip_diag
+
+  def _compute_toeplitz_fft(self, module):
+    """Upper bound on the Lipschitz of a Toeplitz-like layer.
+
+    The layer multiplies by sum_i K(Z_f, G_i) K(Z_f, H_i)^T, the bound is
+    sum_i ||K(Z_f, G_i)|| ||K(Z_f, H_i)||. Without corner, the Krylov
+    matrices are lower triangular Toeplitz, a submatrix of the circulant
+    matrix of size 2n. With corner, they are circulant (f=1) and skew
+    circulant (f=-1), diagonalized by the DFT after a scaling by the roots
+    of -1.
+    """
+    G, H = module.G, module.H
+    n = G.shape[-1]
+    # complex tensors are stored as real pairs, as in the layer
+    if module.corner:
+      G_f = fft_pairs(torch.stack((G, torch.zeros_like(G)), dim=-1), 1)
+      angles = torch.arange(n, device=H.device, dtype=H.dtype) / n * math.pi
+      roots = torch.stack((torch.cos(angles), torch.sin(angles)), dim=-1)
+      H_f = fft_pairs(H[..., None] * roots, 1)
+    else:
+      G_f = rfft_pairs(torch.cat((G, torch.zeros_like(G)), dim=-1), 1)
+      H_f = rfft_pairs(torch.cat((H, torch.zeros_like(H)), dim=-1), 1)
+    norm_G = G_f.norm(dim=-1).max(dim=-1)[0]
+    norm_H = H_f.norm(dim=-1).max(dim=-1)[0]
+    return (norm_G * norm_H).sum()
+
+  def _compute_structured(self, module, exact=True):
+    """Compute the Lipschitz of a structured layer. If exact is False, the
+    power iteration is not run, the Rayleigh quotient of the cached
+    singular vectors is returned."""
+    name = module.__class__.__name__.lower()
+    if self.structured_computation == 'fft' and name == 'toeplitzlike':
+      return self._compute_toeplitz_fft(module)
+    power = self.structured_power[module]
+    if power.u is None:
+      n_iter = self.n_iter
+    else:
+      n_iter = self.n_iter_warm if exact else 0
+    return power.compute(n_iter)
+
+  def _cache_convs(self, plan, lip_loss):
+    """Keep the bounds of the conv layers, the kernels and the gradients of
+    the bounds with respect to the kernels."""
+    layers = [(name, module) for name, module in plan.conv
+              if name in lip_loss]
+    values = [lip_loss[name] for name, _ in layers]
+    weights = [module.weight for _, module in layers]
+    grads = [None] * len(layers)
+    trainable = [i for i, (value, weight) in enumerate(zip(values, weights))
+                 if value.requires_grad and weight.requires_grad]
+    if trainable and torch.is_grad_enabled():
+      trainable_grads = torch.autograd.grad(
+        [values[i] for i in trainable], [weights[i] for i in trainable],
+        retain_graph=True, allow_unused=True)
+      for i, grad in zip(trainable, trainable_grads):
+        grads[i] = grad
+    self.conv_cache = OrderedDict()
+    for (name, module), value, weight, grad in zip(
+        layers, values, weights, grads):
+      if grad is None:
+        grad = torch.zeros_like(weight)
+      self.conv_cache[name] = (
+        module, value.detach(), weight.detach().clone(), grad.detach())
+
+  def _estimate_convs(self):
+    """First order estimate of the bounds of the conv layers from the last
+    exact computation, cheap and differentiable like the Rayleigh quotient
+    of the power method."""
+    lip_loss = OrderedDict()
+    for name, (module, value, weight, grad) in self.conv_cache.items():
+      estimate = value + torch.sum(grad * (module.weight - weight))
+      lip_loss[name] = torch.clamp(estimate, min=1e-6)
+    return lip_loss
+
+  def _compute_convs(self, plan, exact=True):
+    """Compute the Lipschitz of the Convolution layers. If exact is False,
+    the first order estimate from the last exact computation is
+    returned."""
+    if not exact and self.conv_cache is not None:
+      return self._estimate_convs()
+    lip_loss = OrderedDict(
+      (name, self._compute_conv(module)) for name, module in plan.conv)
+    self._cache_convs(plan, lip_loss)
+    return lip_loss
+
+  def compute(self, model, exact=True):
+    """Compute Lipschitz of full Network, return the bound of each layer.
+    If exact is False, the bounds of the conv layers may be estimated."""
+    plan = self.get_plan(model)
+    lip_loss = self._compute_convs(plan, exact=exact)
+    if plan.batch_norm:
+      lip_loss.update(self._compute_batch_norms(plan))
+    for name, module in plan.diagonal_circulant:
+      lip_circ, lip_diag = self._compute_diagonal_circulant(module)
+      lip_loss[name + '/circulant'] = lip_circ
+      lip_loss[name + '/diagonal'] = lip_diag
+    for name, module in plan.structured:
+      lip_loss[name] = self._compute_structured(module, exact=exact)
+    return lip_loss
 
-    kernel = module.weight.clone()
-    padding = module.padding[0]
-    shape = list(self.model_input_size[i])
-    
-    pad = (padding, padding, padding, padding)
-    pad_ = (-padding, -padding, -padding, -padding)
-
-    def normalize(arr):
-      norm = torch.sqrt((arr ** 2).sum())
-      return arr / (norm + 1e-12)
-      
-    def power_iteration_conv(u, w_mat, n_iter):
-      u_ = u
-      for i in range(n_iter):
-        v_ = normalize(F.conv2d(F.pad(u_, pad), kernel))
-        u_ = normalize(F.pad(F.conv_transpose2d(v_, kernel), pad_))
-      return u_, v_
-   
-    kshape = str(shape)
-    if kshape not in self.u.keys():
-      self.u[kshape] = torch.normal(0, 0.05, size=shape, device='cuda')
-    u_hat, v_hat = power_iteration_conv(self.u[kshape].clone(), kernel, self.n_iter)
-    
-    z = F.conv2d(F.pad(u_hat, pad), kernel)
-    sigma = torch.max(torch.mul(z, v_hat).sum())
-    return sigma
+
+
+class PowerIterationStructured:
+  """Power iteration on a structured layer (ToeplitzLike, LDRSubdiagonal,
+  LDRTridiagonal) with its fast multiplication, the matrix is never built.
+
+  The transpose of a Toeplitz-like layer without corner is the Toeplitz-like
+  multiplication with G and H swapped, the other layers use the vector
+  Jacobian product of their multiplication. The singular vector is kept
+  between the calls.
+  """
+
+  def __init__(self, module):
+    self.module = module
+    self.u = None
+
+  def _normalize(self, x):
+    return x / (x.norm() + 1e-12)
+
+  def _mult(self, x):
+    out = self.module(x)
+    if self.module.b is not None:
+      out = out - self.module.b
+    return out
+
+  def _mult_transpose(self, v):
+    module = self.module
+    if module.__class__.__name__ == 'ToeplitzLike' and not module.corner:
+      # (sum_i K(G_i) K(H_i)^T)^T = sum_i K(H_i) K(G_i)^T
+      return toep.toeplitz_mult(module.H, module.G, v, False)
+    with torch.enable_grad():
+      x = torch.zeros_like(v).requires_grad_()
+      out = self._mult(x)
+      return torch.autograd.grad(out, x, grad_outputs=v)[0]
+
+  def compute(self, n_iter):
+    """Return the spectral norm of the layer."""
+    weight = self.module.G
+    with torch.no_grad():
+      if self.u is None:
+        self.u = self._normalize(torch.randn(
+          1, self.module.layer_size, device=weight.device, dtype=weight.dtype))
+      u = self.u
+      for _ in range(n_iter):
+        v = self._normalize(self._mult(u))
+        u = self._normalize(self._mult_transpose(v))
+      self.u = u
+      v = self._normalize(self._mult(u))
+    return torch.mul(self._mult(u), v).sum()
+
+
+class PowerIterationConvGroup:
+  """Power iteration on conv layers with the same input shape, kernel shape
+  and conv parameters, computed with a single grouped convolution.
+
+  The singular vectors of each layer are kept between the calls (warm start)
+  so a single iteration per training step is enough. The iterations run
+  without gradient, only the final Rayleigh quotient is differentiated.
+  """
+
+  def __init__(self, modules, names, input_shape):
+    module = modules[0]
+    self.modules = modules
+    self.names = names
+    self.n_layers = len(modules)
+    self.input_shape = tuple(input_shape)
+    self.stride = module.stride
+    self.padding = module.padding
+    self.dilation = module.dilation
+    self.groups = module.groups * self.n_layers
+    self.u = None
+    self.output_padding = None
+
+  def _conv(self, u, kernel):
+    return F.conv2d(u, kernel, stride=self.stride, padding=self.padding,
+                    dilation=self.dilation, groups=self.groups)
+
+  def _conv_transpose(self, v, kernel):
+    """Adjoint of _conv."""
+    if self.output_padding is None:
+      # recover the input size lost by the strides
+      self.output_padding = tuple(
+        size_in - ((size_out - 1) * s - 2 * p + d * (k - 1) + 1)
+        for size_in, size_out, s, p, d, k in zip(
+          self.input_shape[1:], v.shape[2:], self.stride, self.padding,
+          self.dilation, kernel.shape[2:]))
+    return F.conv_transpose2d(
+      v, kernel, stride=self.stride, padding=self.padding,
+      output_padding=self.output_padding, groups=self.groups,
+      dilation=self.dilation)
+
+  def _normalize(self, x):
+    """Normalize the vector of each layer."""
+    shape = x.shape
+    x = x.reshape(self.n_layers, -1)
+    x = x / (x.norm(dim=1, keepdim=True) + 1e-12)
+    return x.reshape(shape)
+
+  def compute(self, n_iter):
+    """Return the spectral norm of each layer of the group."""
+    kernel = torch.cat([module.weight for module in self.modules], dim=0)
+    with torch.no_grad():
+      weight = kernel.detach()
+      if self.u is None:
+        channels, height, width = self.input_shape
+        self.u = self._normalize(torch.normal(
+          0, 0.05, size=(1, self.n_layers * channels, height, width),
+          device=kernel.device))
+      u = self.u
+      for _ in range(n_iter):
+        v = self._normalize(self._conv(u, weight))
+        u = self._normalize(self._conv_transpose(v, weight))
+      self.u = u
+      v = self._normalize(self._conv(u, weight))
+    z = self._conv(u, kernel)
+    return torch.mul(z, v).reshape(self.n_layers, -1).sum(dim=1)
+
+
+class LipschitzPowerIteration(LipschitzGlobal):
+
+  def _build_plan(self, model):
+    plan = super(LipschitzPowerIteration, self)._build_plan(model)
+    self.record_input_sizes(model)
+    self.conv_groups = self._build_conv_groups(plan)
+    return plan
+
+  def _build_conv_groups(self, plan):
+    """Group the conv layers which can be computed together."""
+    groups = OrderedDict()
+    for name, module in plan.conv:
+      if module not in self.model_input_size:
+        continue
+      input_shape = tuple(self.model_input_size[module][1:])
+      key = (input_shape, tuple(module.weight.shape), tuple(module.stride),
+             tuple(module.padding), tuple(module.dilation), module.groups)
+      groups.setdefault(key, []).append((name, module))
+    return [PowerIterationConvGroup(
+              [module for _, module in layers],
+              [name for name, _ in layers], key[0])
+            for key, layers in groups.items()]
+
+  def _compute_convs(self, plan, exact=True):
+    """Compute the spectral norm of the conv layers, one grouped
+    convolution per group of layers. If exact is False, the Rayleigh
+    quotient of the cached singular vectors is returned, it is a first
+    order estimate of the spectral norm."""
+    lip_loss = OrderedDict()
+    for group in self.conv_groups:
+      if group.u is None:
+        n_iter = self.n_iter
+      else:
+        n_iter = self.n_iter_warm if exact else 0
+      lip_loss.update(zip(group.names, group.compute(n_iter).unbind(0)))
+    return lip_loss
+
+
+
+class LipschitzFFT(LipschitzGlobal):
+  """Spectral norm of the conv layers from the 2-D FFT of their kernels.
+
+  A stride 1 convolution with circular padding is block diagonalized by the
+  2-D DFT, its spectral norm is the largest singular value of the
+  c_out x c_in matrices of the FFT of the kernel over all the frequencies.
+  A zero padded convolution is a restriction of the circular convolution on
+  the padded input (n + 2p), the FFT at this size gives an upper bound, as
+  for strides larger than 1. The layers with the same number of channels and
+  FFT size are computed with a single batched SVD.
+  """
+
+  def _build_plan(self, model):
+    plan = super(LipschitzFFT, self)._build_plan(model)
+    self.record_input_sizes(model)
+    self.conv_groups = self._build_conv_groups(plan)
+    return plan
+
+  def _fft_size(self, module):
+    if tuple(module.weight.shape[2:]) == (1, 1):
+      # the transform of a 1x1 kernel is the same at all the frequencies
+      return (1, 1)
+    height, width = self.model_input_size[module][2:]
+    if getattr(module, 'padding_mode', 'zeros') == 'circular':
+      return (height, width)
+    return (height + 2 * module.padding[0], width + 2 * module.padding[1])
+
+  def _build_conv_groups(self, plan):
+    """Group the conv layers by groups, channels and FFT size."""
+    groups = OrderedDict()
+    for name, module in plan.conv:
+      if module not in self.model_input_size:
+        continue
+      c_out, c_in = module.weight.shape[:2]
+      key = (module.groups, c_out, c_in, self._fft_size(module))
+      groups.setdefault(key, []).append((name, module))
+    return groups
+
+  def _dilated_kernel(self, module):
+    kernel = module.weight
+    dh, dw = module.dilation
+    if (dh, dw) == (1, 1):
+      return kernel
+    c_out, c_in, kh, kw = kernel.shape
+    dilated = kernel.new_zeros(
+      c_out, c_in, (kh - 1) * dh + 1, (kw - 1) * dw + 1)
+    dilated[:, :, ::dh, ::dw] = kernel
+    return dilated
+
+  def _padded_kernel(self, module, size):
+    """Dilated kernel zero padded to the size of the FFT."""
+    kernel = self._dilated_kernel(module)
+    kh, kw = kernel.shape[2:]
+    return F.pad(kernel, (0, size[1] - kw, 0, size[0] - kh))
+
+  def _compute_convs(self, plan, exact=True):
+    """Compute the spectral norm of the conv layers. If exact is False, the
+    first order estimate from the last computation is returned."""
+    if not exact and self.conv_cache is not None:
+      return self._estimate_convs()
+    lip_loss = OrderedDict()
+    for (groups, c_out, c_in, size), layers in self.conv_groups.items():
+      # the transform of a real kernel is conjugate symmetric, the singular
+      # values of half the frequencies are enough
+      transforms = torch.stack([
+        rfft_pairs(self._padded_kernel(module, size), 2)
+        for _, module in layers])
+      n_layers = len(layers)
+      # (layers, groups * frequencies, c_out / groups, c_in / groups, 2)
+      transforms = transforms.reshape(
+        n_layers, groups, c_out // groups, c_in, -1, 2)
+      transforms = transforms.permute(0, 1, 4, 2, 3, 5).reshape(
+        n_layers, -1, c_out // groups, c_in, 2)
+      # the singular values of A + iB are the ones of the real matrix
+      # [[A, -B], [B, A]], each of them twice
+      real, imag = transforms[..., 0], transforms[..., 1]
+      blocks = torch.cat([
+        torch.cat([real, -imag], dim=-1),
+        torch.cat([imag, real], dim=-1)], dim=-2)
+      _, sigma, _ = torch.svd(blocks)
+      sigma = sigma[..., 0].max(dim=1)[0]
+      lip_loss.update(zip([name for name, _ in layers], sigma.unbind(0)))
+    self._cache_convs(plan, lip_loss)
+    return lip_loss
 
 
 
 class LipschitzLipBound(LipschitzGlobal):
 
   def __init__(self, model, params, *args):
-    super(LipschitzLipBound, self).__init__(
-      model, params)
-
     self.lip_bound_cls = {}
     self.sample = params.lipschitz_bound_sample
-    
-    # # we pre-create LipschitzBound for each kernel
-    # for i, module in enumerate(model.modules()):
-    #   name = module.__class__.__name__
-    #   print(name)
-    #   if name == 'Conv2d':
-    #     padding = module.padding[0]
-    #     kernel = module.weight
-    #     self.lip_bound_cls[i] = \
-    #       LipschitzBound(kernel.shape, padding, sample=self.sample)
+    super(LipschitzLipBound, self).__init__(
+      model, params)
 
+  def _build_plan(self, model):
+    plan = super(LipschitzLipBound, self)._build_plan(model)
     # we pre-create LipschitzBound for each kernel
-    for i, module in enumerate(model.modules()):
-      name = module.__class__.__name__
-      if len(getattr(module, 'weight', [])):
-        if len(module.weight.shape) == 4:
-          padding = module.padding[0]
-          kernel = module.weight
-          # logging.info('{} {}'.format(
-          #   module.__class__.__name__, len(kernel.shape)))
-          self.lip_bound_cls[i] = \
-            LipschitzBound(kernel.shape, padding, sample=self.sample)
-
-  def _compute_conv(self, i, module):
+    lip_bound_cls = {}
+    for _, module in plan.conv:
+      if module in self.lip_bound_cls:
+        lip_bound_cls[module] = self.lip_bound_cls[module]
+      else:
+        lip_bound_cls[module] = LipschitzBound(
+          module.weight.shape, module.padding[0], sample=self.sample)
+    self.lip_bound_cls = lip_bound_cls
+    return plan
+
+  def _compute_conv(self, module):
     """Compute a bound on the Lipchitz of Convolution layer."""
-    padding = module.padding[0]
     kernel = module.weight
-    lip = self.lip_bound_cls[i].compute(kernel)
+    lip = self.lip_bound_cls[module].compute(kernel)
     return lip
-
-
-
@@ -40,11 +40,12 @@ _model_name_to_cifar_model = {
 
 def _get_model_map(dataset_name):
   """Get name to model map for specified dataset."""
-  if dataset_name in ('cifar10', 'cifar100'):
+  if dataset_name in ('cifar10', 'cifar100',
+                      'cifar10_memmap', 'cifar100_memmap'):
     return _model_name_to_cifar_model
   elif dataset_name == 'mnist':
     return _model_name_to_mnist_model
-  elif dataset_name in ('imagenet'):
+  elif dataset_name in ('imagenet', 'imagenet_memmap'):
     return _model_name_to_imagenet_model
   else:
     raise ValueError('Invalid dataset name: {}'.format(dataset_name))
@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import logging
+import contextlib
+from os.path import join
+from os.path import exists
+from collections import OrderedDict
+from collections import deque
+
+import numpy as np
+import torch
+
+
+class StepTimer:
+  """Measure the time spent in each phase of a training step.
+
+  Phases are timed with `phase(name)`, the device is synchronized before and
+  after each phase so the time of the asynchronous cuda kernels is accounted
+  to the right phase. The last `window` steps are kept to compute rolling
+  percentiles, which are exported as JSON lines and CSV in `logs_dir` every
+  `export_steps` steps. When disabled, `phase` is a no-op.
+  """
+
+  def __init__(self, enabled=False, window=100, sync=True, logs_dir=None,
+               export_steps=0):
+    self.enabled = enabled
+    self.window = window
+    self.sync = sync and torch.cuda.is_available()
+    self.logs_dir = logs_dir
+    self.export_steps = export_steps
+    self.current = OrderedDict()
+    self.history = OrderedDict()
+    self.percentiles = (50, 90, 99)
+
+  def _synchronize(self):
+    if self.sync:
+      torch.cuda.synchronize()
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    if not self.enabled:
+      yield
+      return
+    self._synchronize()
+    start = time.time()
+    with torch.autograd.profiler.record_function(name):
+      yield
+    self._synchronize()
+    self.current[name] = self.current.get(name, 0.) + time.time() - start
+
+  def add(self, name, seconds):
+    """Add a duration measured outside of `phase`."""
+    if self.enabled:
+      self.current[name] = self.current.get(name, 0.) + seconds
+
+  def end_step(self, step):
+    """Record the phases of the current step and export if needed."""
+    if not self.enabled:
+      return
+    self.current['total'] = sum(self.current.values())
+    for name, seconds in self.current.items():
+      if name not in self.history:
+        self.history[name] = deque(maxlen=self.window)
+      self.history[name].append(seconds)
+    self.current = OrderedDict()
+    if self.export_steps and self.logs_dir and step % self.export_steps == 0:
+      self.export(step)
+
+  def summary(self):
+    """Return the mean and percentiles in ms of each phase over the window."""
+    summary = OrderedDict()
+    for name, values in self.history.items():
+      values = np.array(values) * 1000
+      stats = OrderedDict(mean=float(values.mean()))
+      for p in self.percentiles:
+        stats['p{}'.format(p)] = float(np.percentile(values, p))
+      summary[name] = stats
+    return summary
+
+  def get_message(self):
+    """Return a short description of the mean time of each phase."""
+    summary = self.summary()
+    return ' '.join(['{}={:.1f}ms'.format(name, stats['mean'])
+                     for name, stats in summary.items()])
+
+  def export(self, step):
+    summary = self.summary()
+    os.makedirs(self.logs_dir, exist_ok=True)
+    with open(join(self.logs_dir, 'step_times.json'), 'a') as f:
+      f.write(json.dumps({'step': step, 'phases': summary}) + '\n')
+    path = join(self.logs_dir, 'step_times.csv')
+    write_header = not exists(path)
+    with open(path, 'a') as f:
+      if write_header:
+        f.write('step,phase,{}\n'.format(
+          ','.join(summary[next(iter(summary))].keys())))
+      for name, stats in summary.items():
+        f.write('{},{},{}\n'.format(
+          step, name, ','.join(['{:.3f}'.format(v) for v in stats.values()])))
+
+
+class ProfilerWindow:
+  """Run the autograd profiler from step `start` to step `end` (included)
+  and dump a chrome trace in `logs_dir`."""
+
+  def __init__(self, steps=None, logs_dir=None, use_cuda=True):
+    self.start, self.end = steps if steps else (None, None)
+    self.logs_dir = logs_dir
+    self.use_cuda = use_cuda and torch.cuda.is_available()
+    self.prof = None
+
+  def step_begin(self, step):
+    if self.start is not None and step == self.start:
+      logging.info('Start profiling at step {}.'.format(step))
+      self.prof = torch.autograd.profiler.profile(use_cuda=self.use_cuda)
+      self.prof.__enter__()
+
+  def step_end(self, step):
+    if self.prof is not None and step >= self.end:
+      self.prof.__exit__(None, None, None)
+      logging.info(self.prof.key_averages().table(
+        sort_by="self_cpu_time_total", row_limit=30))
+      if self.logs_dir:
+        os.makedirs(self.logs_dir, exist_ok=True)
+        path = join(self.logs_dir, 'trace_{}_{}.json'.format(
+          self.start, self.end))
+        self.prof.export_chrome_trace(path)
+        logging.info('Profiler trace saved in {}.'.format(path))
+      self.prof = None
@@ -1,3 +1,5 @@
+import copy
+
 import torch
 from torch.optim.optimizer import Optimizer
 
@@ -25,9 +27,16 @@ class RMSpropTF(Optimizer):
         centered (bool, optional) : if ``True``, compute the centered RMSProp,
             the gradient is normalized by an estimation of its variance
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
+        foreach (bool, optional): if ``True``, update all the parameters of a
+            group with multi-tensor (``torch._foreach_*``) kernels instead of a
+            Python loop over the parameters (default: False)
+        flatten (bool, optional): if ``True``, the square average and momentum
+            buffers of a group are stored in two flat tensors and updated with
+            single kernels, implies ``foreach`` (default: False)
     """
 
-    def __init__(self, params, lr=1e-2, alpha=0.99, eps=1e-8, momentum=0, weight_decay=0.0):
+    def __init__(self, params, lr=1e-2, alpha=0.99, eps=1e-8, momentum=0, weight_decay=0.0,
+                 foreach=False, flatten=False):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -41,6 +50,10 @@ class RMSpropTF(Optimizer):
         defaults = dict(lr=lr, momentum=momentum, alpha=alpha, eps=eps, weight_decay=weight_decay)
         super(RMSpropTF, self).__init__(params, defaults)
         self.initialized = False
+        self.foreach = foreach or flatten
+        self.flatten = flatten
+        # flat buffers of each group: (params, ms, mom)
+        self._flat_buffers = {}
 
     def __setstate__(self, state):
         super(RMSpropTF, self).__setstate__(state)
@@ -50,6 +63,8 @@ class RMSpropTF(Optimizer):
     def load_state_dict(self, state_dict):
         super(RMSpropTF, self).load_state_dict(state_dict)
         self.initialized = True
+        # the loaded buffers are not views of the flat buffers anymore
+        self._flat_buffers = {}
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -64,7 +79,10 @@ class RMSpropTF(Optimizer):
         if closure is not None:
             loss = closure()
 
-        for group in self.param_groups:
+        for group_id, group in enumerate(self.param_groups):
+            if self.foreach:
+                self._step_foreach(group_id, group)
+                continue
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -99,3 +117,127 @@ class RMSpropTF(Optimizer):
                 p.data.add_(-1.0, mom)
 
         return loss
+
+    def _init_state(self, p):
+        state = self.state[p]
+        if len(state) == 0:
+            assert not self.initialized
+            state['step'] = 0
+            state['ms'] = torch.ones_like(p.data)
+            state['mom'] = torch.zeros_like(p.data)
+        return state
+
+    def _get_flat_buffers(self, group_id, params):
+        """Return flat ms and mom buffers for the parameters of a group, the
+        per parameter states are views of these buffers."""
+        if group_id in self._flat_buffers:
+            flat_params, flat_ms, flat_mom = self._flat_buffers[group_id]
+            if len(flat_params) == len(params) and \
+               all(p is q for p, q in zip(flat_params, params)):
+                return flat_ms, flat_mom
+        states = [self._init_state(p) for p in params]
+        flat_ms = torch.cat([state['ms'].reshape(-1) for state in states])
+        flat_mom = torch.cat([state['mom'].reshape(-1) for state in states])
+        offset = 0
+        for p, state in zip(params, states):
+            n = p.numel()
+            state['ms'] = flat_ms[offset:offset + n].view_as(p)
+            state['mom'] = flat_mom[offset:offset + n].view_as(p)
+            offset += n
+        self._flat_buffers[group_id] = (params, flat_ms, flat_mom)
+        return flat_ms, flat_mom
+
+    def _step_foreach(self, group_id, group):
+        """Same update as `step` for all the parameters of the group with
+        multi-tensor kernels."""
+        assert group['momentum'] > 0
+        all_params = group['params']
+        params = [p for p in all_params if p.grad is not None]
+        if not params:
+            return
+        grads = [p.grad.data for p in params]
+        if any(grad.is_sparse for grad in grads):
+            raise RuntimeError('RMSprop does not support sparse gradients')
+        params_data = [p.data for p in params]
+
+        # weight decay -----
+        if group['weight_decay'] > 0:
+            grads = torch._foreach_add(grads, params_data, alpha=group['weight_decay'])
+
+        rho = group['alpha']
+        # the flat buffers need all the parameters of the group to have a gradient
+        if self.flatten and len(params) == len(all_params):
+            flat_ms, flat_mom = self._get_flat_buffers(group_id, params)
+            states = [self.state[p] for p in params]
+            flat_grad = torch.cat([grad.reshape(-1) for grad in grads])
+            flat_ms.add_(torch.mul(flat_grad, flat_grad).add_(-flat_ms) * (1. - rho))
+            flat_mom.mul_(group['momentum']).addcdiv_(
+                flat_grad, (flat_ms + group['eps']).sqrt_(), value=group['lr'])
+            torch._foreach_add_(params_data, [state['mom'] for state in states], alpha=-1.0)
+        else:
+            states = [self._init_state(p) for p in params]
+            ms = [state['ms'] for state in states]
+            mom = [state['mom'] for state in states]
+            # ms.add_(torch.mul(grad, grad).add_(-ms) * (1. - rho))
+            torch._foreach_mul_(ms, rho)
+            torch._foreach_addcmul_(ms, grads, grads, value=1. - rho)
+            denom = torch._foreach_add(ms, group['eps'])
+            torch._foreach_sqrt_(denom)
+            torch._foreach_mul_(mom, group['momentum'])
+            torch._foreach_addcdiv_(mom, grads, denom, value=group['lr'])
+            torch._foreach_add_(params_data, mom, alpha=-1.0)
+
+        for state in states:
+            state['step'] += 1
+
+
+def test_rmsprop_parity(n_steps=6):
+    """Check that the foreach and flatten updates give the same parameters
+    and states as the loop over the parameters."""
+    torch.manual_seed(0)
+    shapes = [(10, 5), (5,), (3, 3, 2), (7,)]
+    init = [torch.randn(shape) for shape in shapes]
+    grads = [[torch.randn(shape) for shape in shapes] for _ in range(n_steps)]
+
+    def make_optimizer(params, **kwargs):
+        # mixed groups with and without weight decay
+        groups = [{'params': params[:2], 'weight_decay': 1e-2},
+                  {'params': params[2:]}]
+        return RMSpropTF(groups, lr=1e-2, momentum=0.9, **kwargs)
+
+    def run(params, optimizer, steps):
+        for step in steps:
+            for i, p in enumerate(params):
+                # the last parameter has no gradient every other step
+                if step % 2 and i == len(params) - 1:
+                    p.grad = None
+                else:
+                    p.grad = grads[step][i].clone()
+            optimizer.step()
+
+    results = []
+    for kwargs in [{}, {'foreach': True}, {'flatten': True}]:
+        params = [torch.nn.Parameter(x.clone()) for x in init]
+        optimizer = make_optimizer(params, **kwargs)
+        run(params, optimizer, range(n_steps // 2))
+        # round trip through the state dict
+        state_dict = copy.deepcopy(optimizer.state_dict())
+        optimizer = make_optimizer(params, **kwargs)
+        optimizer.load_state_dict(state_dict)
+        run(params, optimizer, range(n_steps // 2, n_steps))
+        states = [optimizer.state[p] for p in params]
+        results.append((
+            [p.data for p in params],
+            [state['ms'] for state in states],
+            [state['mom'] for state in states]))
+
+    reference = results[0]
+    for result in results[1:]:
+        for tensors, reference_tensors in zip(result, reference):
+            for x, y in zip(tensors, reference_tensors):
+                assert torch.allclose(x, y, atol=1e-6), (x - y).abs().max()
+    print('RMSpropTF loop, foreach and flatten updates match.')
+
+
+if __name__ == '__main__':
+    test_rmsprop_parity()
@@ -1,12 +1,16 @@
 
 import os
+import json
 import time
+import random
 import datetime
 import pprint
 import socket
 import logging
 import warnings
 import glob
+import contextlib
+import itertools
 from os import mkdir
 from os.path import join
 from os.path import exists
@@ -17,8 +21,11 @@ from .models import model_config
 from .lipschitz import LipschitzRegularization
 from .rmsprop import RMSpropTF
 from .utils import GradualWarmupScheduler
+from .profiling import StepTimer
+from .profiling import ProfilerWindow
 
 from .dataset.readers import readers_config
+from .dataset.readers import get_loader_queue_depth
 
 import numpy as np
 import torch
@@ -66,23 +73,52 @@ def get_scheduler(optimizer, lr_scheduler, lr_scheduler_params):
   return scheduler
 
 
-def get_optimizer(optimizer, opt_args, init_lr, weight_decay, params):
-  """Returns the optimizer that should be used based on params."""
+def get_parameter_groups(model, weight_decay):
+  """Split the parameters of the model in two groups, the weight decay is
+  only applied to the parameters which are not batch norm parameters."""
+  params_bn, params_without_bn = [], []
+  for name, param in model.named_parameters():
+    if '_bn' in name or '.bn' in name:
+      params_bn.append(param)
+    else:
+      params_without_bn.append(param)
+  return [{'params': params_without_bn, 'weight_decay': weight_decay},
+          {'params': params_bn, 'weight_decay': 0.}]
+
+
+def get_optimizer(optimizer, opt_args, init_lr, weight_decay, params,
+                  zero=False):
+  """Returns the optimizer that should be used based on params. If zero is
+  True, the states of the optimizer are sharded between the ranks with
+  ZeroRedundancyOptimizer."""
   if optimizer == 'sgd':
-    opt = torch.optim.SGD(
-      params, lr=init_lr, weight_decay=weight_decay, **opt_args)
+    opt_class = torch.optim.SGD
   elif optimizer == 'rmsprop':
-    opt = torch.optim.RMSprop(
-      params, lr=init_lr, weight_decay=weight_decay, **opt_args)
+    opt_class = torch.optim.RMSprop
   elif optimizer == 'adam':
-    opt = torch.optim.Adam(
-      params, lr=init_lr, weight_decay=weight_decay, **opt_args)
+    opt_class = torch.optim.Adam
   elif optimizer == 'rmsproptf':
-    # we compute the l2 loss manualy without bn params
-    opt = RMSpropTF(params, lr=init_lr, weight_decay=0, **opt_args)
+    # the weight decay is set in the parameter groups, the bn params are
+    # excluded (see get_parameter_groups)
+    opt_class = RMSpropTF
+    weight_decay = 0
   else:
     raise ValueError("Optimizer was not recognized")
-  return opt
+  if zero:
+    from torch.distributed.optim import ZeroRedundancyOptimizer
+    return ZeroRedundancyOptimizer(
+      params, optimizer_class=opt_class, lr=init_lr,
+      weight_decay=weight_decay, **opt_args)
+  return opt_class(params, lr=init_lr, weight_decay=weight_decay, **opt_args)
+
+
+def list_checkpoints(train_dir):
+  """Return the checkpoints of train_dir sorted by global step. The
+  checkpoints being written have a '.tmp' suffix and are ignored."""
+  checkpoints = glob.glob(join(train_dir, "model.ckpt-*.pth"))
+  get_model_id = lambda x: int(x.strip('.pth').strip('model.ckpt-'))
+  return sorted(
+    [ckpt.split('/')[-1] for ckpt in checkpoints], key=get_model_id)
 
 
 class Trainer:
@@ -98,16 +134,37 @@ class Trainer:
     global_utils.setup_logging(params.logging_verbosity)
 
     self.job_name = self.params.job_name  # "" for local training
-    self.is_distributed = bool(self.job_name)
+    # torchrun (and torch.distributed.launch) export the rank and the world
+    # size of each process
+    self.elastic = 'RANK' in os.environ and 'WORLD_SIZE' in os.environ
+    self.is_distributed = bool(self.job_name) or self.elastic
     self.task_index = self.params.task_index
-    self.local_rank = self.params.local_rank
+    self.local_rank = int(os.environ.get('LOCAL_RANK', self.params.local_rank))
+    self.params.local_rank = self.local_rank
     self.start_new_model = self.params.start_new_model
     self.train_dir = self.params.train_dir
     self.num_gpus = self.params.num_gpus
+    self.use_cuda = torch.cuda.is_available() and bool(self.num_gpus)
+    if self.use_cuda:
+      self.device = torch.device('cuda', self.local_rank)
+    else:
+      self.device = torch.device('cpu')
+
+    # after a failure, the workers restarted by torchrun resume from the
+    # last complete checkpoint
+    restart_count = int(os.environ.get('TORCHELASTIC_RESTART_COUNT', 0))
+    auto_resume = getattr(self.params, 'auto_resume', False) or \
+        restart_count > 0
+    if self.start_new_model and auto_resume and \
+       exists(self.train_dir) and list_checkpoints(self.train_dir):
+      self.start_new_model = False
     if self.num_gpus and not self.is_distributed:
       self.batch_size = self.params.batch_size * self.num_gpus
     else:
       self.batch_size = self.params.batch_size
+    # number of micro-batches accumulated before each optimizer step
+    self.accumulation_steps = getattr(
+      self.params, 'gradient_accumulation_steps', 1)
 
     # print self.params parameters
     if self.start_new_model and self.local_rank == 0:
@@ -116,19 +173,29 @@ class Trainer:
 
     if self.local_rank == 0:
       logging.info("PyTorch version: {}.".format(torch.__version__))
-      logging.info("NCCL Version {}".format(torch.cuda.nccl.version()))
+      if self.use_cuda:
+        logging.info("NCCL Version {}".format(torch.cuda.nccl.version()))
       logging.info("Hostname: {}.".format(socket.gethostname()))
 
     if self.is_distributed:
-      self.num_nodes = len(params.worker_hosts.split(';'))
-      self.world_size = self.num_nodes * self.num_gpus
-      self.rank = self.task_index * self.num_gpus + self.local_rank
+      if self.elastic:
+        self.world_size = int(os.environ['WORLD_SIZE'])
+        self.rank = int(os.environ['RANK'])
+      else:
+        self.num_nodes = len(params.worker_hosts.split(';'))
+        self.world_size = self.num_nodes * self.num_gpus
+        self.rank = self.task_index * self.num_gpus + self.local_rank
+      backend = getattr(self.params, 'dist_backend', None)
+      if backend is None:
+        backend = 'nccl' if self.use_cuda else 'gloo'
       dist.init_process_group(
-        backend='nccl', init_method='env://',
-        timeout=datetime.timedelta(seconds=30))
+        backend=backend, init_method='env://',
+        timeout=datetime.timedelta(
+          seconds=getattr(self.params, 'dist_timeout', 30)))
       if self.local_rank == 0:
         logging.info('World Size={} => Total batch size {}'.format(
-          self.world_size, self.batch_size*self.world_size))
+          self.world_size,
+          self.batch_size * self.accumulation_steps * self.world_size))
       self.is_master = bool(self.rank == 0)
     else:
       self.world_size = 1
@@ -137,6 +204,22 @@ class Trainer:
     # create a mesage builder for logging
     self.message = global_utils.MessageBuilder()
 
+    # per phase timing of the training steps and profiler window
+    self.logs_dir = "{}_logs".format(self.train_dir)
+    self.timer = StepTimer(
+      enabled=getattr(self.params, 'step_timing', False),
+      window=getattr(self.params, 'step_timing_window', 100),
+      logs_dir=self.logs_dir if self.is_master else None,
+      export_steps=getattr(self.params, 'step_timing_export_steps', 0))
+    self.profiler = ProfilerWindow(
+      steps=getattr(self.params, 'profile_steps', None),
+      logs_dir=self.logs_dir if self.is_master else None)
+    # time spent waiting for the data vs in compute
+    self.stall_detector = global_utils.StallDetector(
+      threshold=getattr(self.params, 'datasets_stall_threshold', 0.1))
+    self.auto_tune_threads = getattr(
+      self.params, 'datasets_auto_tune_threads', False)
+
     # load reader and model
     self.reader = readers_config[self.params.dataset](
       self.params, self.batch_size, self.num_gpus, is_training=True)
@@ -144,25 +227,50 @@ class Trainer:
         self.params.model, self.params.dataset, self.params,
         self.reader.n_classes, is_training=True)
     # define DistributedDataParallel job
-    self.model = SyncBatchNorm.convert_sync_batchnorm(self.model)
-    torch.cuda.set_device(params.local_rank)
-    self.model = self.model.cuda()
-    i = params.local_rank
-    self.model = DistributedDataParallel(
-      self.model, device_ids=[i], output_device=i)
-    if self.local_rank == 0:
-      logging.info('Model defined with DistributedDataParallel')
+    if self.use_cuda:
+      self.model = SyncBatchNorm.convert_sync_batchnorm(self.model)
+      torch.cuda.set_device(self.local_rank)
+    self.model = self.model.to(self.device)
+    if self.is_distributed:
+      i = self.local_rank
+      device_ids = [i] if self.use_cuda else None
+      output_device = i if self.use_cuda else None
+      self.model = DistributedDataParallel(
+        self.model, device_ids=device_ids, output_device=output_device)
+      if self.local_rank == 0:
+        logging.info('Model defined with DistributedDataParallel')
+
+    # compute the gradient norm while the buckets are all-reduced
+    self.clip_hook = None
+    if self.is_distributed and self.params.gradient_clip_by_norm and \
+       getattr(self.params, 'gradient_clip_comm_hook', True):
+      self.clip_hook = utils.ClipGradNormCommHook(
+        self.params.gradient_clip_by_norm)
+      self.model.register_comm_hook(None, self.clip_hook)
 
     # define set for saved ckpt
     self.saved_ckpts = set([0])
 
+    # shard the optimizer states and the ema between the ranks, the
+    # checkpoints hold the consolidated states or one shard per rank
+    self.zero = getattr(self.params, 'zero_sharding', False) and \
+        self.is_distributed
+    self.zero_checkpoint = getattr(
+      self.params, 'zero_checkpoint', 'consolidate')
+    assert self.zero_checkpoint in ('consolidate', 'sharded')
+
     # define optimizer
+    if self.params.optimizer == 'rmsproptf':
+      params = get_parameter_groups(self.model, self.params.weight_decay)
+    else:
+      params = self.model.parameters()
     self.optimizer = get_optimizer(
                        self.params.optimizer,
                        self.params.optimizer_params,
                        self.params.init_learning_rate,
                        self.params.weight_decay,
-                       self.model.parameters())
+                       params,
+                       zero=self.zero)
 
     # define learning rate scheduler
     self.scheduler = get_scheduler(
@@ -182,7 +290,15 @@ class Trainer:
     # exponential moving average
     self.ema = None
     if getattr(self.params, 'ema', False) > 0:
-      self.ema = utils.EMA(self.params.ema)
+      if self.zero:
+        self.ema = utils.ShardedEMA(
+          self.params.ema, self.rank, self.world_size)
+      else:
+        self.ema = utils.EMA(self.params.ema)
+      if not self.start_new_model and 'ema' in self.checkpoint:
+        # the sharded ema only keeps the variables of this rank at its
+        # first update
+        self.ema.shadow = self.checkpoint['ema']
 
     # if adversarial training, create the attack class
     if self.params.adversarial_training:
@@ -196,20 +312,68 @@ class Trainer:
                       attack_params)
 
   def load_state(self):
-    # load last checkpoint
-    checkpoints = glob.glob(join(self.train_dir, "model.ckpt-*.pth"))
-    get_model_id = lambda x: int(x.strip('.pth').strip('model.ckpt-'))
-    checkpoints = sorted(
-      [ckpt.split('/')[-1] for ckpt in checkpoints], key=get_model_id)
-    path_last_ckpt = join(self.train_dir, checkpoints[-1])
-    self.checkpoint = torch.load(path_last_ckpt)
+    # load the last checkpoint which can be read
+    checkpoints = list_checkpoints(self.train_dir)
+    for ckpt_name in reversed(checkpoints):
+      try:
+        ckpt_path = join(self.train_dir, ckpt_name)
+        self.checkpoint = torch.load(ckpt_path, map_location=self.device)
+        break
+      except (RuntimeError, EOFError):
+        logging.warning('Checkpoint {} is corrupted.'.format(ckpt_name))
+    else:
+      raise RuntimeError(
+        'No checkpoint could be loaded from {}.'.format(self.train_dir))
     self.model.load_state_dict(self.checkpoint['model_state_dict'])
-    self.optimizer.load_state_dict(self.checkpoint['optimizer_state_dict'])
+    if self.checkpoint.get('zero_sharded', False):
+      self.load_optimizer_shard(ckpt_path)
+    else:
+      optimizer_state = self.checkpoint['optimizer_state_dict']
+      if len(optimizer_state['param_groups']) != \
+         len(self.optimizer.param_groups):
+        optimizer_state = self.regroup_optimizer_state(optimizer_state)
+      self.optimizer.load_state_dict(optimizer_state)
     self.scheduler.load_state_dict(self.checkpoint['scheduler'])
     self.saved_ckpts.add(self.checkpoint['epoch'])
     epoch = self.checkpoint['epoch']
     if self.local_rank == 0:
-      logging.info('Loading checkpoint {}'.format(checkpoints[-1]))
+      logging.info('Loading checkpoint {}'.format(ckpt_name))
+
+  def load_optimizer_shard(self, ckpt_path):
+    """Load the optimizer states saved by this rank with
+    zero_checkpoint='sharded'."""
+    for group, saved_group in zip(self.optimizer.param_groups,
+                                  self.checkpoint['optimizer_param_groups']):
+      group.update(saved_group)
+    shard_path = '{}.rank{}'.format(ckpt_path, self.rank)
+    if not self.zero or self.checkpoint['world_size'] != self.world_size \
+       or not exists(shard_path):
+      if self.local_rank == 0:
+        logging.warning(
+          'The optimizer shards of {} ranks cannot be loaded with {} ranks, '
+          'the optimizer states are reset.'.format(
+            self.checkpoint['world_size'], self.world_size))
+      return
+    shard = torch.load(shard_path, map_location=self.device)
+    self.optimizer.optim.load_state_dict(shard['optimizer_state_dict'])
+
+  def regroup_optimizer_state(self, state_dict):
+    """Convert an optimizer state saved with a single parameter group to the
+    current parameter groups."""
+    assert len(state_dict['param_groups']) == 1
+    params = list(self.model.parameters())
+    group_params = [
+      p for group in self.optimizer.param_groups for p in group['params']]
+    new_index = {id(p): i for i, p in enumerate(group_params)}
+    state = {new_index[id(params[i])]: value
+             for i, value in state_dict['state'].items()}
+    param_groups = []
+    for group in self.optimizer.param_groups:
+      saved_group = dict(state_dict['param_groups'][0])
+      saved_group['weight_decay'] = group['weight_decay']
+      saved_group['params'] = [new_index[id(p)] for p in group['params']]
+      param_groups.append(saved_group)
+    return {'state': state, 'param_groups': param_groups}
 
   def run(self):
     """Performs training on the currently defined Tensorflow graph.
@@ -239,7 +403,7 @@ class Trainer:
   def _run_training(self):
 
     if self.params.lb_smooth == 0:
-      self.criterion = torch.nn.CrossEntropyLoss().cuda()
+      self.criterion = torch.nn.CrossEntropyLoss().to(self.device)
     else:
       if self.local_rank == 0:
         logging.info("Using CrossEntropyLoss with label smooth {}.".format(
@@ -257,96 +421,246 @@ class Trainer:
       global_step = self.checkpoint['global_step']
 
     data_loader, sampler = self.reader.load_dataset()
-    if sampler is not None:
-      assert sampler.num_replicas == self.world_size
-
-    batch_size = self.batch_size
-    if self.is_distributed:
-      n_files = sampler.num_samples
+    assert sampler.num_replicas == self.world_size
+    # resume the epoch from the next unseen sample, the remaining samples
+    # are split between the current workers
+    if not self.start_new_model and 'sampler' in self.checkpoint:
+      sampler.load_state_dict(self.checkpoint['sampler'])
     else:
-      n_files = self.reader.n_train_files
+      sampler.set_epoch(start_epoch)
+    self.sampler = sampler
+    n_files = sampler.num_samples
 
     if self.local_rank == 0:
       logging.info("Number of files on worker: {}".format(n_files))
+      if self.accumulation_steps > 1:
+        logging.info("Accumulating gradients over {} micro-batches".format(
+          self.accumulation_steps))
       logging.info("Start training")
 
-    profile_enabled = False
+    epoch_id = start_epoch
     for epoch_id in range(start_epoch, self.params.num_epochs):
-      if self.is_distributed:
+      if sampler.epoch != epoch_id:
         sampler.set_epoch(epoch_id)
-      for n_batch, data in enumerate(data_loader):
-        epoch = (int(global_step) * batch_size) / n_files
-        with torch.autograd.profiler.profile(
-            enabled=profile_enabled, use_cuda=True) as prof:
-          self._training(data, epoch, global_step)
-        if profile_enabled:
-          logging.info(prof.key_averages().table(sort_by="self_cpu_time_total"))
-          # prof.export_chrome_trace(join(
-          #   self.train_dir+'_logs', 'trace_{}.json'.format(global_step)))
-        self.save_ckpt(global_step, epoch_id)
+      data_iter = iter(data_loader)
+      while True:
+        wait_start_time = time.time()
+        # the last group of an epoch may have less micro-batches
+        data = list(itertools.islice(data_iter, self.accumulation_steps))
+        if not data:
+          break
+        compute_start_time = time.time()
+        epoch = epoch_id + sampler.cursor / self.reader.n_train_files
+        self.profiler.step_begin(global_step)
+        self._training(data, epoch, global_step)
+        self.profiler.step_end(global_step)
+        self.stall_detector.add(
+          compute_start_time - wait_start_time,
+          time.time() - compute_start_time,
+          get_loader_queue_depth(data_iter))
+        self.timer.add('data', compute_start_time - wait_start_time)
+        self.timer.end_step(global_step)
         global_step += 1
+        sampler.advance(
+          sum(len(labels) for _, labels in data) * self.world_size)
+        self.save_ckpt(global_step, epoch_id)
       self.scheduler.step()
+      if self.check_data_stall():
+        data_loader, sampler = self.reader.load_dataset()
+        sampler.load_state_dict(self.sampler.state_dict())
+        self.sampler = sampler
     self.save_ckpt(global_step, epoch_id, final=True)
     logging.info("Done training -- epoch limit reached.")
 
-  def save_ckpt(self, step, epoch, final=False):
-    """Save ckpt in train directory."""
-    freq_ckpt_epochs = self.params.save_checkpoint_epochs
-    if (epoch % freq_ckpt_epochs == 0 and self.is_master \
-        and epoch not in self.saved_ckpts) \
-         or (final and self.is_master):
-      ckpt_name = "model.ckpt-{}.pth".format(step)
-      ckpt_path = join(self.train_dir, ckpt_name)
-      if exists(ckpt_path): return 
-      self.saved_ckpts.add(epoch)
-      state = {
-        'epoch': epoch,
-        'global_step': step,
-        'model_state_dict': self.model.state_dict(),
-        'optimizer_state_dict': self.optimizer.state_dict(),
-        'scheduler': self.scheduler.state_dict()
-      }
-      if self.ema is not None:
-        state['ema'] = self.ema.state_dict()
-      logging.info("Saving checkpoint '{}'.".format(ckpt_name))
-      torch.save(state, ckpt_path)
-
+  def check_data_stall(self):
+    """Check at the end of an epoch if the training was waiting for the data.
+    If datasets_auto_tune_threads is True, increase the number of loader
+    workers and return True, the loader needs to be rebuilt."""
+    stall = self.stall_detector.stall()
+    is_stalling = self.stall_detector.is_stalling()
+    self.stall_detector.reset()
+    if not is_stalling:
+      return False
+    num_threads = self.reader.num_threads
+    suggestion = self.stall_detector.get_suggestion(num_threads)
+    if suggestion <= num_threads:
+      return False
+    if not self.auto_tune_threads:
+      if self.local_rank == 0:
+        logging.info(
+          "Data loading stalled {:.1%} of the epoch, consider increasing "
+          "datasets_num_private_threads from {} to {}.".format(
+            stall, num_threads, suggestion))
+      return False
+    if self.local_rank == 0:
+      logging.info(
+        "Data loading stalled {:.1%} of the epoch, increasing the number "
+        "of loader workers from {} to {}.".format(
+          stall, num_threads, suggestion))
+    self.reader.num_threads = suggestion
+    self.reader.reset_loader()
+    return True
+
+  def write_lipschitz_metrics(self, step):
+    """Append the bound of each layer to lipschitz.json in the logs."""
+    if not self.is_master:
+      return
+    metrics = self.lipschitz_reg.get_metrics()
+    if not metrics or not exists(self.logs_dir):
+      return
+    with open(join(self.logs_dir, 'lipschitz.json'), 'a') as f:
+      f.write(json.dumps({'step': step, 'bounds': metrics}) + '\n')
 
-  def _training(self, data, epoch, step):
+  def save_ckpt(self, step, epoch, final=False):
+    """Save ckpt in train directory.
 
-    batch_start_time = time.time()
+    With ZeRO sharding, all the ranks take part in the save: the optimizer
+    states and the ema are gathered on the master, or each rank writes its
+    optimizer shard next to the checkpoint (zero_checkpoint='sharded').
+    """
+    freq_ckpt_epochs = self.params.save_checkpoint_epochs
+    freq_ckpt_steps = getattr(self.params, 'save_checkpoint_steps', None)
+    save_epoch = epoch % freq_ckpt_epochs == 0 and \
+        epoch not in self.saved_ckpts
+    save_step = bool(freq_ckpt_steps) and step % freq_ckpt_steps == 0
+    if not (save_epoch or save_step or final):
+      return
+    if not self.is_master and not self.zero:
+      return
+    ckpt_name = "model.ckpt-{}.pth".format(step)
+    ckpt_path = join(self.train_dir, ckpt_name)
+    skip = exists(ckpt_path)
+    if self.zero:
+      # the master decides, all the ranks must run the same collectives
+      skip = [skip]
+      dist.broadcast_object_list(skip, src=0)
+      skip = skip[0]
+    if skip:
+      return
+    self.saved_ckpts.add(epoch)
+
+    optimizer_state, ema_state = None, None
+    if self.zero and self.zero_checkpoint == 'sharded':
+      shard_path = '{}.rank{}'.format(ckpt_path, self.rank)
+      torch.save({'optimizer_state_dict': self.optimizer.optim.state_dict()},
+                 shard_path + '.tmp')
+      os.replace(shard_path + '.tmp', shard_path)
+      # the checkpoint is written once all the shards are complete
+      dist.barrier()
+    elif self.zero:
+      self.optimizer.consolidate_state_dict(to=0)
+      if self.is_master:
+        optimizer_state = self.optimizer.state_dict()
+    else:
+      optimizer_state = self.optimizer.state_dict()
+    if self.zero and self.ema is not None:
+      ema_state = self.ema.consolidated_state_dict(dst=0)
+    elif self.ema is not None:
+      ema_state = self.ema.state_dict()
+    if not self.is_master:
+      return
+
+    # seed, epoch and position of the next unseen sample
+    sampler_state = self.sampler.state_dict()
+    state = {
+      'epoch': sampler_state['epoch'],
+      'global_step': step,
+      'model_state_dict': self.model.state_dict(),
+      'scheduler': self.scheduler.state_dict(),
+      'sampler': sampler_state
+    }
+    if optimizer_state is not None:
+      state['optimizer_state_dict'] = optimizer_state
+    else:
+      state['zero_sharded'] = True
+      state['world_size'] = self.world_size
+      state['optimizer_param_groups'] = [
+        {key: value for key, value in group.items() if key != 'params'}
+        for group in self.optimizer.param_groups]
+    if ema_state is not None:
+      state['ema'] = ema_state
+    logging.info("Saving checkpoint '{}'.".format(ckpt_name))
+    # write in a temporary file first, an interrupted save never leaves an
+    # incomplete checkpoint
+    torch.save(state, ckpt_path + '.tmp')
+    os.replace(ckpt_path + '.tmp', ckpt_path)
+
+
+  def _prepare_inputs(self, data):
+    """Copy a micro-batch on the device, apply the batched transforms and
+    the adversarial attack."""
     inputs, labels = data
-    inputs = inputs.cuda(non_blocking=True)
-    labels = labels.cuda(non_blocking=True)
+    with self.timer.phase('h2d'):
+      inputs = inputs.to(self.device, non_blocking=True)
+      labels = labels.to(self.device, non_blocking=True)
+    if self.reader.batch_transform is not None:
+      with self.timer.phase('batch_transform'):
+        inputs = self.reader.batch_transform(inputs)
 
     if self.params.adversarial_training:
-      inputs = self.attack.perturb(inputs)
-
-    outputs = self.model(inputs)
-    loss = self.criterion(outputs, labels.cuda())
+      with self.timer.phase('attack'):
+        inputs = self.attack.perturb(inputs)
+    return inputs, labels
+
+  def _forward_backward(self, inputs, labels, epoch, loss_scale,
+                        with_lip_reg):
+    """Forward and backward pass of a micro-batch, the gradients are
+    accumulated in the parameters."""
+    with self.timer.phase('forward'):
+      outputs = self.model(inputs)
+      loss = self.criterion(outputs, labels)
+
+    # the Lipschitz regularization does not depend on the data, it is
+    # only added once per optimizer step
+    lip_loss = 0.
+    if with_lip_reg:
+      with self.timer.phase('lipreg'):
+        lip_loss = self.lipschitz_reg.get_lip_reg(epoch, self.model)
+    total_loss = loss * loss_scale + lip_loss
+
+    with self.timer.phase('backward'):
+      total_loss.backward()
+    return loss, lip_loss
 
-    with torch.autograd.profiler.record_function("lipreg"):
-      lip_loss = self.lipschitz_reg.get_lip_reg(epoch, self.model)
-    total_loss = loss + lip_loss
-    if self.params.optimizer == 'rmsproptf':
-      params_without_bn = [p for n, p in self.model.named_parameters() \
-                           if not ('_bn' in n or '.bn' in n)]
-      total_loss += self.params.weight_decay * (1./2.) * \
-          sum([torch.sum(p**2) for p in params_without_bn])
+  def _training(self, data, epoch, step):
+    """Run an optimizer step on a list of micro-batches."""
 
+    batch_start_time = time.time()
+    n_micro_batches = len(data)
+    # the attacks run backward passes, the gradients of the parameters are
+    # reset after all the micro-batches have been perturbed
+    micro_batches = [self._prepare_inputs(micro_batch) for micro_batch in data]
     self.optimizer.zero_grad()
-    total_loss.backward()
-
-    if self.params.gradient_clip_by_norm:
-      torch.nn.utils.clip_grad_norm_(
-        self.model.parameters(), self.params.gradient_clip_by_norm)
-    elif self.params.gradient_clip_by_value:
-      torch.nn.utils.clip_grad_value_(
-        self.model.parameters(), self.params.gradient_clip_by_value)
-
-    self.optimizer.step()
+    if self.clip_hook is not None:
+      self.clip_hook.reset()
+    loss = 0.
+    for i, (inputs, labels) in enumerate(micro_batches):
+      is_last = i == n_micro_batches - 1
+      # the gradients are only all-reduced on the last micro-batch
+      if is_last or not self.is_distributed:
+        sync_context = contextlib.suppress()
+      else:
+        sync_context = self.model.no_sync()
+      with sync_context:
+        micro_loss, lip_loss = self._forward_backward(
+          inputs, labels, epoch, 1. / n_micro_batches, with_lip_reg=is_last)
+      loss += micro_loss.detach() / n_micro_batches
+
+    with self.timer.phase('clip'):
+      if self.clip_hook is not None:
+        # the norm has been computed by the hook during the all-reduce
+        self.clip_hook.clip_(self.model.parameters())
+      elif self.params.gradient_clip_by_norm:
+        torch.nn.utils.clip_grad_norm_(
+          self.model.parameters(), self.params.gradient_clip_by_norm)
+      elif self.params.gradient_clip_by_value:
+        torch.nn.utils.clip_grad_value_(
+          self.model.parameters(), self.params.gradient_clip_by_value)
+
+    with self.timer.phase('optimizer'):
+      self.optimizer.step()
     seconds_per_batch = time.time() - batch_start_time
-    examples_per_second = self.batch_size / seconds_per_batch
+    examples_per_second = self.batch_size * n_micro_batches / seconds_per_batch
     examples_per_second *= self.world_size
     
     if step == 10 and self.is_master:
@@ -360,7 +674,8 @@ class Trainer:
 
     # update ema
     if self.ema is not None:
-      self.ema(self.model, step)
+      with self.timer.phase('ema'):
+        self.ema(self.model, step)
 
     local_rank = self.local_rank
     to_print = step % self.params.frequency_log_steps == 0
@@ -372,7 +687,14 @@ class Trainer:
       self.message.add("loss", loss, format=".4f")
       self.message.add("lip", lip_loss, format="2.4f")
       self.message.add("imgs/sec", examples_per_second, width=5, format=".0f")
+      self.message.add("stall", self.stall_detector.stall() * 100, format=".1f")
+      queue_depth = self.stall_detector.queue_depth()
+      if queue_depth is not None:
+        self.message.add("queue", queue_depth, format=".1f")
       logging.info(self.message.get_message())
+      self.write_lipschitz_metrics(step)
+      if self.timer.enabled:
+        logging.info("step times: {}".format(self.timer.get_message()))
 
 
 
@@ -3,7 +3,9 @@ import copy
 import multiprocessing
 
 import torch
-from torch.distributions import normal, laplace, uniform, bernoulli
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.utils.data import get_worker_info
 from torch.optim.lr_scheduler import _LRScheduler
 from advertorch import attacks
 
@@ -46,9 +48,17 @@ def get_attack(model, num_classes, attack_name, attack_params):
   elif attack_name == 'elasticnet':
     attack = attacks.ElasticNetL1Attack(model, num_classes, **attack_params)
   elif attack_name == 'pgd':
-    norm = attack_params['norm']
-    del attack_params['norm']
-    if norm == 'inf':
+    # the params may be shared by several attacks, they are not modified
+    attack_params = dict(attack_params)
+    norm = attack_params.pop('norm')
+    early_stop = attack_params.pop('early_stop', False)
+    refill = attack_params.pop('refill', False)
+    if early_stop and norm in ('inf', 'l2'):
+      attack = EarlyStopPGDAttack(
+        model, norm=norm, refill=refill, **attack_params)
+    elif early_stop:
+      raise ValueError("Early stopping PGD only supports the inf and l2 norms.")
+    elif norm == 'inf':
       attack = attacks.LinfPGDAttack(model, **attack_params)
     elif norm == 'l1':
       attack = attacks.SparseL1PGDAttack(model, **attack_params)
@@ -57,13 +67,183 @@ def get_attack(model, num_classes, attack_name, attack_params):
     else:
       raise ValueError("Norm not recognized for PGD attack.")
   elif attack_name == 'fgsm':
-    attack = GradientSignAttack(model, **attack_params)
+    attack = attacks.GradientSignAttack(model, **attack_params)
   else:
     raise ValueError("Attack name not recognized for adv training.")
   return attack
 
 
 
+class EarlyStopPGDAttack:
+  """PGD attack with the inf or l2 norm which stops perturbing the samples
+  as soon as they are misclassified.
+
+  At each iteration, the samples misclassified by the model keep their
+  adversarial example and leave the active batch, which is compacted, the
+  attack ends when all the samples are misclassified. With `refill`,
+  `perturb_stream` replaces them with the next samples of an iterator of
+  batches so the active batch stays full.
+  """
+
+  def __init__(self, predict, norm='inf', eps=0.3, nb_iter=40, eps_iter=0.01,
+               rand_init=True, clip_min=0., clip_max=1., refill=False):
+    self.predict = predict
+    self.norm = norm
+    self.eps = eps
+    self.nb_iter = nb_iter
+    self.eps_iter = eps_iter
+    self.rand_init = rand_init
+    self.clip_min = clip_min
+    self.clip_max = clip_max
+    self.refill = refill
+
+  def _norm(self, x):
+    """l2 norm of each sample, with the shape of x for broadcasting."""
+    norm = x.reshape(x.shape[0], -1).norm(dim=1)
+    return norm.reshape(-1, *([1] * (x.dim() - 1)))
+
+  def _project(self, delta):
+    if self.norm == 'inf':
+      return torch.clamp(delta, -self.eps, self.eps)
+    return delta * torch.clamp(self.eps / (self._norm(delta) + 1e-12), max=1.)
+
+  def _init_delta(self, x):
+    if not self.rand_init:
+      return torch.zeros_like(x)
+    if self.norm == 'inf':
+      delta = torch.empty_like(x).uniform_(-self.eps, self.eps)
+    else:
+      delta = torch.randn_like(x)
+      radius = torch.rand(x.shape[0], device=x.device) * self.eps
+      delta = delta / (self._norm(delta) + 1e-12) * radius.reshape(
+        -1, *([1] * (x.dim() - 1)))
+    return torch.clamp(x + delta, self.clip_min, self.clip_max) - x
+
+  def _step(self, x, delta, y):
+    """One iteration on the active samples, return the new perturbations and
+    the mask of the samples misclassified with the current ones."""
+    delta = delta.detach().requires_grad_()
+    with torch.enable_grad():
+      outputs = self.predict(x + delta)
+      loss = F.cross_entropy(outputs, y, reduction='sum')
+      grad, = torch.autograd.grad(loss, delta)
+    done = outputs.argmax(dim=1).ne(y)
+    if self.norm == 'inf':
+      new_delta = delta + self.eps_iter * grad.sign()
+    else:
+      new_delta = delta + self.eps_iter * grad / (self._norm(grad) + 1e-12)
+    new_delta = self._project(new_delta.detach())
+    new_delta = torch.clamp(x + new_delta, self.clip_min, self.clip_max) - x
+    return new_delta, done
+
+  def perturb(self, x, y=None):
+    """Return the adversarial examples of a batch. Without labels, the
+    predictions of the model are used, as in advertorch, the samples stop
+    once their prediction changes."""
+    if y is None:
+      with torch.no_grad():
+        y = self.predict(x).argmax(1)
+    x_adv = x.clone()
+    index = torch.arange(x.shape[0], device=x.device)
+    x_active, y_active = x, y
+    delta = self._init_delta(x)
+    for _ in range(self.nb_iter):
+      new_delta, done = self._step(x_active, delta, y_active)
+      # the misclassified samples keep their perturbation and leave the batch
+      x_adv[index[done]] = x_active[done] + delta[done]
+      keep = ~done
+      index, x_active, y_active = index[keep], x_active[keep], y_active[keep]
+      delta = new_delta[keep]
+      if index.numel() == 0:
+        break
+    x_adv[index] = x_active + delta
+    return x_adv
+
+  def perturb_stream(self, batches):
+    """Attack the samples of an iterator of (inputs, labels) batches.
+
+    The samples leaving the active batch are replaced by the next samples
+    of the iterator. Yield (inputs, labels, inputs_adv) batches of the size
+    of the first batch, the samples are not in the order of the iterator.
+    """
+    batches = iter(batches)
+    batch_size = None
+    x = y = delta = n_iter = None
+    # samples waiting to enter the active batch and attacked samples
+    queue, finished = [], []
+    exhausted = False
+    while True:
+      n_active = 0 if x is None else x.shape[0]
+      n_queued = sum(inputs.shape[0] for inputs, _ in queue)
+      while not exhausted and (
+          batch_size is None or n_active + n_queued < batch_size):
+        try:
+          inputs, labels = next(batches)
+        except StopIteration:
+          exhausted = True
+          break
+        batch_size = batch_size or inputs.shape[0]
+        queue.append((inputs, labels))
+        n_queued += inputs.shape[0]
+      if n_queued and n_active < batch_size:
+        inputs = torch.cat([inputs for inputs, _ in queue])
+        labels = torch.cat([labels for _, labels in queue])
+        n_new = batch_size - n_active
+        queue = [(inputs[n_new:], labels[n_new:])] \
+            if inputs.shape[0] > n_new else []
+        inputs, labels = inputs[:n_new], labels[:n_new]
+        new_n_iter = torch.zeros(
+          inputs.shape[0], dtype=torch.long, device=inputs.device)
+        if x is None:
+          x, y, delta, n_iter = (
+            inputs, labels, self._init_delta(inputs), new_n_iter)
+        else:
+          x, y = torch.cat([x, inputs]), torch.cat([y, labels])
+          delta = torch.cat([delta, self._init_delta(inputs)])
+          n_iter = torch.cat([n_iter, new_n_iter])
+      if x is None or x.shape[0] == 0:
+        break
+
+      new_delta, done = self._step(x, delta, y)
+      n_iter += 1
+      # the misclassified samples keep their perturbation, the others are
+      # finished after nb_iter iterations
+      x_adv = torch.where(
+        done.reshape(-1, *([1] * (x.dim() - 1))), x + delta, x + new_delta)
+      out = done | (n_iter >= self.nb_iter)
+      if out.any():
+        finished.append((x[out], y[out], x_adv[out]))
+      keep = ~out
+      x, y, delta, n_iter = x[keep], y[keep], new_delta[keep], n_iter[keep]
+
+      n_finished = sum(inputs.shape[0] for inputs, _, _ in finished)
+      if n_finished >= batch_size:
+        inputs, labels, inputs_adv = [torch.cat(t) for t in zip(*finished)]
+        yield inputs[:batch_size], labels[:batch_size], \
+            inputs_adv[:batch_size]
+        finished = [(inputs[batch_size:], labels[batch_size:],
+                     inputs_adv[batch_size:])]
+    if finished:
+      inputs, labels, inputs_adv = [torch.cat(t) for t in zip(*finished)]
+      if inputs.shape[0]:
+        yield inputs, labels, inputs_adv
+
+
+@torch.jit.script
+def add_clip(x, noise, clip_min: float, clip_max: float):
+  """Add the noise and clip, fused in a single kernel."""
+  return torch.clamp(x + noise, clip_min, clip_max)
+
+
+class Normal:
+
+  def __init__(self, loc, scale):
+    self.loc = loc
+    self.scale = scale
+
+  def sample(self, shape, device=None, generator=None):
+    noise = torch.randn(shape, device=device, generator=generator)
+    return noise * self.scale + self.loc
 
 
 class MixtureNoise:
@@ -71,32 +251,36 @@ class MixtureNoise:
   def __init__(self, noise1, noise2, method, prob=0.5):
     self.noise1 = noise1
     self.noise2 = noise2
-    self.bernoulli = bernoulli.Bernoulli(probs=prob)
+    self.prob = prob
 
     if method == 'rand':
       self.sample = self.sample_rand
     elif method == 'sum':
       self.sample = self.sample_sum
 
-  def sample_rand(self, shape):
-    if self.bernoulli.sample():
-      return self.noise1.sample(shape)
-    else:
-      return self.noise2.sample(shape)
+  def sample_rand(self, shape, device=None, generator=None):
+    # the coin is drawn on the device to avoid a synchronization
+    coin = torch.rand((), device=device, generator=generator) < self.prob
+    return torch.where(coin, self.noise1.sample(shape, device, generator),
+                       self.noise2.sample(shape, device, generator))
 
-  def sample_sum(self, shape):
-    return self.noise1.sample(shape) + self.noise2.sample(shape)
+  def sample_sum(self, shape, device=None, generator=None):
+    return self.noise1.sample(shape, device, generator) + \
+        self.noise2.sample(shape, device, generator)
 
 
 
 class Uniform:
 
   def __init__(self, low, high, scale):
+    self.low = low
+    self.high = high
     self.scale = scale
-    self.noise = uniform.Uniform(low, high)
 
-  def sample(self, shape):
-    return ((self.noise.sample(shape) * 2) - 1) * self.scale
+  def sample(self, shape, device=None, generator=None):
+    noise = torch.rand(shape, device=device, generator=generator)
+    noise = noise * (self.high - self.low) + self.low
+    return ((noise * 2) - 1) * self.scale
 
 
 class AddNoise:
@@ -112,25 +296,85 @@ class AddNoise:
     high = self.params.noise['high']
 
     if dist == "normal":
-      self.noise = normal.Normal(loc_normal, scale_normal)
+      self.noise = Normal(loc_normal, scale_normal)
     elif dist == 'uniform':
       self.noise = Uniform(low, high, scale_uniform)
     elif dist == 'uniform+normal':
-      noise1 = normal.Normal(loc_normal, scale_normal)
+      noise1 = Normal(loc_normal, scale_normal)
       noise2 = Uniform(low, high, scale_uniform)
       self.noise = MixtureNoise(noise1, noise2, method='sum')
     elif dist == 'mix_rand_uniform_normal':
-      noise1 = normal.Normal(loc_normal, scale_normal)
+      noise1 = Normal(loc_normal, scale_normal)
       noise2 = Uniform(low, high, scale_uniform)
       self.noise = MixtureNoise(noise1, noise2, method='rand')
     else:
       raise ValueError('Noise not recognized.')
     logging.info('Noise Injection {}'.format(dist))
 
-  def __call__(self, x):
-    if x.is_cuda:
-      return x + self.noise.sample(x.shape).cuda()
-    return x + self.noise.sample(x.shape)
+    # the noisy inputs are clipped if one of the bounds is set
+    self.clip_min = self.params.noise.get('clip_min', None)
+    self.clip_max = self.params.noise.get('clip_max', None)
+    self.seed = getattr(self.params, 'torch_random_seed', None)
+    self.generators = {}
+
+  def get_generator(self, device):
+    """Return the generator of the device, seeded with torch_random_seed
+    plus the rank. None without seed or in the loader workers, which are
+    seeded by the DataLoader."""
+    if self.seed is None or get_worker_info() is not None:
+      return None
+    if device not in self.generators:
+      rank = dist.get_rank() if dist.is_initialized() else 0
+      generator = torch.Generator(device=device)
+      generator.manual_seed(self.seed + rank)
+      self.generators[device] = generator
+    return self.generators[device]
+
+  def __call__(self, x, generator=None):
+    # the noise is sampled directly on the device of the inputs
+    if generator is None:
+      generator = self.get_generator(x.device)
+    noise = self.noise.sample(x.shape, x.device, generator)
+    if self.clip_min is None and self.clip_max is None:
+      return x + noise
+    clip_min = float('-inf') if self.clip_min is None else self.clip_min
+    clip_max = float('inf') if self.clip_max is None else self.clip_max
+    return add_clip(x, noise, clip_min, clip_max)
+
+
+class _EOTFunction(torch.autograd.Function):
+  """Mean of the logits over the noisy samples. The activations of the
+  chunks are not kept, the backward pass recomputes each chunk with the
+  same noise from its seed."""
+
+  @staticmethod
+  def forward(ctx, x, eot, seed):
+    ctx.eot = eot
+    ctx.seed = seed
+    ctx.save_for_backward(x)
+    logits = None
+    for index, x_noisy in eot.chunks(x, seed):
+      y = eot.model(x_noisy)
+      if logits is None:
+        logits = y.new_zeros(x.shape[0], *y.shape[1:])
+      logits.index_add_(0, index, y)
+    return logits / eot.eot_samples
+
+  @staticmethod
+  def backward(ctx, grad_output):
+    x, = ctx.saved_tensors
+    eot = ctx.eot
+    grad_output = grad_output / eot.eot_samples
+    grad = torch.zeros_like(x)
+    with torch.enable_grad():
+      x = x.detach().requires_grad_()
+      for index, x_noisy in eot.chunks(x, ctx.seed):
+        y = eot.model(x_noisy)
+        # only the gradient of the inputs, not of the model parameters
+        grad_x, = torch.autograd.grad(
+          y, x, grad_outputs=grad_output.index_select(0, index))
+        grad += grad_x
+    return grad, None, None
 
 
 class EOTWrapper(torch.nn.Module):
@@ -142,15 +386,31 @@ class EOTWrapper(torch.nn.Module):
     self.num_classes = num_classes
 
     self.eot_samples = params.eot_samples
+    # maximum number of noisy samples in a forward pass of the model, all
+    # the samples of the batch at once if null
+    self.chunk_size = getattr(params, 'eot_chunk_size', None)
     logging.info('Using EOT Samples {}'.format(self.eot_samples))
     self.noise = AddNoise(params)
+    self.generators = {}
 
-  def forward(self, x):
+  def chunks(self, x, seed):
+    """Yield the chunks of noisy samples with the indexes of their inputs,
+    the noise of the i-th chunk is sampled on the device with seed + i."""
     bs = x.shape[0]
-    x = torch.repeat_interleave(x, repeats=self.eot_samples, dim=0)
-    y = self.model(self.noise(x))
-    y = y.view(bs, self.eot_samples, self.num_classes)
-    return torch.mean(y, dim=1)
+    n_samples = bs * self.eot_samples
+    chunk_size = self.chunk_size or n_samples
+    if x.device not in self.generators:
+      self.generators[x.device] = torch.Generator(device=x.device)
+    generator = self.generators[x.device]
+    for i, start in enumerate(range(0, n_samples, chunk_size)):
+      index = torch.arange(
+        start, min(start + chunk_size, n_samples), device=x.device) % bs
+      generator.manual_seed(seed + i)
+      yield index, self.noise(x.index_select(0, index), generator)
+
+  def forward(self, x):
+    seed = int(torch.randint(2**62, (1,)))
+    return _EOTFunction.apply(x, self, seed)
 
 
 
@@ -189,12 +449,14 @@ class EMA:
   def __len__(self):
     return len(self.shadow)
 
-  def __call__(self, module, step=None):
+  def _decay(self, step):
     if step is None:
-      mu = self.mu
-    else:
-      # see: tensorflow doc ExponentialMovingAverage
-      mu = min(self.mu, (1. + step) / (10 + step))
+      return self.mu
+    # see: tensorflow doc ExponentialMovingAverage
+    return min(self.mu, (1. + step) / (10 + step))
+
+  def __call__(self, module, step=None):
+    mu = self._decay(step)
     for name, x in module.state_dict().items():
       if name in self.shadow:
         new_average = (1.0 - mu) * x + mu * self.shadow[name]
@@ -203,6 +465,116 @@ class EMA:
         self.shadow[name] = x.clone()
 
 
+class ShardedEMA(EMA):
+  """EMA whose shadow variables are split between the ranks.
+
+  The variables of the state dict are assigned to the ranks the first time
+  the EMA is updated, greedily by size. Each rank only keeps and updates the
+  shadow of its variables, `consolidated_state_dict` gathers the full shadow
+  on one rank.
+  """
+
+  def __init__(self, mu, rank, world_size):
+    super(ShardedEMA, self).__init__(mu)
+    self.rank = rank
+    self.world_size = world_size
+    self.owned = None
+
+  def _assign(self, state_dict):
+    sizes = [0] * self.world_size
+    owned = set()
+    items = sorted(state_dict.items(), key=lambda x: (-x[1].numel(), x[0]))
+    for name, x in items:
+      rank = sizes.index(min(sizes))
+      sizes[rank] += x.numel()
+      if rank == self.rank:
+        owned.add(name)
+    return owned
+
+  def __call__(self, module, step=None):
+    mu = self._decay(step)
+    state_dict = module.state_dict()
+    if self.owned is None:
+      self.owned = self._assign(state_dict)
+      # a shadow loaded from a checkpoint may hold all the variables
+      self.shadow = {name: x for name, x in self.shadow.items()
+                     if name in self.owned}
+    for name in self.owned:
+      x = state_dict[name]
+      if name in self.shadow:
+        new_average = (1.0 - mu) * x + mu * self.shadow[name]
+        self.shadow[name] = new_average.clone()
+      else:
+        self.shadow[name] = x.clone()
+
+  def consolidated_state_dict(self, dst=0):
+    """Gather the shadow of all the ranks on dst, return None on the other
+    ranks. Must be called by all the ranks."""
+    shadow = {name: x.cpu() for name, x in self.shadow.items()}
+    shadows = [None] * self.world_size if self.rank == dst else None
+    dist.gather_object(shadow, shadows, dst=dst)
+    if self.rank != dst:
+      return None
+    state_dict = {}
+    for shadow in shadows:
+      state_dict.update(shadow)
+    return state_dict
+
+
+class ClipGradNormCommHook:
+  """DDP communication hook which all-reduces the gradient buckets and
+  computes their squared norm as they are reduced.
+
+  The global norm of the averaged gradients is derived from the bucket norms
+  once backward is done, `clip_` then scales the gradients without
+  synchronizing with the host. It replaces `clip_grad_norm_` which recomputes
+  the norm of all the parameters after the all-reduce.
+  """
+
+  def __init__(self, max_norm, eps=1e-6):
+    self.max_norm = max_norm
+    self.eps = eps
+    self.sq_norms = []
+
+  def reset(self):
+    """Drop the norms of the buckets reduced by a previous backward."""
+    self.sq_norms = []
+
+  def _get_tensor(self, bucket):
+    # the GradBucket API changed across the versions of PyTorch, the older
+    # versions expect the hook to return a list of tensors
+    if hasattr(bucket, 'buffer'):
+      return bucket.buffer(), False
+    if hasattr(bucket, 'get_tensor'):
+      return bucket.get_tensor(), True
+    return bucket.get_tensors()[0], True
+
+  def __call__(self, process_group, bucket):
+    tensor, legacy = self._get_tensor(bucket)
+    group = process_group if process_group is not None else dist.group.WORLD
+    tensor.div_(dist.get_world_size(group))
+    fut = dist.all_reduce(tensor, group=group, async_op=True).get_future()
+
+    def compute_norm(fut):
+      reduced = fut.value()[0]
+      self.sq_norms.append(reduced.float().pow(2).sum())
+      return [reduced] if legacy else reduced
+    return fut.then(compute_norm)
+
+  def clip_(self, parameters):
+    """Scale the gradients by max_norm / total_norm if the norm is larger
+    than max_norm and return the total norm."""
+    grads = [p.grad.data for p in parameters if p.grad is not None]
+    if not self.sq_norms or not grads:
+      return None
+    total_norm = torch.stack(self.sq_norms).sum().sqrt()
+    self.reset()
+    clip_coef = (self.max_norm / (total_norm + self.eps)).clamp(max=1.0)
+    for grad in grads:
+      grad.mul_(clip_coef.to(grad.dtype))
+    return total_norm
+
+
 class GradualWarmupScheduler(_LRScheduler):
   """ Gradually warm-up(increasing) learning rate in optimizer.
   Proposed in 'Accurate, Large Minibatch SGD: Training ImageNet in 1 Hour'.
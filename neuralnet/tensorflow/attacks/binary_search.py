@@ -0,0 +1,161 @@
+"""State of the binary search over the constants of the CarliniWagnerL2 and
+ElasticNet attacks, kept on the device.
+"""
+import numpy as np
+import tensorflow as tf
+
+np_dtype = np.dtype('float32')
+tf_dtype = tf.as_dtype('float32')
+
+
+class BinarySearchState:
+  """
+  Keep the constants, the bounds of the binary search and the best
+  adversarial examples of a batch in variables, so that no data leaves the
+  device during the attack. The optimization loop of a binary search step
+  runs in a tf.while_loop whose loop variables hold the best results and the
+  early abort state (`read`, `assign`). The bookkeeping of all the samples
+  is done with vectorized masks:
+    - `update` records the best adversarial examples of an iteration,
+    - `abort` stops the optimization of the samples which do not make
+      progress anymore (early abort per sample),
+    - `update_const` moves the constants after a binary search step.
+  """
+
+  def __init__(self, shape, tlab, confidence=0, targeted=False,
+               initial_const=1e-2):
+    """
+    :param shape: shape of the batch of images.
+    :param tlab: variable with the one hot labels (or targets).
+    :param confidence: confidence of the adversarial examples.
+    :param targeted: whether the attack is targeted.
+    :param initial_const: initial tradeoff-constant of each sample.
+    """
+    batch_size = shape[0]
+    self.tlab = tlab
+    self.labels = tf.argmax(tlab, 1, output_type=tf.int32)
+    self.confidence = confidence
+    self.targeted = targeted
+    self.initial_const = initial_const
+
+    def variable(value, dtype, name):
+      return tf.Variable(value, dtype=dtype, name=name, trainable=False,
+                         use_resource=True)
+
+    # constants and bounds of the binary search
+    self.const = variable(np.zeros(batch_size), tf_dtype, 'const')
+    self.lower_bound = variable(np.zeros(batch_size), tf_dtype, 'lower_bound')
+    self.upper_bound = variable(np.zeros(batch_size), tf_dtype, 'upper_bound')
+    # best results of the current binary search step
+    self.bestdst = variable(np.zeros(batch_size), tf_dtype, 'bestdst')
+    self.bestscore = variable(np.zeros(batch_size), tf.int32, 'bestscore')
+    # best results over all the binary search steps
+    self.o_bestdst = variable(np.zeros(batch_size), tf_dtype, 'o_bestdst')
+    self.o_bestscore = variable(np.zeros(batch_size), tf.int32, 'o_bestscore')
+    self.o_bestattack = variable(np.zeros(shape), tf_dtype, 'o_bestattack')
+    # samples still optimized and their loss at the last check
+    self.active = variable(np.ones(batch_size, dtype=bool), tf.bool, 'active')
+    self.prev = variable(np.zeros(batch_size), tf_dtype, 'prev')
+
+    # state of the optimization loop of a binary search step
+    self.loop_variables = [
+      self.bestdst, self.bestscore, self.o_bestdst, self.o_bestscore,
+      self.o_bestattack, self.active, self.prev]
+
+    self.assign_oimg = tf.placeholder(tf_dtype, shape, name='assign_oimg')
+
+    # reset the search at the beginning of a batch
+    self.reset_batch = tf.group(
+      self.const.assign(tf.fill([batch_size], initial_const)),
+      self.lower_bound.assign(tf.zeros([batch_size])),
+      self.upper_bound.assign(tf.fill([batch_size], 1e10)),
+      self.o_bestdst.assign(tf.fill([batch_size], 1e10)),
+      self.o_bestscore.assign(tf.fill([batch_size], -1)),
+      self.o_bestattack.assign(self.assign_oimg))
+
+    # reset the best results at the beginning of a binary search step
+    self.reset_step = tf.group(
+      self.bestdst.assign(tf.fill([batch_size], 1e10)),
+      self.bestscore.assign(tf.fill([batch_size], -1)),
+      self.active.assign(tf.ones([batch_size], dtype=tf.bool)),
+      self.prev.assign(tf.fill([batch_size], 1e6)))
+
+    # the last binary search step (if we run many steps) repeats the search
+    # with the upper bound
+    self.const_to_upper = self.const.assign(self.upper_bound)
+
+    self.update_const = self._update_const()
+
+    found = tf.less(self.upper_bound, 1e9)
+    self.n_success = tf.reduce_sum(tf.cast(found, tf.int32))
+    self.mean_dst = tf.reduce_mean(
+      tf.sqrt(tf.boolean_mask(self.o_bestdst, tf.less(self.o_bestdst, 1e9))))
+
+  def _compare(self, predictions):
+    """Whether the predicted classes are adversarial."""
+    if self.targeted:
+      return tf.equal(predictions, self.labels)
+    return tf.not_equal(predictions, self.labels)
+
+  def read(self):
+    """Return the values of the loop variables."""
+    return tuple(x.read_value() for x in self.loop_variables)
+
+  def assign(self, state):
+    """Return the op saving the loop variables at the end of a loop."""
+    return tf.group(
+      *[x.assign(value) for x, value in zip(self.loop_variables, state)])
+
+  def update(self, state, dst, scores, adv):
+    """Record the adversarial examples `adv` whose distance `dst` is the
+    best so far, the logits are `scores`. Return the new loop variables, the
+    mask of the samples still optimized is `state[5]`."""
+    bestdst, bestscore, o_bestdst, o_bestscore, o_bestattack, active, prev = \
+        state
+    # the confidence is removed from the logits of the label (or target)
+    if self.targeted:
+      scores_conf = scores - self.confidence * self.tlab
+    else:
+      scores_conf = scores + self.confidence * self.tlab
+    success = self._compare(tf.argmax(scores_conf, 1, output_type=tf.int32))
+    predictions = tf.argmax(scores, 1, output_type=tf.int32)
+
+    improved = tf.logical_and(success, tf.less(dst, bestdst))
+    o_improved = tf.logical_and(success, tf.less(dst, o_bestdst))
+    return (
+      tf.where(improved, dst, bestdst),
+      tf.where(improved, predictions, bestscore),
+      tf.where(o_improved, dst, o_bestdst),
+      tf.where(o_improved, predictions, o_bestscore),
+      tf.where(o_improved, adv, o_bestattack),
+      active, prev)
+
+  def abort(self, state, loss, check):
+    """If `check` is True, stop the samples whose loss did not decrease
+    since the last check. Return the new loop variables."""
+    active, prev = state[5:]
+    check = tf.fill(tf.shape(loss), check)
+    progress = tf.less_equal(loss, prev * .9999)
+    active = tf.logical_and(
+      active, tf.logical_or(tf.logical_not(check), progress))
+    prev = tf.where(check, loss, prev)
+    return state[:5] + (active, prev)
+
+  def _update_const(self):
+    """Divide the constants of the successful samples by two, multiply the
+    others by 10 if no solution was found yet, or do the binary search with
+    the known upper bound."""
+    success = tf.logical_and(
+      self._compare(self.bestscore), tf.not_equal(self.bestscore, -1))
+    upper_bound = tf.where(
+      success, tf.minimum(self.upper_bound, self.const), self.upper_bound)
+    lower_bound = tf.where(
+      success, self.lower_bound, tf.maximum(self.lower_bound, self.const))
+    const = tf.where(
+      tf.less(upper_bound, 1e9), (lower_bound + upper_bound) / 2,
+      tf.where(success, self.const, self.const * 10))
+    with tf.control_dependencies([upper_bound, lower_bound, const]):
+      return tf.group(
+        self.upper_bound.assign(upper_bound),
+        self.lower_bound.assign(lower_bound),
+        self.const.assign(const))
@@ -4,6 +4,8 @@ import logging
 import numpy as np
 import tensorflow as tf
 
+from .binary_search import BinarySearchState
+
 np_dtype = np.dtype('float32')
 tf_dtype = tf.as_dtype('float32')
 
@@ -102,27 +104,22 @@ class CarliniWagnerL2:
     shape = x.get_shape().as_list()[1:]
     self.shape = shape = tuple([self.batch_size] + list(shape))
 
-    # the variable we're going to optimize over
-    modifier = tf.Variable(np.zeros(shape, dtype=np_dtype))
-
     # these are variables to be more efficient in sending data to tf
     self.timg = tf.Variable(np.zeros(shape), dtype=tf_dtype, name='timg')
     self.tlab = tf.Variable(
         np.zeros((self.batch_size, nb_classes)), dtype=tf_dtype, name='tlab')
-    self.const = tf.Variable(
-        np.zeros(self.batch_size), dtype=tf_dtype, name='const')
 
     # and here's what we use to assign them
     self.assign_timg = tf.placeholder(tf_dtype, shape, name='assign_timg')
     self.assign_tlab = tf.placeholder(
         tf_dtype, (self.batch_size, nb_classes), name='assign_tlab')
-    self.assign_const = tf.placeholder(
-        tf_dtype, [self.batch_size], name='assign_const')
 
-    # the resulting instance, tanh'd to keep bounded from clip_min
-    # to clip_max
-    self.newimg = (tf.tanh(modifier + self.timg) + 1) / 2
-    self.newimg = self.newimg * (self.clip_max - self.clip_min) + self.clip_min
+    # the constants, bounds and best results of the binary search stay on
+    # the device
+    self.search = BinarySearchState(
+      shape, self.tlab, confidence=self.confidence,
+      targeted=bool(self.y_target), initial_const=self.initial_const)
+    self.const = self.search.const
 
     # prediction BEFORE-SOFTMAX of the model
     def batch_prediction(img):
@@ -138,62 +135,86 @@ class CarliniWagnerL2:
       output = tf.reduce_mean(logits, axis=1)
       return output
 
-    if self.sample <= 1:
-      self.output = fn_logits(self.newimg)
-    else:
+    if self.sample > 1:
       tf.logging.info(
         "Monte Carlo (MC) on attacks, sample: {}".format(self.sample))
       tf.logging.info("batch_size: {}".format(self.batch_size))
-      self.output = batch_prediction(self.newimg)
-      # _, *shape_img = self.newimg.shape.as_list()
-      # self.newimg_sample = tf.layers.flatten(self.newimg)
-      # _, dim = self.newimg_sample.shape.as_list()
-      # self.newimg_sample = tf.tile(
-      #   self.newimg_sample, (1, self.sample))
-      # self.newimg_sample = tf.reshape(
-      #   self.newimg_sample, (self.batch_size*self.sample, *shape_img))
-      # logits = fn_logits(self.newimg_sample)
-      # assert logits.op.type != 'Softmax'
-      # _, dim = logits.shape.as_list()
-      # logits = tf.reshape(logits, (self.batch_size, self.sample, dim))
-      # self.output = tf.reduce_mean(logits, axis=1)
 
     # distance to the input data
     self.other = (tf.tanh(self.timg) + 1) / \
         2 * (self.clip_max - self.clip_min) + self.clip_min
-    self.l2dist = tf.reduce_sum(
-        tf.square(self.newimg - self.other), list(range(1, len(shape))))
-
-    # compute the probability of the label class versus the maximum other
-    real = tf.reduce_sum((self.tlab) * self.output, 1)
-    other = tf.reduce_max((1 - self.tlab) * self.output - self.tlab * 10000, 1)
-    zero = np.asarray(0., dtype=np_dtype)
-    if self.y_target:
-      # if targeted, optimize for making the other class most likely
-      loss1 = tf.maximum(zero, other - real + self.confidence)
-    else:
-      # if untargeted, optimize for making this class least likely.
-      loss1 = tf.maximum(zero, real - other + self.confidence)
-
-    # sum up the losses
-    self.loss2 = tf.reduce_sum(self.l2dist)
-    self.loss1 = tf.reduce_sum(self.const * loss1)
-    self.loss = self.loss1 + self.loss2
-
-    # Setup the adam optimizer and keep track of variables we're creating
-    start_vars = set(x.name for x in tf.global_variables())
-    optimizer = tf.train.AdamOptimizer(self.learning_rate)
-    self.train = optimizer.minimize(self.loss, var_list=[modifier])
-    end_vars = tf.global_variables()
-    new_vars = [x for x in end_vars if x.name not in start_vars]
+
+    def iteration(modifier):
+      """Return the image, the logits, the distance and the loss of each
+      sample for a modifier."""
+      # the resulting instance, tanh'd to keep bounded from clip_min
+      # to clip_max
+      newimg = (tf.tanh(modifier + self.timg) + 1) / 2
+      newimg = newimg * (self.clip_max - self.clip_min) + self.clip_min
+      if self.sample <= 1:
+        output = fn_logits(newimg)
+      else:
+        output = batch_prediction(newimg)
+      l2dist = tf.reduce_sum(
+          tf.square(newimg - self.other), list(range(1, len(shape))))
+
+      # compute the probability of the label class versus the maximum other
+      real = tf.reduce_sum((self.tlab) * output, 1)
+      other = tf.reduce_max((1 - self.tlab) * output - self.tlab * 10000, 1)
+      zero = np.asarray(0., dtype=np_dtype)
+      if self.y_target:
+        # if targeted, optimize for making the other class most likely
+        loss1 = tf.maximum(zero, other - real + self.confidence)
+      else:
+        # if untargeted, optimize for making this class least likely.
+        loss1 = tf.maximum(zero, real - other + self.confidence)
+      return newimg, output, l2dist, self.const * loss1 + l2dist
+
+    check_every = (self.max_iterations // 10) or 1
+    beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+
+    def cond(i, modifier, m, v, *state):
+      return tf.logical_and(tf.less(i, self.max_iterations),
+                            tf.reduce_any(state[5]))
+
+    def body(i, modifier, m, v, *state):
+      newimg, output, l2dist, loss_batch = iteration(modifier)
+      grad, = tf.gradients(tf.reduce_sum(loss_batch), modifier)
+
+      # the best results are recorded with the values before the step
+      state = self.search.update(state, l2dist, output, newimg)
+
+      # perform the attack, an Adam step, the samples stopped by the early
+      # abort keep their modifier
+      t = tf.cast(i + 1, tf_dtype)
+      m = beta1 * m + (1 - beta1) * grad
+      v = beta2 * v + (1 - beta2) * tf.square(grad)
+      lr = self.learning_rate * tf.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
+      modifier = tf.where(
+        state[5], modifier - lr * m / (tf.sqrt(v) + epsilon), modifier)
+
+      # check if we should abort search if we're getting nowhere, the
+      # samples which do not make progress are stopped
+      if self.abort_early:
+        state = self.search.abort(
+          state, loss_batch, tf.equal(i % check_every, 0))
+      return (i + 1, modifier, m, v) + tuple(state)
+
+    # all the iterations of a binary search step run in a single loop on the
+    # device, adam's internal state starts from zero at each step
+    zeros = tf.zeros(shape, dtype=tf_dtype)
+    loop_vars = (tf.constant(0), zeros, zeros, zeros) + self.search.read()
+    outputs = tf.while_loop(cond, body, loop_vars, back_prop=False)
+    self.optimize = self.search.assign(outputs[4:])
 
     # these are the variables to initialize when we run
     self.setup = []
     self.setup.append(self.timg.assign(self.assign_timg))
     self.setup.append(self.tlab.assign(self.assign_tlab))
-    self.setup.append(self.const.assign(self.assign_const))
+    self.setup.append(self.search.reset_batch)
 
-    self.init = tf.variables_initializer(var_list=[modifier] + new_vars)
+    # reset the best results of the step
+    self.init = self.search.reset_step
 
     # wrap attack function in py_func
     def cw_wrap(x_val, y_val):
@@ -221,22 +242,10 @@ class CarliniWagnerL2:
 
   def attack_batch(self, imgs, labs):
     """
-    Run the attack on a batch of instance and labels.
+    Run the attack on a batch of instance and labels. The state of the
+    binary search is kept on the device, only the best adversarial examples
+    are fetched at the end.
     """
-
-    def compare(x, y):
-      if not isinstance(x, (float, int, np.int64)):
-        x = np.copy(x)
-        if self.y_target:
-          x[y] -= self.confidence
-        else:
-          x[y] += self.confidence
-        x = np.argmax(x)
-      if self.y_target:
-        return x == y
-      else:
-        return x != y
-
     batch_size = self.batch_size
 
     oimgs = np.clip(imgs, self.clip_min, self.clip_max)
@@ -249,102 +258,42 @@ class CarliniWagnerL2:
     # convert to tanh-space
     imgs = np.arctanh(imgs * .999999)
 
-    # set the lower and upper bounds accordingly
-    lower_bound = np.zeros(batch_size)
-    CONST = np.ones(batch_size) * self.initial_const
-    upper_bound = np.ones(batch_size) * 1e10
-
-    # placeholders for the best l2, score, and instance attack found so far
-    o_bestl2 = [1e10] * batch_size
-    o_bestscore = [-1] * batch_size
-    o_bestattack = np.copy(oimgs)
+    # set the variables so that we don't have to send them over again
+    self.sess.run(
+        self.setup, {
+            self.assign_timg: imgs[:batch_size],
+            self.assign_tlab: labs[:batch_size],
+            self.search.assign_oimg: oimgs[:batch_size]
+        })
 
     for outer_step in range(self.binary_search_steps):
-      # completely reset adam's internal state.
+      # reset the best results of the step
       self.sess.run(self.init)
-      batch = imgs[:batch_size]
-      batchlab = labs[:batch_size]
-
-      bestl2 = [1e10] * batch_size
-      bestscore = [-1] * batch_size
       logging.debug("  Binary search step %s of %s",
                     outer_step, self.binary_search_steps)
 
       # The last iteration (if we run many steps) repeat the search once.
       if self.repeat and outer_step == self.binary_search_steps - 1:
-        CONST = upper_bound
-
-      # set the variables so that we don't have to send them over again
-      self.sess.run(
-          self.setup, {
-              self.assign_timg: batch,
-              self.assign_tlab: batchlab,
-              self.assign_const: CONST
-          })
-
-      prev = 1e6
-      for iteration in range(self.max_iterations):
-        # perform the attack
-        _, l, l2s, scores, nimg = self.sess.run([
-            self.train, self.loss, self.l2dist, self.output,
-            self.newimg
-        ])
-
-        if iteration % ((self.max_iterations // 10) or 1) == 0:
-          logging.debug(("    Iteration {} of {}: loss={:.3g} " +
-                         "l2={:.3g} f={:.3g}").format(
-                             iteration, self.max_iterations, l,
-                             np.mean(l2s), np.mean(scores)))
-
-        # check if we should abort search if we're getting nowhere.
-        if self.abort_early and \
-           iteration % ((self.max_iterations // 10) or 1) == 0:
-          if l > prev * .9999:
-            msg = "    Failed to make progress; stop early"
-            logging.debug(msg)
-            break
-          prev = l
-
-        # adjust the best result found so far
-        for e, (l2, sc, ii) in enumerate(zip(l2s, scores, nimg)):
-          lab = np.argmax(batchlab[e])
-          if l2 < bestl2[e] and compare(sc, lab):
-            bestl2[e] = l2
-            bestscore[e] = np.argmax(sc)
-          if l2 < o_bestl2[e] and compare(sc, lab):
-            o_bestl2[e] = l2
-            o_bestscore[e] = np.argmax(sc)
-            o_bestattack[e] = ii
+        self.sess.run(self.search.const_to_upper)
+
+      # perform the attack, all the iterations run in the graph
+      self.sess.run(self.optimize)
 
       # adjust the constant as needed
-      for e in range(batch_size):
-        if compare(bestscore[e], np.argmax(batchlab[e])) and \
-           bestscore[e] != -1:
-          # success, divide const by two
-          upper_bound[e] = min(upper_bound[e], CONST[e])
-          if upper_bound[e] < 1e9:
-            CONST[e] = (lower_bound[e] + upper_bound[e]) / 2
-        else:
-          # failure, either multiply by 10 if no solution found yet
-          #          or do binary search with the known upper bound
-          lower_bound[e] = max(lower_bound[e], CONST[e])
-          if upper_bound[e] < 1e9:
-            CONST[e] = (lower_bound[e] + upper_bound[e]) / 2
-          else:
-            CONST[e] *= 10
-      logging.debug("  Successfully generated adversarial examples " +
-                    "on {} of {} instances.".format(
-                        sum(upper_bound < 1e9), batch_size))
-      o_bestl2 = np.array(o_bestl2)
-      mean = np.mean(np.sqrt(o_bestl2[o_bestl2 < 1e9]))
-      logging.debug("   Mean successful distortion: {:.4g}".format(mean))
+      self.sess.run(self.search.update_const)
+      if logging.getLogger().isEnabledFor(logging.DEBUG):
+        n_success, mean = self.sess.run(
+          [self.search.n_success, self.search.mean_dst])
+        logging.debug("  Successfully generated adversarial examples " +
+                      "on {} of {} instances.".format(n_success, batch_size))
+        logging.debug("   Mean successful distortion: {:.4g}".format(mean))
 
     # return the best solution found
+    o_bestattack, n_success, mean = self.sess.run(
+      [self.search.o_bestattack, self.search.n_success,
+       self.search.mean_dst])
     logging.info("  Successfully generated adversarial examples " +
-                  "on {} of {} instances.".format(
-                      sum(upper_bound < 1e9), batch_size))
-    o_bestl2 = np.array(o_bestl2)
-    mean = np.mean(np.sqrt(o_bestl2[o_bestl2 < 1e9]))
+                  "on {} of {} instances.".format(n_success, batch_size))
     logging.info("   Mean successful distortion: {:.4g}".format(mean))
     return o_bestattack
 
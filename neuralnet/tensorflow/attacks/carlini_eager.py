@@ -1,7 +1,6 @@
 """The CarliniWagnerL2 attack
 """
 import logging
-import numpy as np
 import tensorflow as tf
 import tensorflow.contrib.eager as tfe
 
@@ -84,6 +83,10 @@ class CarliniWagnerL2:
 
   def generate(self, x, fn_logits, y=None):
     self.fn_logits = fn_logits
+    # the whole attack is compiled in a graph function, the iterations run
+    # in a tf.while_loop and only the adversarial examples and their
+    # distances leave the device
+    self.attack_fn = tfe.defun(self._attack)
     # wrap attack function in py_func
     def cw_wrap(x_val):
       return self.attack(x_val)
@@ -93,216 +96,175 @@ class CarliniWagnerL2:
 
   def attack(self, imgs):
     """
-    Return a tensor that constructs adversarial examples for the given
-    input. Generate uses tf.py_func in order to operate over tensors.
-    :param x: A tensor with the inputs.
-    :param kwargs: See `parse_params`
+    Return the adversarial examples of a batch of images.
+    :param imgs: A tensor with the inputs.
     """
     imgs = tf.cast(imgs, tf.float32)
-    preds = self.fn_logits(imgs)
-    preds_max = tf.reduce_max(preds, 1, keepdims=True)
-    original_predictions = tf.to_float(tf.equal(preds, preds_max))
-    labs = tf.stop_gradient(original_predictions)
-    repeat = self.binary_search_steps >= 10
-    shape = tf.shape(imgs)
-
-    # # the variable we're going to optimize over
-    # modifier = tfe.Variable(tf.zeros(shape, dtype=tf_dtype))
-
-    def compute_newimage(imgs, modifier):
-      # the resulting instance, tanh'd to keep bounded from clip_min
-      # to clip_max
-      newimg = (tf.tanh(modifier + imgs) + 1) / 2
-      newimg = newimg * (self.clip_max - self.clip_min) + self.clip_min
-      return newimg
+    o_bestattack, o_bestl2, upper_bound = self.attack_fn(imgs)
 
-    def get_l2dist(imgs, newimg):
+    # return the best solution found
+    batch_size = imgs.get_shape().as_list()[0]
+    success = tf.reduce_sum(tf.cast(tf.less(upper_bound, 1e9), tf.int32))
+    logging.info("  Successfully generated adversarial examples " +
+                 "on {} of {} instances.".format(success.numpy(), batch_size))
+    mask = tf.less(o_bestl2, 1e9)
+    mean = tf.reduce_mean(tf.sqrt(tf.boolean_mask(o_bestl2, mask)))
+    logging.info("   Mean successful distortion: {:.4g}".format(mean.numpy()))
+    return o_bestattack
+
+  def _logits(self, img):
+    # prediction BEFORE-SOFTMAX of the model
+    if self.sample <= 1:
+      return self.fn_logits(img)
+    logits = [self.fn_logits(img) for _ in range(self.sample)]
+    return tf.reduce_mean(tf.stack(logits), 0)
+
+  def _newimg(self, timg, modifier):
+    # the resulting instance, tanh'd to keep bounded from clip_min
+    # to clip_max
+    newimg = (tf.tanh(modifier + timg) + 1) / 2
+    return newimg * (self.clip_max - self.clip_min) + self.clip_min
+
+  def _compare(self, predictions, labels):
+    if self.y_target:
+      return tf.equal(predictions, labels)
+    return tf.not_equal(predictions, labels)
+
+  def _optimize(self, timg, tlab, const, best):
+    """Run the iterations of a binary search step in a tf.while_loop.
+
+    Adam is written with the loop variables so no variable is created in
+    the loop. The samples are stopped by the early abort separately and the
+    best results are updated with vectorized masks.
+    :param best: (o_bestl2, o_bestscore, o_bestattack) of the previous steps.
+    :return: the best score of the step and the new best results.
+    """
+    batch_size = tf.shape(timg)[0]
+    labels = tf.argmax(tlab, 1, output_type=tf.int32)
+    other = self._newimg(timg, tf.zeros_like(timg))
+    sum_axis = list(range(1, timg.get_shape().ndims))
+    check_every = (self.max_iterations // 10) or 1
+    beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+
+    def cond(i, *args):
+      active = args[-1]
+      return tf.logical_and(tf.less(i, self.max_iterations),
+                            tf.reduce_any(active))
+
+    def body(i, modifier, m, v, bestl2, bestscore, o_bestl2, o_bestscore,
+             o_bestattack, prev, active):
+      newimg = self._newimg(timg, modifier)
+      output = self._logits(newimg)
       # distance to the input data
-      other = (tf.tanh(imgs) + 1) / 2 * (self.clip_max - self.clip_min) + self.clip_min
-      sum_axis = list(range(1, len(shape.numpy())))
       l2dist = tf.reduce_sum(tf.square(newimg - other), sum_axis)
-      return l2dist
-
-    def loss(timg, tlab, const, modifier):
-      newimg = compute_newimage(timg, modifier)
-      # prediction BEFORE-SOFTMAX of the model
-      if self.sample <= 1:
-        output = self.fn_logits(newimg)
-      else:
-        logging.info(
-          "Monte Carlo (MC) on attacks, sample: {}".format(self.sample))
-        for i in range(self.sample):
-          logits = self.fn_logits(newimg)
-          if i == 0:
-            assert logits.op.type != 'Softmax'
-          output.append(logits)
-        output = tf.reduct_mean(output, 0)
-
-      # distantce to the input data
-      l2dist = get_l2dist(timg, newimg)
 
       # compute the probability of the label class versus the maximum other
-      real_target = tf.reduce_sum((tlab) * output, 1)
-      other_target = tf.reduce_max((1 - tlab) * output - tlab * 10000, 1)
-      zero = tf.constant(0., dtype=tf_dtype)
+      real = tf.reduce_sum(tlab * output, 1)
+      other_max = tf.reduce_max((1 - tlab) * output - tlab * 10000, 1)
       if self.y_target:
         # if targeted, optimize for making the other class most likely
-        loss1 = tf.maximum(zero, other_target - real_target + self.confidence)
+        loss1 = tf.maximum(0., other_max - real + self.confidence)
       else:
         # if untargeted, optimize for making this class least likely.
-        loss1 = tf.maximum(zero, real_target - other_target + self.confidence)
-
-      # sum up the losses
-      loss2 = tf.reduce_sum(l2dist)
-      loss1 = tf.reduce_sum(const * loss1)
-      loss = loss1 + loss2
-      return loss, output
+        loss1 = tf.maximum(0., real - other_max + self.confidence)
+      loss = const * loss1 + l2dist
+      grad, = tf.gradients(tf.reduce_sum(loss), modifier)
 
-
-    def grad(imgs, labs, const, modifier):
-      with tf.GradientTape(watch_accessed_variables=False) as tape:
-        tape.watch(modifier)
-        loss_value, logits = loss(imgs, labs, const, modifier)
-        with tape.stop_recording():
-          gradients = tape.gradient(loss_value, [modifier])
-      return gradients, loss_value, logits
-
-
-    def compare_multi(x, y):
-      x_array = tf.unstack(x)
-      if self.y_target:
-        x_array[y] = x_array[y] - self.confidence
-      else:
-        x_array[y] = x_array[y] + self.confidence
-      x = tf.argmax(tf.stack(x_array))
+      # adjust the best result found so far
       if self.y_target:
-        return x == y
+        scores = output - self.confidence * tlab
       else:
-        return x != y
-
-    def compare_single(x, y):
-      if self.y_target:
-        return x == y
-      else:
-        return x != y
-
-
-    # batch_size = tf.shape(imgs)[0]
-    batch_size = imgs.get_shape().as_list()[0]
+        scores = output + self.confidence * tlab
+      success = self._compare(
+        tf.argmax(scores, 1, output_type=tf.int32), labels)
+      predictions = tf.argmax(output, 1, output_type=tf.int32)
+      improved = tf.logical_and(success, tf.less(l2dist, bestl2))
+      o_improved = tf.logical_and(success, tf.less(l2dist, o_bestl2))
+      bestl2 = tf.where(improved, l2dist, bestl2)
+      bestscore = tf.where(improved, predictions, bestscore)
+      o_bestl2 = tf.where(o_improved, l2dist, o_bestl2)
+      o_bestscore = tf.where(o_improved, predictions, o_bestscore)
+      o_bestattack = tf.where(o_improved, newimg, o_bestattack)
+
+      # perform the attack, an Adam step on the active samples
+      t = tf.cast(i + 1, tf_dtype)
+      m = beta1 * m + (1 - beta1) * grad
+      v = beta2 * v + (1 - beta2) * tf.square(grad)
+      lr = self.learning_rate * tf.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
+      new_modifier = modifier - lr * m / (tf.sqrt(v) + epsilon)
+      modifier = tf.where(active, new_modifier, modifier)
+
+      # check if we should abort search if we're getting nowhere, the
+      # samples which do not make progress are stopped
+      if self.abort_early:
+        check = tf.fill([batch_size], tf.equal(i % check_every, 0))
+        progress = tf.less_equal(loss, prev * .9999)
+        active = tf.logical_and(
+          active, tf.logical_or(tf.logical_not(check), progress))
+        prev = tf.where(check, loss, prev)
+      return (i + 1, modifier, m, v, bestl2, bestscore, o_bestl2,
+              o_bestscore, o_bestattack, prev, active)
+
+    zeros = tf.zeros_like(timg)
+    loop_vars = (
+      tf.constant(0), zeros, zeros, zeros,
+      tf.fill([batch_size], 1e10), tf.fill([batch_size], -1)) + \
+      tuple(best) + (
+      tf.fill([batch_size], 1e6), tf.ones([batch_size], dtype=tf.bool))
+    outputs = tf.while_loop(cond, body, loop_vars, back_prop=False)
+    bestscore = outputs[5]
+    return bestscore, outputs[6:9]
+
+  def _attack(self, imgs):
+    """Run the binary search over the constants, return the best
+    adversarial examples, their distances and the upper bounds of the
+    constants."""
+    preds = self.fn_logits(imgs)
+    preds_max = tf.reduce_max(preds, 1, keepdims=True)
+    labs = tf.stop_gradient(tf.to_float(tf.equal(preds, preds_max)))
+    labels = tf.argmax(labs, 1, output_type=tf.int32)
+    repeat = self.binary_search_steps >= 10
+    batch_size = tf.shape(imgs)[0]
 
+    oimgs = tf.clip_by_value(imgs, self.clip_min, self.clip_max)
     # re-scale instances to be within range [0, 1]
-    imgs = (imgs - self.clip_min) / (self.clip_max - self.clip_min)
-    imgs = tf.clip_by_value(imgs, 0, 1)
+    timg = (imgs - self.clip_min) / (self.clip_max - self.clip_min)
+    timg = tf.clip_by_value(timg, 0, 1)
     # now convert to [-1, 1]
-    imgs = (imgs * 2) - 1
+    timg = (timg * 2) - 1
     # convert to tanh-space
-    imgs = tf.atanh(imgs * .999999)
+    timg = tf.atanh(timg * .999999)
 
     # set the lower and upper bounds accordingly
-    lower_bound = tfe.Variable(tf.zeros(batch_size), trainable=False)
-    const = tfe.Variable(tf.ones(batch_size) * self.initial_const, trainable=False)
-    upper_bound = tfe.Variable(tf.ones(batch_size) * 1e10, trainable=False)
+    lower_bound = tf.zeros([batch_size])
+    const = tf.fill([batch_size], self.initial_const)
+    upper_bound = tf.fill([batch_size], 1e10)
 
-    # placeholders for the best l2, score, and instance attack found so far
-    o_bestl2 = tfe.Variable(tf.constant(1e10, shape=(batch_size, )), trainable=False)
-    o_bestscore = tfe.Variable(tf.constant(-1, shape=(batch_size, )), trainable=False)
-    o_bestattack = tfe.Variable(tf.identity(imgs), trainable=False)
+    # the best l2, score, and instance attack found so far
+    best = (tf.fill([batch_size], 1e10), tf.fill([batch_size], -1), oimgs)
 
     for outer_step in range(self.binary_search_steps):
-
-      # completely reset adam's internal state.
-      modifier = tfe.Variable(tf.zeros(shape, dtype=tf_dtype))
-      optimizer = tf.train.AdamOptimizer(self.learning_rate)
-
-      bestl2 = tfe.Variable(tf.constant(1e10, shape=(batch_size, )), trainable=False)
-      bestscore = tfe.Variable(tf.constant(-1, shape=(batch_size, )), trainable=False)
-      logging.info("  Binary search step %s of %s",
-                    outer_step, self.binary_search_steps)
-
       # The last iteration (if we run many steps) repeat the search once.
       if repeat and outer_step == self.binary_search_steps - 1:
         const = upper_bound
 
-      prev = 1e6
-      for iteration in range(self.max_iterations):
-
-        import resource, gc
-        mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-        logging.info('resource {}'.format(mem))
-        gc.collect()
-
-        tf.set_random_seed(np.random.randint(0, 100))
-
-        # perform the attack
-        gradients, loss_value, scores = grad(imgs, labs, const, modifier)
-        optimizer.apply_gradients(zip(gradients, [modifier]))
-
-        nimg = compute_newimage(imgs, modifier)
-        l2s = get_l2dist(imgs, nimg)
-
-        if iteration % ((self.max_iterations // 10) or 1) == 0 and \
-           logging.get_verbosity() == logging.DEBUG:
-          l2_mean = tf.reduce_mean(l2s).numpy()
-          logging.debug(
-            "    Iteration {} of {}: loss={:.3g} l2={:.3g}".format(
-              iteration, self.max_iterations, loss_value, l2_mean))
-
-        # check if we should abort search if we're getting nowhere.
-        if self.abort_early and \
-           iteration % ((self.max_iterations // 10) or 1) == 0:
-          if loss_value > prev * .9999:
-            logging.debug("    Failed to make progress; stop early" )
-            break
-          prev = loss_value
-
-        # adjust the best result found so far
-        for e, (l2, sc, ii) in enumerate(zip(l2s, scores, nimg)):
-          lab = tf.argmax(labs[e])
-          comp = compare_multi(sc, lab)
-          if l2 < bestl2[e] and comp:
-            bestl2[e].assign(l2)
-            bestscore[e].assign(tf.argmax(sc, output_type=tf.int32))
-          if l2 < o_bestl2[e] and comp:
-            o_bestl2[e].assign(l2)
-            o_bestscore[e].assign(tf.argmax(sc, output_type=tf.int32))
-            o_bestattack[e].assign(ii)
-
-      # adjust the constant as needed
-      for e in range(batch_size):
-        if compare_single(bestscore[e], tf.argmax(labs[e])) and bestscore[e] != -1:
-          # success, divide const by two
-          upper_bound[e].assign(tf.minimum(upper_bound[e], const[e]))
-          if upper_bound[e] < 1e9:
-            const[e].assign((lower_bound[e] + upper_bound[e]) / 2)
-        else:
-          # failure, either multiply by 10 if no solution found yet
-          #          or do binary search with the known upper bound
-          lower_bound[e].assign(tf.maximum(lower_bound[e], const[e]))
-          if upper_bound[e] < 1e9:
-            const[e].assign((lower_bound[e] + upper_bound[e]) / 2)
-          else:
-            const[e].assign(const[e]*10)
-
-      if logging.get_verbosity() == logging.DEBUG:
-        success = tf.cast(tf.less(upper_bound, 1e9), tf.int32)
-        logging.debug("  Successfully generated adversarial examples " +
-                      "on {} of {} instances.".format(
-                          tf.reduce_sum(success), batch_size))
-
-        mask = tf.less(o_bestl2, 1e9)
-        mean = tf.reduce_mean(tf.sqrt(tf.boolean_mask(o_bestl2, mask)))
-        logging.debug("   Mean successful distortion: {:.4g}".format(mean.numpy()))
-
-    # return the best solution found
-    success = tf.cast(tf.less(upper_bound, 1e9), tf.int32)
-    logging.info("  Successfully generated adversarial examples " +
-                 "on {} of {} instances.".format(
-                      tf.reduce_sum(success), batch_size))
-
-    mask = tf.less(o_bestl2, 1e9)
-    mean = tf.reduce_mean(tf.sqrt(tf.boolean_mask(o_bestl2, mask)))
-    logging.info("   Mean successful distortion: {:.4g}".format(mean.numpy()))
-    return o_bestattack.read_value()
+      bestscore, best = self._optimize(timg, labs, const, best)
+
+      # adjust the constant as needed: divide const by two on success,
+      # on failure, either multiply by 10 if no solution found yet or do
+      # binary search with the known upper bound
+      success = tf.logical_and(
+        self._compare(bestscore, labels), tf.not_equal(bestscore, -1))
+      upper_bound = tf.where(
+        success, tf.minimum(upper_bound, const), upper_bound)
+      lower_bound = tf.where(
+        success, lower_bound, tf.maximum(lower_bound, const))
+      const = tf.where(
+        tf.less(upper_bound, 1e9), (lower_bound + upper_bound) / 2,
+        tf.where(success, const, const * 10))
+
+    o_bestl2, _, o_bestattack = best
+    return o_bestattack, o_bestl2, upper_bound
 
 
 
@@ -4,6 +4,7 @@ import logging
 import numpy as np
 import tensorflow as tf
 
+from .binary_search import BinarySearchState
 
 np_dtype = np.dtype('float32')
 tf_dtype = tf.as_dtype('float32')
@@ -107,7 +108,6 @@ class ElasticNet:
     nb_classes = labels.get_shape().as_list()[1]
 
     batch_size = self.batch_size
-    self.LEARNING_RATE = self.learning_rate
     self.beta_t = tf.cast(self.beta, tf_dtype)
 
     # the session is passed after
@@ -120,56 +120,20 @@ class ElasticNet:
 
     # these are variables to be more efficient in sending data to tf
     self.timg = tf.Variable(np.zeros(shape), dtype=tf_dtype, name='timg')
-    self.newimg = tf.Variable(
-        np.zeros(shape), dtype=tf_dtype, name='newimg')
-    self.slack = tf.Variable(
-        np.zeros(shape), dtype=tf_dtype, name='slack')
     self.tlab = tf.Variable(
         np.zeros((batch_size, nb_classes)), dtype=tf_dtype, name='tlab')
-    self.const = tf.Variable(
-        np.zeros(batch_size), dtype=tf_dtype, name='const')
+
+    # the constants, bounds and best results of the binary search stay on
+    # the device
+    self.search = BinarySearchState(
+      shape, self.tlab, confidence=self.confidence,
+      targeted=bool(self.y_target), initial_const=self.initial_const)
+    self.const = self.search.const
 
     # and here's what we use to assign them
     self.assign_timg = tf.placeholder(tf_dtype, shape, name='assign_timg')
-    self.assign_newimg = tf.placeholder(
-        tf_dtype, shape, name='assign_newimg')
-    self.assign_slack = tf.placeholder(
-        tf_dtype, shape, name='assign_slack')
     self.assign_tlab = tf.placeholder(
         tf_dtype, (batch_size, nb_classes), name='assign_tlab')
-    self.assign_const = tf.placeholder(
-        tf_dtype, [batch_size], name='assign_const')
-
-    self.global_step = tf.Variable(0, trainable=False)
-    self.global_step_t = tf.cast(self.global_step, tf_dtype)
-
-    # Fast Iterative Shrinkage Thresholding
-    self.zt = tf.divide(self.global_step_t,
-                        self.global_step_t + tf.cast(3, tf_dtype))
-    cond1 = tf.cast(tf.greater(tf.subtract(self.slack, self.timg),
-                               self.beta_t), tf_dtype)
-    cond2 = tf.cast(tf.less_equal(tf.abs(tf.subtract(self.slack,
-                                                     self.timg)),
-                                  self.beta_t), tf_dtype)
-    cond3 = tf.cast(tf.less(tf.subtract(self.slack, self.timg),
-                            tf.negative(self.beta_t)), tf_dtype)
-
-    upper = tf.minimum(tf.subtract(self.slack, self.beta_t),
-                       tf.cast(self.clip_max, tf_dtype))
-    lower = tf.maximum(tf.add(self.slack, self.beta_t),
-                       tf.cast(self.clip_min, tf_dtype))
-
-    self.assign_newimg = tf.multiply(cond1, upper)
-    self.assign_newimg += tf.multiply(cond2, self.timg)
-    self.assign_newimg += tf.multiply(cond3, lower)
-
-    self.assign_slack = self.assign_newimg
-    self.assign_slack += tf.multiply(self.zt,
-                                     self.assign_newimg - self.newimg)
-
-    # --------------------------------
-    self.setter = tf.assign(self.newimg, self.assign_newimg)
-    self.setter_y = tf.assign(self.slack, self.assign_slack)
 
     # prediction BEFORE-SOFTMAX of the model
     def batch_prediction(img):
@@ -185,88 +149,118 @@ class ElasticNet:
       output = tf.reduce_mean(logits, axis=1)
       return output
 
-    if self.sample <= 1:
-      self.output = fn_logits(self.newimg)
-      self.output_y = fn_logits(self.slack)
-    else:
+    if self.sample > 1:
       tf.logging.info(
         "Monte Carlo (MC) on attacks, sample: {}".format(self.sample))
       tf.logging.info("batch_size: {}".format(self.batch_size))
-      self.output = batch_prediction(self.newimg)
-      self.output_y = batch_prediction(self.slack)
 
-    # distance to the input data
-    self.l2dist = tf.reduce_sum(tf.square(self.newimg-self.timg),
-                             list(range(1, len(shape))))
-    self.l2dist_y = tf.reduce_sum(tf.square(self.slack-self.timg),
-                               list(range(1, len(shape))))
-    self.l1dist = tf.reduce_sum(tf.abs(self.newimg-self.timg),
-                             list(range(1, len(shape))))
-    self.l1dist_y = tf.reduce_sum(tf.abs(self.slack-self.timg),
-                               list(range(1, len(shape))))
-    self.elasticdist = self.l2dist + tf.multiply(self.l1dist,
-                                                 self.beta_t)
-    self.elasticdist_y = self.l2dist_y + tf.multiply(self.l1dist_y,
-                                                     self.beta_t)
     if self.decision_rule == 'EN':
-      self.crit = self.elasticdist
       self.crit_p = 'Elastic'
     else:
-      self.crit = self.l1dist
       self.crit_p = 'L1'
 
-    # compute the probability of the label class versus the maximum other
-    real = tf.reduce_sum((self.tlab) * self.output, 1)
-    real_y = tf.reduce_sum((self.tlab) * self.output_y, 1)
-    other = tf.reduce_max((1 - self.tlab) * self.output -
-                       (self.tlab * 10000), 1)
-    other_y = tf.reduce_max((1 - self.tlab) * self.output_y -
-                         (self.tlab * 10000), 1)
+    def losses(img):
+      """Return the logits, the decision criterion and the loss terms of
+      each sample for an image."""
+      if self.sample <= 1:
+        output = fn_logits(img)
+      else:
+        output = batch_prediction(img)
 
-    zero = np.asarray(0., dtype=np_dtype)
-    if self.y_target:
-      # if targeted, optimize for making the other class most likely
-      loss1 = tf.maximum(zero, other - real + self.confidence)
-      loss1_y = tf.maximum(zero, other_y - real_y + self.confidence)
-    else:
-      # if untargeted, optimize for making this class least likely.
-      loss1 = tf.maximum(zero, real - other + self.confidence)
-      loss1_y = tf.maximum(zero, real_y - other_y + self.confidence)
-
-    # sum up the losses
-    self.loss21 = tf.reduce_sum(self.l1dist)
-    self.loss21_y = tf.reduce_sum(self.l1dist_y)
-    self.loss2 = tf.reduce_sum(self.l2dist)
-    self.loss2_y = tf.reduce_sum(self.l2dist_y)
-    self.loss1 = tf.reduce_sum(self.const * loss1)
-    self.loss1_y = tf.reduce_sum(self.const * loss1_y)
-    self.loss_opt = self.loss1_y + self.loss2_y
-    self.loss = self.loss1+self.loss2+tf.multiply(self.beta_t, self.loss21)
-
-    self.learning_rate = tf.train.polynomial_decay(
-        self.LEARNING_RATE,
-        self.global_step,
-        self.max_iterations,
-        0,
-        power=0.5)
-
-    # Setup the optimizer and keep track of variables we're creating
-    start_vars = set(x.name for x in tf.global_variables())
-    optimizer = tf.train.GradientDescentOptimizer(self.learning_rate)
-    self.train = optimizer.minimize(self.loss_opt,
-                                    var_list=[self.slack],
-                                    global_step=self.global_step)
-    end_vars = tf.global_variables()
-    new_vars = [x for x in end_vars if x.name not in start_vars]
+      # distance to the input data
+      l2dist = tf.reduce_sum(tf.square(img-self.timg),
+                             list(range(1, len(shape))))
+      l1dist = tf.reduce_sum(tf.abs(img-self.timg),
+                             list(range(1, len(shape))))
+      elasticdist = l2dist + tf.multiply(l1dist, self.beta_t)
+      crit = elasticdist if self.decision_rule == 'EN' else l1dist
+
+      # compute the probability of the label class versus the maximum other
+      real = tf.reduce_sum((self.tlab) * output, 1)
+      other = tf.reduce_max((1 - self.tlab) * output -
+                         (self.tlab * 10000), 1)
+      zero = np.asarray(0., dtype=np_dtype)
+      if self.y_target:
+        # if targeted, optimize for making the other class most likely
+        loss1 = tf.maximum(zero, other - real + self.confidence)
+      else:
+        # if untargeted, optimize for making this class least likely.
+        loss1 = tf.maximum(zero, real - other + self.confidence)
+      return output, crit, self.const * loss1, l2dist, l1dist
+
+    def shrinkage(slack):
+      """Projected shrinkage-thresholding of the slack variable."""
+      cond1 = tf.cast(tf.greater(tf.subtract(slack, self.timg),
+                                 self.beta_t), tf_dtype)
+      cond2 = tf.cast(tf.less_equal(tf.abs(tf.subtract(slack,
+                                                       self.timg)),
+                                    self.beta_t), tf_dtype)
+      cond3 = tf.cast(tf.less(tf.subtract(slack, self.timg),
+                              tf.negative(self.beta_t)), tf_dtype)
+
+      upper = tf.minimum(tf.subtract(slack, self.beta_t),
+                         tf.cast(self.clip_max, tf_dtype))
+      lower = tf.maximum(tf.add(slack, self.beta_t),
+                         tf.cast(self.clip_min, tf_dtype))
+
+      newimg = tf.multiply(cond1, upper)
+      newimg += tf.multiply(cond2, self.timg)
+      newimg += tf.multiply(cond3, lower)
+      return newimg
+
+    check_every = (self.max_iterations // 10) or 1
+
+    def cond(i, newimg, slack, *state):
+      return tf.logical_and(tf.less(i, self.max_iterations),
+                            tf.reduce_any(state[5]))
+
+    def body(i, newimg, slack, *state):
+      # gradient step on the slack variable, with the polynomial decay of
+      # the learning rate (power 0.5)
+      _, _, loss1_y, l2dist_y, _ = losses(slack)
+      grad, = tf.gradients(
+        tf.reduce_sum(loss1_y) + tf.reduce_sum(l2dist_y), slack)
+      step = tf.cast(i, tf_dtype)
+      learning_rate = self.learning_rate * tf.sqrt(
+        1 - step / self.max_iterations)
+      slack_step = slack - learning_rate * grad
+
+      # Fast Iterative Shrinkage Thresholding, the samples stopped by the
+      # early abort keep their images
+      zt = (step + 1) / (step + 1 + 3)
+      assign_newimg = shrinkage(slack_step)
+      assign_slack = assign_newimg + zt * (assign_newimg - newimg)
+      active = state[5]
+      newimg = tf.where(active, assign_newimg, newimg)
+      slack = tf.where(active, assign_slack, slack)
+
+      # record the best results of the iteration
+      output, crit, loss1, l2dist, l1dist = losses(newimg)
+      state = self.search.update(state, crit, output, newimg)
+
+      # check if we should abort search if we're getting nowhere, the
+      # samples which do not make progress are stopped
+      if self.abort_early:
+        loss_batch = loss1 + l2dist + tf.multiply(self.beta_t, l1dist)
+        state = self.search.abort(
+          state, loss_batch, tf.equal(i % check_every, 0))
+      return (i + 1, newimg, slack) + tuple(state)
+
+    # all the iterations of a binary search step run in a single loop on the
+    # device, the images and the slack variable start from the inputs
+    loop_vars = (tf.constant(0), self.timg.read_value(),
+                 self.timg.read_value()) + self.search.read()
+    outputs = tf.while_loop(cond, body, loop_vars, back_prop=False)
+    self.optimize = self.search.assign(outputs[3:])
 
     # these are the variables to initialize when we run
     self.setup = []
     self.setup.append(self.timg.assign(self.assign_timg))
     self.setup.append(self.tlab.assign(self.assign_tlab))
-    self.setup.append(self.const.assign(self.assign_const))
+    self.setup.append(self.search.reset_batch)
 
-    var_list = [self.global_step]+[self.slack]+[self.newimg]+new_vars
-    self.init = tf.variables_initializer(var_list=var_list)
+    # reset the best results of the step
+    self.init = self.search.reset_step
 
     def ead_wrap(x_val, y_val):
       return np.array(self.attack(x_val, y_val), dtype=np_dtype)
@@ -309,133 +303,51 @@ class ElasticNet:
 
   def attack_batch(self, imgs, labs):
     """
-    Run the attack on a batch of instance and labels.
+    Run the attack on a batch of instance and labels. The state of the
+    binary search is kept on the device, only the best adversarial examples
+    are fetched at the end.
     """
-
-    def compare(x, y):
-      if not isinstance(x, (float, int, np.int64)):
-        x = np.copy(x)
-        if self.y_target:
-          x[y] -= self.confidence
-        else:
-          x[y] += self.confidence
-        x = np.argmax(x)
-      if self.y_target:
-        return x == y
-      else:
-        return x != y
-
     batch_size = self.batch_size
 
     imgs = np.clip(imgs, self.clip_min, self.clip_max)
+    batch = imgs[:batch_size]
 
-    # set the lower and upper bounds accordingly
-    lower_bound = np.zeros(batch_size)
-    CONST = np.ones(batch_size) * self.initial_const
-    upper_bound = np.ones(batch_size) * 1e10
-
-    # placeholders for the best en, score, and instance attack found so far
-    o_bestdst = [1e10] * batch_size
-    o_bestscore = [-1] * batch_size
-    o_bestattack = np.copy(imgs)
+    # set the variables so that we don't have to send them over again
+    self.sess.run(
+        self.setup, {
+            self.assign_timg: batch,
+            self.assign_tlab: labs[:batch_size],
+            self.search.assign_oimg: batch
+        })
 
     for outer_step in range(self.binary_search_steps):
-      # completely reset the optimizer's internal state.
+      # reset the best results of the step
       self.sess.run(self.init)
-      batch = imgs[:batch_size]
-      batchlab = labs[:batch_size]
-
-      bestdst = [1e10] * batch_size
-      bestscore = [-1] * batch_size
       logging.debug("  Binary search step %s of %s",
                     outer_step, self.binary_search_steps)
 
       # The last iteration (if we run many steps) repeat the search once.
       if self.repeat and outer_step == self.binary_search_steps - 1:
-        CONST = upper_bound
-
-      # set the variables so that we don't have to send them over again
-      self.sess.run(
-          self.setup, {
-              self.assign_timg: batch,
-              self.assign_tlab: batchlab,
-              self.assign_const: CONST
-          })
-      self.sess.run(self.setter, {self.assign_newimg: batch})
-      self.sess.run(self.setter_y, {self.assign_slack: batch})
-      prev = 1e6
-      for iteration in range(self.max_iterations):
-        # perform the attack
-        self.sess.run([self.train])
-        self.sess.run([self.setter, self.setter_y])
-        l, l2s, l1s, crit, scores, nimg = self.sess.run([self.loss,
-                                                         self.l2dist,
-                                                         self.l1dist,
-                                                         self.crit,
-                                                         self.output,
-                                                         self.newimg])
-        if iteration % ((self.max_iterations // 10) or 1) == 0:
-          logging.debug(("    Iteration {} of {}: loss={:.3g} " +
-                         "l2={:.3g} l1={:.3g} f={:.3g}").format(
-                             iteration, self.max_iterations, l,
-                             np.mean(l2s), np.mean(l1s),
-                             np.mean(scores)))
-
-        # check if we should abort search if we're getting nowhere.
-        if self.abort_early and \
-           iteration % ((self.max_iterations // 10) or 1) == 0:
-          if l > prev * .9999:
-            msg = "    Failed to make progress; stop early"
-            logging.debug(msg)
-            break
-          prev = l
-
-        # adjust the best result found so far
-        for e, (dst, sc, ii) in enumerate(zip(crit, scores, nimg)):
-          lab = np.argmax(batchlab[e])
-          if dst < bestdst[e] and compare(sc, lab):
-            bestdst[e] = dst
-            bestscore[e] = np.argmax(sc)
-          if dst < o_bestdst[e] and compare(sc, lab):
-            o_bestdst[e] = dst
-            o_bestscore[e] = np.argmax(sc)
-            o_bestattack[e] = ii
+        self.sess.run(self.search.const_to_upper)
+
+      # perform the attack, all the iterations run in the graph
+      self.sess.run(self.optimize)
 
       # adjust the constant as needed
-      for e in range(batch_size):
-        if compare(bestscore[e], np.argmax(batchlab[e])) and \
-           bestscore[e] != -1:
-          # success, divide const by two
-          upper_bound[e] = min(upper_bound[e], CONST[e])
-          if upper_bound[e] < 1e9:
-            CONST[e] = (lower_bound[e] + upper_bound[e]) / 2
-        else:
-          # failure, either multiply by 10 if no solution found yet
-          #          or do binary search with the known upper bound
-          lower_bound[e] = max(lower_bound[e], CONST[e])
-          if upper_bound[e] < 1e9:
-            CONST[e] = (lower_bound[e] + upper_bound[e]) / 2
-          else:
-            CONST[e] *= 10
-      logging.debug("  Successfully generated adversarial examples " +
-                    "on {} of {} instances.".format(
-                        sum(upper_bound < 1e9), batch_size))
-      o_bestdst = np.array(o_bestdst)
-      mean = np.mean(np.sqrt(o_bestdst[o_bestdst < 1e9]))
-      logging.debug(self.crit_p +
-                    " Mean successful distortion: {:.4g}".format(mean))
+      self.sess.run(self.search.update_const)
+      if logging.getLogger().isEnabledFor(logging.DEBUG):
+        n_success, mean = self.sess.run(
+          [self.search.n_success, self.search.mean_dst])
+        logging.debug("  Successfully generated adversarial examples " +
+                      "on {} of {} instances.".format(n_success, batch_size))
+        logging.debug(self.crit_p +
+                      " Mean successful distortion: {:.4g}".format(mean))
 
     # return the best solution found
+    o_bestattack, n_success, mean = self.sess.run(
+      [self.search.o_bestattack, self.search.n_success,
+       self.search.mean_dst])
     logging.info("  Successfully generated adversarial examples " +
-                  "on {} of {} instances.".format(
-                      sum(upper_bound < 1e9), batch_size))
-    o_bestdst = np.array(o_bestdst)
-    mean = np.mean(np.sqrt(o_bestdst[o_bestdst < 1e9]))
+                  "on {} of {} instances.".format(n_success, batch_size))
     logging.info("   Mean successful distortion: {:.4g}".format(mean))
     return o_bestattack
-
-
-
-
-
-
@@ -37,6 +37,7 @@ class ProjectedGradientDescent:
                clip_max=None,
                y_target=None,
                sample=1,
+               early_stop=False,
                sanity_checks=False):
     """
     Create a ProjectedGradientDescent instance.
@@ -54,6 +55,10 @@ class ProjectedGradientDescent:
                 Possible values: np.inf, 1 or 2.
     :param clip_min: (optional float) Minimum input component value
     :param clip_max: (optional float) Maximum input component value
+    :param early_stop: (optional bool) Stop perturbing the samples once they
+                       are misclassified, the iterations only run on the
+                       samples still correctly classified and are skipped
+                       when there are none.
     :param sanity_checks: bool Insert tf asserts checking values
         (Some tests need to run with no sanity checks because the
          tests intentionally configure the attack strangely)
@@ -71,6 +76,7 @@ class ProjectedGradientDescent:
     self.clip_min = clip_min
     self.clip_max = clip_max
     self.sample = sample
+    self.early_stop = early_stop
     self.sanity_checks = sanity_checks
 
     if isinstance(eps, float) and isinstance(eps_iter, float):
@@ -90,6 +96,36 @@ class ProjectedGradientDescent:
       self.rand_minmax, self.eps, self.eps_iter, self.nb_iter, self.sample,
       self.ord)
 
+  def _early_stop_iteration(self, x, adv_x, y, active, fn_logits, fgm_attack):
+    """One iteration on the samples still correctly classified, gathered in
+    a compact batch. The misclassified samples keep their adversarial
+    example and the iteration is skipped when all the samples are
+    misclassified.
+    :param active: boolean tensor of the samples still attacked.
+    :return: the adversarial examples and the new active samples.
+    """
+    def attack():
+      index = tf.where(active)
+      x_active = tf.gather_nd(x, index)
+      adv_active = tf.gather_nd(adv_x, index)
+      y_active = tf.gather_nd(y, index)
+      logits = fn_logits(adv_active)
+      correct = tf.equal(tf.argmax(logits, 1), tf.argmax(y_active, 1))
+      loss = tf.nn.softmax_cross_entropy_with_logits_v2(
+        labels=tf.stop_gradient(y_active), logits=logits)
+      grad, = tf.gradients(tf.reduce_sum(loss), adv_active)
+      adv_new = adv_active + fgm_attack._optimize_linear(
+        grad, self.eps_iter, self.ord)
+      # Clipping perturbation eta to self.ord norm ball
+      eta = clip_eta(adv_new - x_active, self.ord, self.eps)
+      adv_new = x_active + eta
+      if self.clip_min is not None or self.clip_max is not None:
+        adv_new = clip_by_value(adv_new, self.clip_min, self.clip_max)
+      adv_new = tf.where(correct, adv_new, adv_active)
+      return (tf.tensor_scatter_nd_update(adv_x, index, adv_new),
+              tf.tensor_scatter_nd_update(active, index, correct))
+    return tf.cond(tf.reduce_any(active), attack, lambda: (adv_x, active))
+
   def generate(self, x, fn_logits, y=None):
     """
     Generate symbolic graph for adversarial examples and return.
@@ -180,19 +216,28 @@ class ProjectedGradientDescent:
     # _, adv_x = tf.while_loop(cond, body, (tf.zeros([]), adv_x), back_prop=True,
     #                          maximum_iterations=self.nb_iter)
 
-    for i in range(self.nb_iter):
-      adv_x = fgm_attack.generate(adv_x, fn_logits)
-
-      # Clipping perturbation eta to self.ord norm ball
-      eta = adv_x - x
-      eta = clip_eta(eta, self.ord, self.eps)
-      adv_x = x + eta
-
-      # Redo the clipping.
-      # FGM already did it, but subtracting and re-adding eta can add some
-      # small numerical error.
-      if self.clip_min is not None or self.clip_max is not None:
-        adv_x = clip_by_value(adv_x, self.clip_min, self.clip_max)
+    if self.early_stop:
+      if targeted or self.sample > 1:
+        raise ValueError("Early stopping PGD only supports untargeted "
+                         "attacks with a single sample.")
+      active = tf.ones(tf.shape(x)[:1], dtype=tf.bool)
+      for i in range(self.nb_iter):
+        adv_x, active = self._early_stop_iteration(
+          x, adv_x, y, active, fn_logits, fgm_attack)
+    else:
+      for i in range(self.nb_iter):
+        adv_x = fgm_attack.generate(adv_x, fn_logits)
+
+        # Clipping perturbation eta to self.ord norm ball
+        eta = adv_x - x
+        eta = clip_eta(eta, self.ord, self.eps)
+        adv_x = x + eta
+
+        # Redo the clipping.
+        # FGM already did it, but subtracting and re-adding eta can add some
+        # small numerical error.
+        if self.clip_min is not None or self.clip_max is not None:
+          adv_x = clip_by_value(adv_x, self.clip_min, self.clip_max)
 
     # Asserts run only on CPU.
     # When multi-GPU eval code tries to force all PGD ops onto GPU, this
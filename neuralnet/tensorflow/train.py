@@ -202,6 +202,13 @@ class Trainer:
     # create a mesage builder for logging
     self.message = global_utils.MessageBuilder()
 
+    # time spent waiting for the input pipeline vs in compute, measured from
+    # the IteratorGetNext ops every stall_probe_steps steps
+    self.stall_detector = global_utils.StallDetector(
+      threshold=getattr(self.params, 'datasets_stall_threshold', 0.1))
+    self.stall_probe_steps = getattr(
+      self.params, 'stall_probe_steps', self.params.frequency_log_steps)
+
     self.batch_size = self.params.batch_size * self.num_gpus
     if self.job_name:
       self.global_batch_size = self.batch_size * \
@@ -838,17 +845,32 @@ class Trainer:
         generate_tfprof_profile(profiler, self.params.tfprof_file)
 
 
+  def _get_input_wait_time(self, run_metadata):
+    """Return the time in seconds spent in the IteratorGetNext ops, i.e.
+    waiting for the input pipeline."""
+    wait_time = 0.
+    for dev_stats in run_metadata.step_stats.dev_stats:
+      for node_stats in dev_stats.node_stats:
+        if 'IteratorGetNext' in node_stats.node_name:
+          # the iterators of the towers run concurrently
+          wait_time = max(wait_time, node_stats.all_end_rel_micros / 1e6)
+    return wait_time
+
   def _training(self, sess, step, fetches, profiler,
                 collective_graph_key):
 
     should_profile = profiler and 0 <= step < 20
+    should_probe_stall = bool(self.stall_probe_steps) and \
+        step % self.stall_probe_steps == 0
     need_options_and_metadata = (
         should_profile or collective_graph_key > 0 or
-        (self.trace_filename and step == 0))
+        (self.trace_filename and step == 0) or should_probe_stall)
     if need_options_and_metadata:
       run_options = tf.RunOptions()
       if (self.trace_filename and step == 0) or should_profile:
         run_options.trace_level = tf.RunOptions.FULL_TRACE
+      elif should_probe_stall:
+        run_options.trace_level = tf.RunOptions.SOFTWARE_TRACE
       if collective_graph_key > 0:
         run_options.experimental.collective_graph_key = collective_graph_key
       run_metadata = tf.RunMetadata()
@@ -862,6 +884,11 @@ class Trainer:
     examples_per_second = self.batch_size / seconds_per_batch
     step = results['global_step']
 
+    if should_probe_stall:
+      wait_time = self._get_input_wait_time(run_metadata)
+      wait_time = min(wait_time, seconds_per_batch)
+      self.stall_detector.add(wait_time, seconds_per_batch - wait_time)
+
     to_print = step % self.params.frequency_log_steps == 0
     if (self.is_master and to_print) or step == 1:
       epoch = ((step * self.batch_size)
@@ -871,7 +898,16 @@ class Trainer:
       self.message.add("lr", results['learning_rate'], format=".6f")
       self.message.add("loss", results['loss'], format=".4f")
       self.message.add("imgs/sec", examples_per_second, width=5, format=".0f")
+      self.message.add("stall", self.stall_detector.stall() * 100, format=".1f")
       logging.info(self.message.get_message())
+      if self.stall_detector.is_stalling():
+        num_threads = getattr(self.params, 'datasets_num_private_threads', 0)
+        logging.info(
+          "Input pipeline stalled {:.1%} of the time, consider increasing "
+          "datasets_num_private_threads from {} to {}.".format(
+            self.stall_detector.stall(), num_threads,
+            self.stall_detector.get_suggestion(num_threads)))
+      self.stall_detector.reset()
 
     if need_options_and_metadata:
       if should_profile:
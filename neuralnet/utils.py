@@ -6,6 +6,8 @@ import shutil
 import json
 import logging
 import glob
+import math
+import multiprocessing
 import absl.logging
 from os.path import join
 from os.path import exists
@@ -114,6 +116,47 @@ class MessageBuilder:
 
 
 
+class StallDetector:
+  """Detect data starvation by comparing the time spent waiting for the
+  input pipeline with the time spent in compute."""
+
+  def __init__(self, threshold=0.1):
+    self.threshold = threshold
+    self.reset()
+
+  def reset(self):
+    self.wait_time = 0.
+    self.compute_time = 0.
+    self.queue_depths = []
+
+  def add(self, wait_time, compute_time, queue_depth=None):
+    self.wait_time += wait_time
+    self.compute_time += compute_time
+    if queue_depth is not None:
+      self.queue_depths.append(queue_depth)
+
+  def stall(self):
+    """Fraction of the time spent waiting for the data."""
+    total_time = self.wait_time + self.compute_time
+    if total_time == 0:
+      return 0.
+    return self.wait_time / total_time
+
+  def queue_depth(self):
+    """Mean number of batches ready in the input queue, None if unknown."""
+    if not self.queue_depths:
+      return None
+    return sum(self.queue_depths) / len(self.queue_depths)
+
+  def is_stalling(self):
+    return self.stall() > self.threshold
+
+  def get_suggestion(self, num_threads):
+    """Return the suggested number of input threads."""
+    cpu_count = multiprocessing.cpu_count()
+    return min(cpu_count, int(math.ceil(max(num_threads, 1) * 1.5)))
+
+
 def setup_logging(verbosity):
   formatter = logging.Formatter(
     "[%(asctime)s %(filename)s:%(lineno)s] %(message)s",
@@ -59,7 +59,21 @@ class GenerateScript:
       self.distributed = False
       self.nodes = 1
 
-    if backend  == 'pytorch' and self.distributed:
+    max_restarts = 0
+    if self.distributed:
+      max_restarts = self.distributed_config.get('max_restarts', 0)
+    if backend  == 'pytorch' and self.distributed and max_restarts:
+      # elastic training with torchrun: the workers are restarted after a
+      # failure and the nodes can join or leave the job
+      setup_dist_pytorch = [' -m torch.distributed.run']
+      setup_dist_pytorch.append('--nnodes 1:{}'.format(self.nodes))
+      setup_dist_pytorch.append('--nproc_per_node={}'.format(self.n_gpus))
+      setup_dist_pytorch.append('--max_restarts={}'.format(max_restarts))
+      setup_dist_pytorch.append('--rdzv_id ${SLURM_JOB_ID}')
+      setup_dist_pytorch.append('--rdzv_backend c10d')
+      setup_dist_pytorch.append('--rdzv_endpoint ${master_host}:${master_port}')
+      self.python_exec += ' '.join(setup_dist_pytorch)
+    elif backend  == 'pytorch' and self.distributed:
       # add torch.distributed.launch config before main script
       setup_dist_pytorch = [' -m torch.distributed.launch']
       setup_dist_pytorch.append('--nnodes {}'.format(self.nodes))
@@ -17,7 +17,8 @@ from script import GenerateScript
 _CLUSTER_MAX_TIME_JOB = 20
 
 LIST_ATTACKS = [
-  'fgm', 'fgsm', 'pgd', 'pgd_l2', 'pgd_linf', 'carlini', 'elasticnet']
+  'fgm', 'fgsm', 'pgd', 'pgd_l2', 'pgd_linf', 'carlini', 'elasticnet',
+  'multi']
 
 DATE_FORMAT = "%Y-%m-%d_%H.%M.%S_%f"
 
@@ -363,6 +364,9 @@ if __name__ == '__main__':
                       help="Port to use for parameter server.")
   parser.add_argument("--wk_port", type=int, default=9000,
                       help="Port to use for workers." )
+  parser.add_argument("--max_restarts", type=int, default=0,
+                      help="Elastic training with torchrun, number of times "
+                           "the workers are restarted after a failure.")
  
   # parse all arguments 
   args = parser.parse_args()
@@ -387,7 +391,8 @@ if __name__ == '__main__':
       "nodes": args.nodes,
       "num_ps": args.num_ps,
       "ps_port": args.ps_port,
-      "wk_port": args.wk_port
+      "wk_port": args.wk_port,
+      "max_restarts": args.max_restarts
     }
   else:
     distributed_config = None